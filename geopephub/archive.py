@@ -3,29 +3,40 @@
 # v1 lives in bunch_geo.py and is intentionally left alone: it assumes a
 # destination directory that survives between runs, which is how the manual
 # Rivanna flow documented in the README works. This module assumes the
-# opposite -- nothing persists except the tar in S3 -- so it rehydrates the
-# previous archive, applies the delta, and republishes.
+# opposite -- nothing persists except the tar in S3 -- so it diffs the
+# manifest of the previous archive against the live namespace, streams the
+# previous archive into a new one, merging in the delta, and republishes.
 
 import concurrent.futures
+import io
+import json
 import logging
 import os
+import posixpath
 import shutil
 import tarfile
-from typing import Optional, Tuple
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
 
 import pepdbagent
-from pepdbagent.models import TarNamespaceModel
+from pepdbagent.models import RegistryPath, TarNamespaceModel
 from pephubclient.helpers import save_pep
 
-from geopephub.utils import date_today, get_agent, tar_folder
+from geopephub.metrics import ARCHIVE_BYTES
+from geopephub.pephub import get_namespace_digests
+from geopephub.s3 import download_file
+from geopephub.utils import date_today, get_agent
 
 _LOGGER = logging.getLogger(__name__)
 
 ARCHIVE_BUCKET = "pephub"
 PEPS_DIRNAME = "peps"
 
-# Sentinel start date for a cold start, matching v1's auto_run.
-EPOCH_START = "2000/01/01"
+# Last member of every archive: name, tag, digest, size and tar offset of its
+# PEPs. The offset is where the header of the member starts (TarInfo.fromtarfile
+# reads it from there)
+MANIFEST_MEMBER = f"{PEPS_DIRNAME}/manifest.json"
+MANIFEST_VERSION = 1
 
 
 def gse_shard(name: str) -> str:
@@ -72,91 +83,273 @@ def normalize_archive_key(file_path: str, bucket: str = ARCHIVE_BUCKET) -> str:
     return key
 
 
-def count_projects(peps_dir: str) -> int:
+def _member_name(name: str) -> str:
     """
-    Count PEPs actually present in the archive tree.
+    Archive member name of a project.
 
-    v1 registers agent.annotation.get(...).count -- the live namespace count --
-    which makes the number useless for spotting a short dump. This counts what
-    will really be in the tar.
-
-    :param peps_dir: the peps/ directory
-    :return: number of .zip files, recursively
+    :param name: project name, e.g. 'gse100000'
+    :return: 'peps/gse100nnn/gse100000.zip'
     """
-    total = 0
-    for _, _, files in os.walk(peps_dir):
-        total += sum(1 for f in files if f.endswith(".zip"))
-    return total
+    return posixpath.join(PEPS_DIRNAME, gse_shard(name), f"{name}.zip")
 
 
-def resolve_shards(peps_dir: str) -> int:
+def _project_member_name(member_name: str) -> Optional[str]:
     """
-    Move PEPs that landed in the wrong shard into the right one.
-
-    Repairs the flat peps/gsennn/ pile left by the create_gse_sub_name(namespace)
-    regression. Idempotent: a second call over a clean tree moves nothing.
-    Projects whose name is short enough to legitimately shard to 'gsennn' stay
-    where they are.
+    Archive member name of a PEP zip, in its correct shard.
 
-    :param peps_dir: the peps/ directory
-    :return: number of files relocated
+    :param member_name: member name from the tar, e.g. 'peps/gsennn/gse100000.zip'
+    :return: 'peps/gse100nnn/gse100000.zip', or None if the member is not a PEP
     """
-    moved = 0
-    for shard in sorted(os.listdir(peps_dir)):
-        shard_path = os.path.join(peps_dir, shard)
-        if not os.path.isdir(shard_path):
-            continue
-        for filename in sorted(os.listdir(shard_path)):
-            if not filename.endswith(".zip"):
-                continue
-            correct = gse_shard(filename[: -len(".zip")])
-            if correct == shard:
-                continue
-            target_dir = os.path.join(peps_dir, correct)
-            os.makedirs(target_dir, exist_ok=True)
-            shutil.move(
-                os.path.join(shard_path, filename),
-                os.path.join(target_dir, filename),
-            )
-            moved += 1
-    if moved:
-        _LOGGER.info(f"Relocated {moved} projects into correct shard directories")
-    return moved
+    if not member_name.endswith(".zip"):
+        return None
+    return _member_name(posixpath.basename(member_name)[: -len(".zip")])
 
 
-def extract_archive(tar_path: str, destination: str) -> str:
+def _check_member(member: tarfile.TarInfo) -> None:
     """
-    Extract a published archive, returning the peps/ directory inside it.
+    Refuse members that are not rooted at 'peps/', escape it, or are neither
+    files nor directories.
 
     v1 tars with arcname=basename(folder), so every member is rooted at 'peps/'.
     Anything else means the tar was not produced by this pipeline and the run
     should stop rather than build on top of an unknown layout.
+    """
+    parts = member.name.split("/")
+    if parts[0] != PEPS_DIRNAME:
+        raise ValueError(
+            f"Unexpected archive layout: member '{member.name}' is not "
+            f"rooted at '{PEPS_DIRNAME}/'. Refusing to merge."
+        )
+    if ".." in parts or posixpath.isabs(member.name):
+        raise ValueError(f"Archive member escapes destination: {member.name}")
+    if not (member.isfile() or member.isdir()):
+        raise ValueError(f"Unexpected archive member type: {member.name}")
+
 
-    :param tar_path: local path to the downloaded tar
-    :param destination: directory to extract into
-    :return: path to the extracted peps/ directory
+def _add_directories(tar: tarfile.TarFile, member_name: str, written_dirs: set) -> None:
     """
-    os.makedirs(destination, exist_ok=True)
-    dest_real = os.path.realpath(destination)
+    Add directory entries for the parents of a member, unless already written.
+    """
+    parent = posixpath.dirname(member_name)
+    missing = []
+    while parent and parent not in written_dirs:
+        missing.append(parent)
+        parent = posixpath.dirname(parent)
+    for directory in reversed(missing):
+        info = tarfile.TarInfo(directory)
+        info.type = tarfile.DIRTYPE
+        info.mode = 0o755
+        info.mtime = int(time.time())
+        tar.addfile(info)
+        written_dirs.add(directory)
+
+
+def merge_archive(
+    previous_tar: Optional[str],
+    delta_dir: str,
+    output_path: str,
+    drop: Iterable[str] = (),
+    projects: Dict[str, dict] = None,
+) -> dict:
+    """
+    Write a new archive from the previous one and the delta, in one pass.
+
+    The previous tar is read member by member and copied straight into the new
+    one; nothing is extracted. PEPs that are also in the delta are dropped from
+    the copy and the delta versions are appended after it. PEPs in the wrong
+    shard, such as the flat peps/gsennn/ pile left by the
+    create_gse_sub_name(namespace) regression, are renamed on the way. The
+    manifest of the new archive is written as its last member. The output is
+    written next to output_path and renamed over it at the end, so output_path
+    may be the previous tar itself.
+
+    :param previous_tar: local path to the previous archive, None on cold start
+    :param delta_dir: peps/ directory holding only the projects of the delta
+    :param output_path: path of the new tar
+    :param drop: member names of PEPs to leave out (deleted projects)
+    :param projects: {member name: {'name', 'tag', 'digest'}} of the PEPs, for
+        the manifest
+    :return: {'projects': int, 'kept': int, 'replaced': int, 'added': int,
+        'dropped': int, 'relocated': int}
+    """
+    delta = {}
+    for root, _, files in os.walk(delta_dir):
+        for filename in files:
+            member_name = _project_member_name(filename)
+            if member_name:
+                delta[member_name] = os.path.join(root, filename)
+    drop = set(drop)
+    projects = projects or {}
+
+    stats = {
+        "projects": 0,
+        "kept": 0,
+        "replaced": 0,
+        "added": 0,
+        "dropped": 0,
+        "relocated": 0,
+    }
+    manifest = []
+    written_dirs = set()
+    part_path = f"{output_path}.part"
+
+    def _add_project(out: tarfile.TarFile, member: tarfile.TarInfo, fileobj) -> None:
+        _add_directories(out, member.name, written_dirs)
+        offset = out.offset
+        out.addfile(member, fileobj)
+        name = posixpath.basename(member.name)[: -len(".zip")]
+        project = projects.get(member.name, {})
+        manifest.append(
+            {
+                "path": member.name,
+                "name": project.get("name", name),
+                "tag": project.get("tag"),
+                "digest": project.get("digest"),
+                "size": member.size,
+                "offset": offset,
+            }
+        )
+
+    with tarfile.open(part_path, "w") as out:
+        if previous_tar:
+            written = set()
+            with tarfile.open(previous_tar, "r|") as previous:
+                for member in previous:
+                    _check_member(member)
+                    if member.name == MANIFEST_MEMBER:
+                        continue
+                    if member.isdir():
+                        if member.name not in written_dirs:
+                            out.addfile(member)
+                            written_dirs.add(member.name)
+                        continue
+                    member_name = _project_member_name(member.name)
+                    if member_name is None:
+                        out.addfile(member, previous.extractfile(member))
+                        continue
+                    if member_name in written:
+                        continue
+                    written.add(member_name)
+                    if member_name in drop:
+                        stats["dropped"] += 1
+                        continue
+                    if member_name in delta:
+                        stats["replaced"] += 1
+                        continue
+                    if member_name != member.name:
+                        member.name = member_name
+                        stats["relocated"] += 1
+                    _add_project(out, member, previous.extractfile(member))
+                    stats["kept"] += 1
+
+        for member_name, path in sorted(delta.items()):
+            member = out.gettarinfo(path, arcname=member_name)
+            with open(path, "rb") as f:
+                _add_project(out, member, f)
+        stats["added"] = len(delta) - stats["replaced"]
+
+        _add_directories(out, MANIFEST_MEMBER, written_dirs)
+        data = json.dumps(
+            {"version": MANIFEST_VERSION, "projects": manifest}, indent=1
+        ).encode("utf-8")
+        info = tarfile.TarInfo(MANIFEST_MEMBER)
+        info.size = len(data)
+        info.mode = 0o644
+        info.mtime = int(time.time())
+        out.addfile(info, io.BytesIO(data))
+
+    os.replace(part_path, output_path)
+    stats["projects"] = len(manifest)
+    _LOGGER.info(
+        f"Merged archive: {stats['kept']} kept, {stats['replaced']} replaced, "
+        f"{stats['added']} added, {stats['dropped']} dropped, "
+        f"{stats['relocated']} relocated"
+    )
+    return stats
+
+
+def read_manifest(tar_path: str) -> Optional[Dict[str, dict]]:
+    """
+    Read the manifest of an archive.
 
-    # Python 3.14 makes 'data' the default extraction filter; opt in early where
-    # it exists so behavior does not shift under us.
-    extract_kwargs = {"filter": "data"} if hasattr(tarfile, "data_filter") else {}
+    The manifest is the last member, so every header is read to reach it, but
+    none of the PEPs.
 
+    :param tar_path: local path to the archive
+    :return: {member name: manifest entry}, or None if the archive has no
+        manifest (archives published before manifests were added)
+    """
     with tarfile.open(tar_path, "r") as tar:
         for member in tar:
-            root = member.name.split("/", 1)[0]
-            if root != PEPS_DIRNAME:
-                raise ValueError(
-                    f"Unexpected archive layout: member '{member.name}' is not "
-                    f"rooted at '{PEPS_DIRNAME}/'. Refusing to extract."
-                )
-            target = os.path.realpath(os.path.join(dest_real, member.name))
-            if not target.startswith(dest_real + os.sep):
-                raise ValueError(f"Archive member escapes destination: {member.name}")
-            tar.extract(member, path=dest_real, **extract_kwargs)
+            if member.name == MANIFEST_MEMBER:
+                manifest = json.load(tar.extractfile(member))
+                return {entry["path"]: entry for entry in manifest["projects"]}
+    return None
+
+
+def _legacy_manifest(tar_path: str) -> Dict[str, dict]:
+    """
+    Manifest of an archive without one, from its member names. Digests are
+    unknown.
+
+    :param tar_path: local path to the archive
+    :return: {member name: manifest entry}
+    """
+    entries = {}
+    with tarfile.open(tar_path, "r|") as tar:
+        for member in tar:
+            member_name = _project_member_name(member.name)
+            if member_name and member.isfile():
+                entries[member_name] = {
+                    "path": member_name,
+                    "name": posixpath.basename(member_name)[: -len(".zip")],
+                    "tag": None,
+                    "digest": None,
+                }
+    return entries
+
+
+def live_projects(digests: Dict[Tuple[str, str], str]) -> Dict[str, dict]:
+    """
+    Archive member of every live project.
+
+    A PEP is archived as <name>.zip, so several tags of a name share a member;
+    the 'default' tag is archived, or the first tag in alphabetical order.
 
-    return os.path.join(destination, PEPS_DIRNAME)
+    :param digests: {(name, tag): digest} of the namespace
+    :return: {member name: {'name', 'tag', 'digest'}}
+    """
+    projects = {}
+    for (name, tag), digest in sorted(
+        digests.items(), key=lambda item: (item[0][1] != "default", item[0])
+    ):
+        projects.setdefault(
+            _member_name(name), {"name": name, "tag": tag, "digest": digest}
+        )
+    return projects
+
+
+def diff_manifest(
+    previous: Dict[str, dict], live: Dict[str, dict], updated: Iterable[str] = ()
+) -> Tuple[List[str], List[str]]:
+    """
+    Compare the manifest of the previous archive with the live namespace.
+
+    :param previous: manifest of the previous archive
+    :param live: live projects, result of live_projects
+    :param updated: member names to fetch even if their digest did not change
+    :return: (member names to fetch, member names to drop)
+    """
+    updated = set(updated)
+    fetch = [
+        member_name
+        for member_name, project in sorted(live.items())
+        if member_name in updated
+        or member_name not in previous
+        or previous[member_name].get("digest") != project["digest"]
+    ]
+    drop = sorted(set(previous) - set(live))
+    return fetch, drop
 
 
 def download_previous_archive(
@@ -174,8 +367,6 @@ def download_previous_archive(
     :param bucket: S3 bucket holding the archives
     :return: (local tar path, start period as 'YYYY/MM/DD'), both None on cold start
     """
-    import boto3
-
     info = agent.namespace.get_tar_info(namespace=namespace)
     if not info.count:
         _LOGGER.info(f"No archive registered for '{namespace}'; starting from scratch")
@@ -187,7 +378,7 @@ def download_previous_archive(
 
     _LOGGER.info(f"Downloading previous archive s3://{bucket}/{key}")
     os.makedirs(destination, exist_ok=True)
-    boto3.client("s3").download_file(bucket, key, local_path)
+    download_file(bucket, key, local_path)
 
     start_period = latest.creation_date.strftime("%Y/%m/%d")
     _LOGGER.info(
@@ -197,33 +388,22 @@ def download_previous_archive(
     return local_path, start_period
 
 
-def sync_delta(
+def updated_projects(
     agent: pepdbagent.PEPDatabaseAgent,
     namespace: str,
-    peps_dir: str,
     start_period: str,
     end_period: str,
-    workers: int = 4,
-) -> dict:
+) -> List[RegistryPath]:
     """
-    Download every project updated in the window and write it into the tree.
+    List projects updated in the window.
 
-    Filtering on last_update_date returns new *and* revised projects, so this
-    single pass covers both -- provided save_pep is allowed to overwrite. v1
-    passes force=False, so revisions raise PEPExistsError and get swallowed by a
-    "skipping" warning; that is why every project revised since Sept 2024 is
-    stale in the published archive. force=True here is the fix, and
-    PEPExistsError is deliberately not caught: if it fires, something is wrong
-    and the run should say so.
+    Filtering on last_update_date returns new *and* revised projects.
 
     :param agent: PEPDatabaseAgent
-    :param namespace: namespace to sync
-    :param peps_dir: the peps/ directory to write into
+    :param namespace: namespace to search
     :param start_period: earlier bound, 'YYYY/MM/DD'
     :param end_period: later bound, 'YYYY/MM/DD'
-    :param workers: concurrent fetches; each opens its own session off the
-        shared engine, so keep this under the SQLAlchemy pool size
-    :return: {'attempted': int, 'written': int, 'failed': [(name, reason), ...]}
+    :return: registry paths of the projects
     """
     projects = agent.annotation.get_projects_list(
         namespace=namespace,
@@ -233,10 +413,36 @@ def sync_delta(
         filter_start_date=start_period,
         filter_end_date=end_period,
     )
-    attempted = len(projects)
     _LOGGER.info(
-        f"{attempted} projects updated between {start_period} and {end_period}"
+        f"{len(projects)} projects updated between {start_period} and {end_period}"
     )
+    return projects
+
+
+def sync_delta(
+    agent: pepdbagent.PEPDatabaseAgent,
+    projects: List[RegistryPath],
+    peps_dir: str,
+    workers: int = 4,
+) -> dict:
+    """
+    Download the projects of the delta and write them into the tree.
+
+    Revised projects overwrite their previous zip, so save_pep must be allowed
+    to overwrite. v1 passes force=False, so revisions raise PEPExistsError and
+    get swallowed by a "skipping" warning; that is why every project revised
+    since Sept 2024 is stale in the published archive. force=True here is the
+    fix, and PEPExistsError is deliberately not caught: if it fires, something
+    is wrong and the run should say so.
+
+    :param agent: PEPDatabaseAgent
+    :param projects: registry paths of the projects to download
+    :param peps_dir: the peps/ directory to write into
+    :param workers: concurrent fetches; each opens its own session off the
+        shared engine, so keep this under the SQLAlchemy pool size
+    :return: {'attempted': int, 'written': int, 'failed': [(name, reason), ...]}
+    """
+    attempted = len(projects)
 
     failed = []
     written = 0
@@ -281,14 +487,17 @@ def build_archive(
     """
     Produce a dated full-namespace archive without relying on persistent state.
 
-    Downloads the last published archive, applies the update delta, repairs
-    shard layout, re-tars, and (optionally) publishes and registers the result.
+    Downloads the last published archive and diffs its manifest against the
+    digests of the live namespace: changed and new projects are fetched,
+    deleted ones dropped, unchanged ones copied over untouched. The previous
+    tar and the delta are merged into a new tar in one pass (repairing shard
+    layout on the way), which is (optionally) published and registered.
 
     :param namespace: namespace to archive
-    :param workdir: scratch directory; needs roughly 5GB free for geo
-    :param start_period: override the delta start ('YYYY/MM/DD'). Defaults to the
-        previous archive's creation date. Widen it to re-pull projects that
-        earlier runs skipped.
+    :param workdir: scratch directory; needs room for two archives and the delta
+    :param start_period: also re-pull projects updated since this date
+        ('YYYY/MM/DD'), even if their digest did not change. Archives without a
+        manifest default it to their creation date.
     :param workers: concurrent project fetches
     :param register: upload to S3 and write the archive row
     :param bucket: S3 bucket
@@ -305,23 +514,51 @@ def build_archive(
         agent, namespace, workdir, bucket=bucket
     )
 
-    if previous_tar:
-        peps_dir = extract_archive(previous_tar, workdir)
-        os.remove(previous_tar)
-        _LOGGER.info(f"Rehydrated {count_projects(peps_dir)} projects from previous archive")
-    else:
-        peps_dir = os.path.join(workdir, PEPS_DIRNAME)
-        os.makedirs(peps_dir, exist_ok=True)
-
-    resolve_shards(peps_dir)
+    # only the delta is written to disk; the previous archive is merged with
+    # it as a stream, without extracting it
+    delta_root = os.path.join(workdir, "delta")
+    peps_dir = os.path.join(delta_root, PEPS_DIRNAME)
+    if os.path.exists(delta_root):
+        shutil.rmtree(delta_root)
+    os.makedirs(peps_dir)
 
-    start = start_period or previous_period or EPOCH_START
+    live = live_projects(get_namespace_digests(agent, namespace))
+    previous = {}
+    if previous_tar:
+        previous = read_manifest(previous_tar)
+        if previous is None:
+            # published before manifests: trust the date-based delta, as v1 did
+            _LOGGER.info("Previous archive has no manifest; using a date-based delta")
+            previous = _legacy_manifest(previous_tar)
+            for member_name, entry in previous.items():
+                if member_name in live:
+                    entry["digest"] = live[member_name]["digest"]
+            start_period = start_period or previous_period
+
+    updated = []
+    if start_period:
+        updated = [
+            _member_name(registry_path.name)
+            for registry_path in updated_projects(
+                agent, namespace, start_period, date_today(separator="/")
+            )
+        ]
+    fetch, drop = diff_manifest(previous, live, updated)
+    _LOGGER.info(
+        f"{len(fetch)} projects to fetch, {len(drop)} to drop, "
+        f"{len(live) - len(fetch)} unchanged"
+    )
     stats = sync_delta(
         agent,
-        namespace=namespace,
+        [
+            RegistryPath(
+                namespace=namespace,
+                name=live[member_name]["name"],
+                tag=live[member_name]["tag"],
+            )
+            for member_name in fetch
+        ],
         peps_dir=peps_dir,
-        start_period=start,
-        end_period=date_today(separator="/"),
         workers=workers,
     )
 
@@ -334,15 +571,28 @@ def build_archive(
                 f"a partial archive."
             )
 
-    tar_path = tar_folder(peps_dir, os.path.join(workdir, f"{namespace}_{date_today()}"))
-    actual = count_projects(peps_dir)
-    live = agent.annotation.get(namespace=namespace, limit=1).count
-    _LOGGER.info(f"Archived {actual} projects (live namespace count: {live})")
-    if actual != live:
+    # PEPs that failed to fetch keep their previous version and digest
+    failed_names = {name for name, _ in stats["failed"]}
+    projects = dict(previous)
+    for member_name in fetch:
+        if live[member_name]["name"] not in failed_names:
+            projects[member_name] = live[member_name]
+
+    tar_path = os.path.join(workdir, f"{namespace}_{date_today()}.tar")
+    merge_stats = merge_archive(
+        previous_tar, peps_dir, tar_path, drop=drop, projects=projects
+    )
+    if previous_tar and os.path.abspath(previous_tar) != os.path.abspath(tar_path):
+        os.remove(previous_tar)
+    shutil.rmtree(delta_root)
+    ARCHIVE_BYTES.inc(os.path.getsize(tar_path), namespace=namespace)
+    actual = merge_stats["projects"]
+    _LOGGER.info(f"Archived {actual} projects (live namespace: {len(live)})")
+    if actual != len(live):
         _LOGGER.warning(
-            f"Archive holds {actual} projects but the namespace reports {live}. "
-            f"Deleted projects are never removed by a date-based delta; a digest "
-            f"manifest would be needed to reconcile this."
+            f"Archive holds {actual} projects but the namespace has {len(live)}. "
+            f"Projects that failed to fetch are missing or stale; the next run "
+            f"fetches them again."
         )
 
     if not register:
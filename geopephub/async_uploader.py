@@ -0,0 +1,401 @@
+# Asyncio uploader (`geopephub run-uploader --async`).
+#
+# Most of the time of an upload cycle is spent waiting: on NCBI, on the PEPhub
+# database and on the status tables. The async uploader keeps hundreds of GSEs
+# in flight as cheap tasks, and writes their statuses through an async engine.
+# geofetch (a subprocess, whose result is parsed in Python) and pepdbagent are
+# blocking, so they run in thread pools: geofetch in `workers` threads, under
+# the same NCBI rate limiter and adaptive concurrency limit as the sync
+# uploader, and PEPhub writes in a single thread, like in the sync uploader.
+
+import asyncio
+import datetime
+import functools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterable, AsyncIterator, Dict, List
+
+import geofetch
+import pepdbagent
+import peppy
+
+from geopephub.const import (
+    ASYNC_IN_FLIGHT,
+    GEOFETCH_NCBI_REQUESTS,
+    GEOFETCH_TIMEOUT,
+    WORKER_LEASE_SECONDS,
+)
+from geopephub.db_utils import AsyncBaseEngine
+from geopephub.lease import LeaseHeartbeat, make_worker_id
+from geopephub.metrics import UPLOAD_THROUGHPUT, observe_gse
+from geopephub.metageo_pephub import (
+    _count_samples,
+    _create_gse_projects,
+    _failure_info,
+    _finish_cycle,
+    _geofetcher_kwargs,
+    _log_rate_limit_report,
+)
+from geopephub.models import StatusModel
+from geopephub.retry import retry_call
+from geopephub.throttle import AdaptiveConcurrency, get_ncbi_rate_limiter
+from geopephub.timing import timed
+from geopephub.utils import (
+    FunctionTimeoutError,
+    get_agent,
+    get_async_base_db_engine,
+    get_base_db_engine,
+    get_geofetch_cache,
+    is_throttling_error,
+    run_geofetch,
+)
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class _StatusCollector:
+    """
+    Stands in for the status connection in blocking code, that runs in a
+    thread. Collected statuses are written by the event loop afterwards.
+    """
+
+    def __init__(self):
+        self.models: List[StatusModel] = []
+
+    def upload_project_log(self, model: StatusModel) -> StatusModel:
+        self.models.append(model.model_copy())
+        return model
+
+
+async def upload_queued_projects_async(
+    target: str,
+    tag: str = None,
+    workers: int = 1,
+    in_flight: int = ASYNC_IN_FLIGHT,
+    geofetch_timeout: int = GEOFETCH_TIMEOUT,
+    resume: bool = False,
+    lease_seconds: int = WORKER_LEASE_SECONDS,
+) -> None:
+    """
+    Upload projects of the queued cycles, with asyncio
+
+    Cycles are claimed, resumed and finished like in upload_queued_projects.
+
+    :param target: Namespace of the projects (bedbase, geo)
+    :param tag: Tag of the projects
+    :param workers: number of concurrent geofetch runs
+    :param in_flight: number of GSEs processed at once
+    :param geofetch_timeout: seconds before geofetch of a single GSE is killed
+    :param resume: first requeue cycles and projects of uploaders and workers,
+        whose leases expired (they were killed or crashed)
+    :param lease_seconds: seconds before a claimed cycle is considered abandoned,
+        if this uploader stops sending heartbeats
+    :return: None
+    """
+    _LOGGER.info(f"Time now: {datetime.datetime.now()}")
+    _LOGGER.info(f"geofetch version: {geofetch.__version__}")
+    _LOGGER.info(f"pepdbagent version: {pepdbagent.__version__}")
+    _LOGGER.info(f"peppy version: {peppy.__version__}")
+
+    loop = asyncio.get_running_loop()
+    agent = get_agent()
+    # cycle bookkeeping is a handful of queries per cycle, it stays synchronous
+    status_db_connection = get_base_db_engine()
+    async_db_connection = get_async_base_db_engine()
+    worker_id = make_worker_id()
+
+    def _blocking(func, *args, **kwargs):
+        return loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+    if resume:
+        await _blocking(status_db_connection.requeue_expired, target)
+
+    list_of_cycles = await _blocking(status_db_connection.get_queued_cycle, target)
+    if not list_of_cycles:
+        _LOGGER.info("No queued cycles found. Quitting..")
+
+    heartbeat = LeaseHeartbeat(status_db_connection, worker_id, lease_seconds)
+    heartbeat.start()
+    try:
+        for this_cycle in list_of_cycles:
+            if not await _blocking(
+                status_db_connection.claim_cycle,
+                this_cycle.id,
+                worker_id,
+                lease_seconds,
+            ):
+                _LOGGER.info(f"Cycle {this_cycle.id} was taken by another uploader")
+                continue
+            this_cycle.status = "processing"
+            status_counts = await _blocking(
+                status_db_connection.get_cycle_status_counts, this_cycle.id
+            )
+
+            await _upload_gse_project_async(
+                agent,
+                async_db_connection,
+                _claimed_projects(
+                    _blocking,
+                    status_db_connection,
+                    target,
+                    this_cycle.id,
+                    worker_id,
+                    lease_seconds,
+                ),
+                target,
+                tag,
+                total_nb=status_counts.get("queued", 0),
+                workers=workers,
+                in_flight=in_flight,
+                geofetch_timeout=geofetch_timeout,
+            )
+
+            await _blocking(_finish_cycle, status_db_connection, this_cycle)
+    finally:
+        heartbeat.stop()
+        await async_db_connection.dispose()
+
+
+async def _claimed_projects(
+    blocking,
+    status_db_connection,
+    target: str,
+    cycle_id: int,
+    worker_id: str,
+    lease_seconds: int,
+) -> AsyncIterator[StatusModel]:
+    """
+    Claim queued projects of the uploader's cycle batch by batch, like
+    BaseEngine.iter_claimed_projects, without blocking the event loop
+
+    :param blocking: runs a blocking call in the executor
+    :param status_db_connection: BaseEngine object connected to db
+    :param target: target(namespace) of the cycle
+    :param cycle_id: id of the claimed cycle
+    :param worker_id: id of the uploader
+    :param lease_seconds: seconds before a claim expires without a heartbeat
+    :return: async iterator of claimed StatusModels
+    """
+    while batch := await blocking(
+        status_db_connection.claim_queued_projects,
+        target,
+        worker_id,
+        lease_seconds=lease_seconds,
+        cycle_id=cycle_id,
+    ):
+        for gse_log in batch:
+            yield gse_log
+
+
+async def _upload_gse_project_async(
+    agent,
+    log_connection: AsyncBaseEngine,
+    gse_logs: AsyncIterable[StatusModel],
+    target: str,
+    tag: str = None,
+    total_nb: int = None,
+    workers: int = 1,
+    in_flight: int = ASYNC_IN_FLIGHT,
+    geofetch_timeout: int = GEOFETCH_TIMEOUT,
+) -> Dict[str, int]:
+    """
+    Get, upload to PEPhub and load log to database of GSE projects, with asyncio.
+    Statuses and the result are the same as in _upload_gse_project
+
+    :param agent: pepdbagent object connected to db
+    :param log_connection: AsyncBaseEngine object connected to db
+    :param gse_logs: StatusModels (seq table model) of the GSEs. Consumed lazily,
+        at most in_flight of them are held at once
+    :param target: namespace where project's should be added
+    :param tag: Tag of the projects
+    :param total_nb: number of GSEs expected in gse_logs (for logging)
+    :param workers: number of concurrent geofetch runs
+    :param in_flight: number of GSEs processed at once
+    :param geofetch_timeout: seconds before geofetch of a single GSE is killed
+    :return: dict with number of processed projects by status
+    """
+    geofetcher_obj = geofetch.Geofetcher(**_geofetcher_kwargs(target))
+    rate_limiter = get_ncbi_rate_limiter()
+    workers = max(1, workers)
+    concurrency = AdaptiveConcurrency(
+        max_limit=workers, is_throttled=is_throttling_error
+    )
+    fetch = functools.partial(
+        retry_call,
+        concurrency.run,
+        run_geofetch,
+        geofetcher_obj=geofetcher_obj,
+        timeout=geofetch_timeout,
+        cache=get_geofetch_cache(),
+        rate_limiter=rate_limiter,
+        ncbi_requests=GEOFETCH_NCBI_REQUESTS.get(target, GEOFETCH_NCBI_REQUESTS["geo"]),
+    )
+    start_time = time.monotonic()
+    start_requests = rate_limiter.acquired
+
+    _LOGGER.info(f"Number of projects that will be processed: {total_nb}")
+    status_dict = {
+        "total": 0,
+        "success": 0,
+        "failure": 0,
+        "warning": 0,
+    }
+
+    slots = asyncio.Semaphore(max(1, in_flight))
+    tasks = set()
+    fetch_executor = ThreadPoolExecutor(
+        max_workers=workers, thread_name_prefix="geofetch"
+    )
+    pephub_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pephub")
+
+    async def _process(process_nb: int, gse_log: StatusModel) -> None:
+        try:
+            gse_status = await _upload_one_gse(
+                agent,
+                log_connection,
+                gse_log,
+                target,
+                fetch,
+                fetch_executor,
+                pephub_executor,
+                process_nb,
+                total_nb,
+            )
+        except Exception as err:
+            # status writes themselves failed; the GSE stays in "processing"
+            _LOGGER.error(f"Failed to process {gse_log.gse}: {err}")
+            gse_status = {"failure": 1}
+        status_dict["total"] += 1
+        for status, count in gse_status.items():
+            status_dict[status] += count
+        observe_gse(target, gse_log.stage_metrics, gse_status)
+        slots.release()
+
+    process_nb = 0
+    try:
+        async for gse_log in gse_logs:
+            await slots.acquire()
+            process_nb += 1
+            task = asyncio.ensure_future(_process(process_nb, gse_log))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    except Exception as err:
+        _LOGGER.error(f"Reading GSEs failed after {process_nb} projects: {err}")
+        raise
+    finally:
+        if tasks:
+            await asyncio.gather(*tasks)
+        fetch_executor.shutdown()
+        pephub_executor.shutdown()
+
+    _LOGGER.info("================== Finished ==================")
+    _LOGGER.info(f"\033[32mAfter run report: {status_dict}\033[0m")
+    elapsed = time.monotonic() - start_time
+    UPLOAD_THROUGHPUT.set(status_dict["total"] / max(elapsed, 1e-9), target=target)
+    _log_rate_limit_report(
+        status_dict["total"],
+        elapsed,
+        rate_limiter.acquired - start_requests,
+        rate_limiter.rate,
+        concurrency,
+    )
+    return status_dict
+
+
+async def _upload_one_gse(
+    agent,
+    log_connection: AsyncBaseEngine,
+    gse_log: StatusModel,
+    target: str,
+    fetch,
+    fetch_executor: ThreadPoolExecutor,
+    pephub_executor: ThreadPoolExecutor,
+    process_nb: int,
+    total_nb: int,
+) -> Dict[str, int]:
+    """
+    Download one GSE with geofetch and upload it to PEPhub (log stages 1-3),
+    like _fetch_gse and _create_gse_projects do in the sync uploader
+
+    :param agent: pepdbagent object connected to db
+    :param log_connection: AsyncBaseEngine object connected to db
+    :param gse_log: StatusModel of the GSE
+    :param target: namespace where project's should be added
+    :param fetch: blocking function, that returns geofetch projects of a GSE
+    :param fetch_executor: thread pool of geofetch runs
+    :param pephub_executor: thread pool of PEPhub writes
+    :param process_nb: position of the GSE in the cycle (for logging)
+    :param total_nb: number of GSEs in the cycle (for logging)
+    :return: dict with number of projects by status
+    """
+    loop = asyncio.get_running_loop()
+    gse = gse_log.gse
+
+    gse_log.status = "processing"
+    gse_log.log_stage = 1
+    gse_log.stage_metrics = {}
+    await _write_status(log_connection, gse_log)
+
+    _LOGGER.info(f"\033[0;33mProcessing GSE: {gse}. {process_nb}/{total_nb}\033[0m")
+
+    try:
+        gse_log.status_info = "geofetcher"
+        gse_log.log_stage = 2
+        project_dict = await loop.run_in_executor(
+            fetch_executor,
+            functools.partial(fetch, gse, stage_metrics=gse_log.stage_metrics),
+        )
+        _LOGGER.info("Project has been downloaded using geofetch")
+        gse_log.stage_metrics["samples"] = _count_samples(project_dict)
+    except FunctionTimeoutError as err:
+        gse_log.status = "failure"
+        gse_log.status_info = "timeout"
+        gse_log.info = str(err)
+        await _write_status(log_connection, gse_log)
+        return {"failure": 1}
+    except Exception as err:
+        gse_log.status = "failure"
+        gse_log.status_info = _failure_info(err, "geofetcher")
+        gse_log.info = str(err)
+        await _write_status(log_connection, gse_log)
+        return {"failure": 1}
+
+    if len(list(project_dict.keys())) == 0:
+        gse_log.status = "warning"
+        gse_log.info = "No data was fetched from GEO, check if project has any data"
+        gse_log.status_info = "geofetcher"
+        await _write_status(log_connection, gse_log)
+        return {"warning": 1}
+
+    collector = _StatusCollector()
+    try:
+        gse_status = await loop.run_in_executor(
+            pephub_executor,
+            _create_gse_projects,
+            agent,
+            collector,
+            gse_log,
+            project_dict,
+            target,
+        )
+    except Exception as err:
+        _LOGGER.error(f"Failed to upload {gse}: {err}")
+        gse_status = {"failure": 1}
+    for model in collector.models:
+        await _write_status(log_connection, model)
+    return gse_status
+
+
+async def _write_status(
+    log_connection: AsyncBaseEngine, gse_log: StatusModel
+) -> StatusModel:
+    """
+    Write status of the GSE, and add the time it took to its stage metrics
+
+    :param log_connection: AsyncBaseEngine object connected to db
+    :param gse_log: StatusModel of the GSE
+    :return: StatusModel
+    """
+    with timed(gse_log.stage_metrics, "status"):
+        return await log_connection.upload_project_log(gse_log)
@@ -0,0 +1,260 @@
+# Offline benchmark of the queuer, the uploader and the archive builder.
+#
+# NCBI, PEPhub, the status database and S3 are replaced with local stand-ins,
+# the rest of the pipeline runs as in production:
+#
+#   GEO        SyntheticFinder and SyntheticGeofetcher return generated GSEs and
+#              projects, with a configurable number of samples and latency.
+#              geofetch still runs in its killable subprocess.
+#   databases  SQLite files in the work directory (or a throwaway database
+#              given by a DSN), for both BaseEngine and pepdbagent
+#   S3         LocalS3 keeps objects in the work directory
+#
+# `geopephub bench` reports GSEs/s of the queuer and the uploader, and MB/s of
+# build_archive, so that performance work can be measured without a cluster.
+
+import contextlib
+import datetime
+import logging
+import os
+import tarfile
+import tempfile
+import time
+from functools import partial
+from typing import Dict, List
+from unittest import mock
+
+import geofetch
+from pepdbagent import PEPDatabaseAgent
+from pepdbagent.db_utils import Base
+
+from geopephub import archive, metageo_pephub, s3
+from geopephub.db_utils import BaseEngine
+from geopephub.metrics import DB_ROUND_TRIPS, count_db_round_trips
+from geopephub.synthetic import SyntheticFinder, SyntheticGeofetcher
+from geopephub.throttle import TokenBucket
+
+_LOGGER = logging.getLogger(__name__)
+
+BENCH_TARGET = "geo"
+BENCH_TAG = "default"
+BENCH_BUCKET = "bench"
+# round trips of the bench engines are counted under their own labels
+BENCH_DATABASES = ("bench_status", "bench_pephub")
+
+
+class LocalS3:
+    """
+    Stand-in for the boto3 S3 client, keeps objects in a local directory
+
+    Transfer settings are ignored, the progress callback is called for every
+    chunk, as boto3 does.
+    """
+
+    def __init__(self, root: str):
+        """
+        :param root: directory of the buckets
+        """
+        self.root = root
+
+    def _path(self, bucket: str, key: str) -> str:
+        return os.path.join(self.root, bucket, key)
+
+    @staticmethod
+    def _copy(source_path: str, destination_path: str, callback=None) -> None:
+        with open(source_path, "rb") as source, open(
+            destination_path, "wb"
+        ) as destination:
+            while chunk := source.read(1024 * 1024):
+                destination.write(chunk)
+                if callback:
+                    callback(len(chunk))
+
+    def upload_file(
+        self, Filename: str, Bucket: str, Key: str, Callback=None, **kwargs
+    ) -> None:
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._copy(Filename, path, Callback)
+
+    def download_file(
+        self, Bucket: str, Key: str, Filename: str, Callback=None, **kwargs
+    ) -> None:
+        self._copy(self._path(Bucket, Key), Filename, Callback)
+
+
+@contextlib.contextmanager
+def fake_backends(
+    workdir: str,
+    gses: List[str],
+    samples: int = 20,
+    latency: float = 0.0,
+    ncbi_rate: float = 0,
+    dsn: str = None,
+):
+    """
+    Replace GEO, the databases and S3 with local stand-ins
+
+    :param workdir: directory of the SQLite files and S3 objects
+    :param gses: GSEs found by the Finder
+    :param samples: number of samples in every project
+    :param latency: seconds every geofetch run takes
+    :param ncbi_rate: NCBI requests per second. 0 disables the rate limit
+    :param dsn: database for both the status tables and pepdbagent, instead of
+        SQLite files. All data in it is overwritten, use a throwaway database
+    :return: (status engine, pepdbagent agent)
+    """
+    status_dsn = dsn or f"sqlite:///{os.path.join(workdir, 'status.db')}"
+    pephub_dsn = dsn or f"sqlite:///{os.path.join(workdir, 'pephub.db')}"
+
+    status_db = BaseEngine(dsn=status_dsn)
+    status_db.create_schema()
+    count_db_round_trips(status_db._engine, BENCH_DATABASES[0])
+    agent = PEPDatabaseAgent(dsn=pephub_dsn)
+    Base.metadata.create_all(agent.pep_db_engine.engine)
+    count_db_round_trips(agent.pep_db_engine.engine, BENCH_DATABASES[1])
+
+    rate_limiter = TokenBucket(rate=ncbi_rate or 1e9)
+    local_s3 = LocalS3(os.path.join(workdir, "s3"))
+
+    with contextlib.ExitStack() as stack:
+        for target, value in [
+            (metageo_pephub, dict(get_agent=lambda: agent)),
+            (metageo_pephub, dict(get_base_db_engine=lambda: status_db)),
+            (metageo_pephub, dict(get_geofetch_cache=lambda: None)),
+            (metageo_pephub, dict(get_ncbi_rate_limiter=lambda: rate_limiter)),
+            (archive, dict(get_agent=lambda: agent)),
+            (
+                geofetch,
+                dict(
+                    Geofetcher=partial(
+                        SyntheticGeofetcher, samples=samples, latency=latency
+                    ),
+                    Finder=partial(SyntheticFinder, gses),
+                ),
+            ),
+            (s3, dict(get_s3_client=lambda: local_s3)),
+        ]:
+            stack.enter_context(mock.patch.multiple(target, **value))
+        try:
+            yield status_db, agent
+        finally:
+            status_db._engine.dispose()
+            agent.pep_db_engine.engine.dispose()
+
+
+def _round_trips() -> Dict[str, float]:
+    return {
+        database: DB_ROUND_TRIPS._values.get((database,), 0)
+        for database in BENCH_DATABASES
+    }
+
+
+def _per_gse(before: Dict[str, float], nb_gses: int) -> Dict[str, float]:
+    after = _round_trips()
+    return {
+        f"{database[len('bench_'):]}_round_trips_per_gse": round(
+            (after[database] - before[database]) / max(nb_gses, 1), 2
+        )
+        for database in BENCH_DATABASES
+    }
+
+
+def _count_archived_projects(tar_path: str) -> int:
+    with tarfile.open(tar_path, "r|") as tar:
+        return sum(member.name.endswith(".zip") for member in tar)
+
+
+def run_bench(
+    gses: int = 200,
+    samples: int = 20,
+    latency: float = 0.05,
+    workers: int = 4,
+    ncbi_rate: float = 0,
+    dsn: str = None,
+    workdir: str = None,
+    archive_runs: bool = True,
+) -> Dict[str, dict]:
+    """
+    Queue, upload and archive synthetic GSEs, and measure each step
+
+    :param gses: number of GSEs
+    :param samples: number of samples in every project
+    :param latency: seconds every geofetch run takes
+    :param workers: number of GSEs downloaded concurrently
+    :param ncbi_rate: NCBI requests per second. 0 disables the rate limit
+    :param dsn: database for the status tables and pepdbagent [Default: SQLite
+        files in workdir]. All data in it is overwritten, use a throwaway database
+    :param workdir: directory of the databases, S3 objects and archives
+        [Default: temporary directory, removed at the end]
+    :param archive_runs: also benchmark build_archive, from scratch and on top
+        of the previous archive
+    :return: dict {step: {measurement: value}}
+    """
+    if not workdir:
+        with tempfile.TemporaryDirectory(prefix="geopephub_bench_") as tmp_dir:
+            return run_bench(
+                gses, samples, latency, workers, ncbi_rate, dsn, tmp_dir, archive_runs
+            )
+    os.makedirs(workdir, exist_ok=True)
+
+    gse_list = [f"GSE{900000 + i}" for i in range(gses)]
+    end_date = datetime.date.today()
+    start_period = (end_date - datetime.timedelta(days=1)).strftime("%Y/%m/%d")
+    end_period = end_date.strftime("%Y/%m/%d")
+    results = {}
+
+    with fake_backends(workdir, gse_list, samples, latency, ncbi_rate, dsn) as (
+        status_db,
+        agent,
+    ):
+        before = _round_trips()
+        start = time.perf_counter()
+        (cycle,) = metageo_pephub.add_to_queue_by_period(
+            BENCH_TARGET, BENCH_TAG, start_period, end_period, chunk_days=0
+        )
+        elapsed = time.perf_counter() - start
+        queued = status_db.get_cycle_status_counts(cycle.id).get("queued", 0)
+        results["queuer"] = {
+            "gses": queued,
+            "seconds": round(elapsed, 3),
+            "gse_per_second": round(queued / elapsed, 1),
+            **_per_gse(before, queued),
+        }
+
+        before = _round_trips()
+        start = time.perf_counter()
+        metageo_pephub.upload_queued_projects(
+            BENCH_TARGET, BENCH_TAG, workers=workers
+        )
+        elapsed = time.perf_counter() - start
+        status_counts = status_db.get_cycle_status_counts(cycle.id)
+        results["uploader"] = {
+            "gses": queued,
+            "seconds": round(elapsed, 3),
+            "gse_per_second": round(queued / elapsed, 2),
+            "statuses": status_counts,
+            **_per_gse(before, queued),
+        }
+
+        if archive_runs:
+            for run in ("archive_cold", "archive_incremental"):
+                start = time.perf_counter()
+                tar_path = archive.build_archive(
+                    namespace=BENCH_TARGET,
+                    workdir=os.path.join(workdir, run),
+                    workers=workers,
+                    bucket=BENCH_BUCKET,
+                )
+                elapsed = time.perf_counter() - start
+                size_mb = os.path.getsize(tar_path) / 1024**2
+                results[run] = {
+                    "projects": _count_archived_projects(tar_path),
+                    "seconds": round(elapsed, 3),
+                    "megabytes": round(size_mb, 3),
+                    "mb_per_second": round(size_mb / elapsed, 3),
+                }
+
+    for step, measurements in results.items():
+        _LOGGER.info(f"{step}: {measurements}")
+    return results
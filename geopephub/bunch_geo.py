@@ -15,9 +15,9 @@ from ubiquerg import parse_registry_path
 import os
 from typing import List, Union
 import tempfile
-import boto3
 from botocore.exceptions import ClientError
 
+from geopephub.s3 import upload_file
 from geopephub.utils import (
     get_agent,
     calculate_time,
@@ -194,10 +194,8 @@ def upload_to_s3_file(file_name: str, bucket: str = "pephub", object_name: str =
     if object_name is None:
         object_name = os.path.basename(file_name)
 
-    s3_client = boto3.client("s3")
-
     try:
-        s3_client.upload_file(file_name, bucket, object_name)
+        upload_file(file_name, bucket, object_name)
         MessageHandler.print_success(
             f"Project was uploaded successfully to s3://{bucket}/{object_name}"
         )
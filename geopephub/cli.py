@@ -1,3 +1,7 @@
+import asyncio
+import time
+from functools import partial
+
 import logmuse
 import typer
 
@@ -10,6 +14,18 @@ from geopephub.metageo_pephub import (
 )
 from geopephub.bunch_geo import bunch_geo, auto_run
 from geopephub.archive import build_archive
+from geopephub.worker import run_worker as run_worker_function
+from geopephub.async_uploader import upload_queued_projects_async
+from geopephub.metrics import start_http_server, write_job_metrics
+from geopephub.utils import get_base_db_engine
+from geopephub.const import (
+    ASYNC_IN_FLIGHT,
+    GEOFETCH_TIMEOUT,
+    UPLOAD_QUEUE_SIZE,
+    WORKER_BATCH_SIZE,
+    WORKER_LEASE_SECONDS,
+    QUEUE_WINDOW_DAYS,
+)
 from geopephub.__version__ import __version__
 
 app = typer.Typer()
@@ -39,11 +55,15 @@ def run_queuer(
         1,
         help="Period (number of day) (time frame) when fetch metadata from GEO [used for q_fetch function]",
     ),
+    chunk_days: int = typer.Option(
+        QUEUE_WINDOW_DAYS,
+        help="Split longer periods into windows of this many days, each queued as its own cycle. 0 disables splitting",
+    ),
 ):
     """
     Queue GEO projects that were uploaded or updated in the last period
     """
-    add_to_queue(target=target, tag=tag, period=period)
+    add_to_queue(target=target, tag=tag, period=period, chunk_days=chunk_days)
 
 
 @app.command()
@@ -57,13 +77,112 @@ def run_uploader(
         "default",
         help="Tag of the project, that will be uploaded to the pephub",
     ),
+    workers: int = typer.Option(
+        1,
+        help="Number of GSEs downloaded concurrently. Keep it under the database connection pool size",
+    ),
+    geofetch_timeout: int = typer.Option(
+        GEOFETCH_TIMEOUT,
+        help="Seconds before geofetch of a single GSE is killed and marked as 'timeout'",
+    ),
+    queue_size: int = typer.Option(
+        UPLOAD_QUEUE_SIZE,
+        help="Number of downloaded GSEs that may wait for the PEPhub upload. Caps memory use",
+    ),
+    resume: bool = typer.Option(
+        False,
+        help="First requeue cycles and GSEs of uploaders that were killed or crashed (expired leases)",
+    ),
+    lease_seconds: int = typer.Option(
+        WORKER_LEASE_SECONDS,
+        help="Seconds before a claimed cycle is considered abandoned, if the uploader stops sending heartbeats",
+    ),
+    use_async: bool = typer.Option(
+        False,
+        "--async",
+        help="Use the asyncio uploader. --workers sets the number of concurrent geofetch runs",
+    ),
+    in_flight: int = typer.Option(
+        ASYNC_IN_FLIGHT,
+        help="With --async: number of GSEs processed at once",
+    ),
 ):
     """
     Upload projects that were queued, but not uploaded yet.
     """
+    if use_async:
+        asyncio.run(
+            upload_queued_projects_async(
+                target=target,
+                tag=tag,
+                workers=workers,
+                in_flight=in_flight,
+                geofetch_timeout=geofetch_timeout,
+                resume=resume,
+                lease_seconds=lease_seconds,
+            )
+        )
+        return
     upload_queued_projects(
         target=target,
         tag=tag,
+        workers=workers,
+        geofetch_timeout=geofetch_timeout,
+        queue_size=queue_size,
+        resume=resume,
+        lease_seconds=lease_seconds,
+    )
+
+
+@app.command()
+def run_worker(
+    target: str = typer.Option(
+        ...,
+        help="Target of the pipeline. Namespace, and purpose of pipeline. Options: ['geo','bedbase']",
+        callback=validate_target,
+    ),
+    tag: str = typer.Option(
+        "default",
+        help="Tag of the project, that will be uploaded to the pephub",
+    ),
+    batch_size: int = typer.Option(
+        WORKER_BATCH_SIZE,
+        help="Number of queued GSEs claimed at once",
+    ),
+    workers: int = typer.Option(
+        1,
+        help="Number of GSEs downloaded concurrently. Keep it under the database connection pool size",
+    ),
+    geofetch_timeout: int = typer.Option(
+        GEOFETCH_TIMEOUT,
+        help="Seconds before geofetch of a single GSE is killed and marked as 'timeout'",
+    ),
+    queue_size: int = typer.Option(
+        UPLOAD_QUEUE_SIZE,
+        help="Number of downloaded GSEs that may wait for the PEPhub upload. Caps memory use",
+    ),
+    lease_seconds: int = typer.Option(
+        WORKER_LEASE_SECONDS,
+        help="Seconds before claimed GSEs are released, if the worker stops sending heartbeats",
+    ),
+    metrics_port: int = typer.Option(
+        None,
+        help="Serve Prometheus metrics over HTTP on this port",
+    ),
+):
+    """
+    Upload queued projects together with other workers. Run it on as many hosts as needed.
+    """
+    if metrics_port is not None:
+        start_http_server(metrics_port)
+    run_worker_function(
+        target=target,
+        tag=tag,
+        batch_size=batch_size,
+        workers=workers,
+        geofetch_timeout=geofetch_timeout,
+        queue_size=queue_size,
+        lease_seconds=lease_seconds,
     )
 
 
@@ -91,6 +210,22 @@ def run_checker(
         1,
         help="length of the period - number of days (time frame) when fetch metadata from GEO [used for q_fetch function]",
     ),
+    workers: int = typer.Option(
+        1,
+        help="Number of GSEs downloaded concurrently. Keep it under the database connection pool size",
+    ),
+    geofetch_timeout: int = typer.Option(
+        GEOFETCH_TIMEOUT,
+        help="Seconds before geofetch of a single GSE is killed and marked as 'timeout'",
+    ),
+    queue_size: int = typer.Option(
+        UPLOAD_QUEUE_SIZE,
+        help="Number of downloaded GSEs that may wait for the PEPhub upload. Caps memory use",
+    ),
+    chunk_days: int = typer.Option(
+        QUEUE_WINDOW_DAYS,
+        help="Split longer periods into windows of this many days, each queued as its own cycle. 0 disables splitting",
+    ),
 ):
     """
     Check if all projects were uploaded successfully in specified period and upload them if not.
@@ -103,6 +238,10 @@ def run_checker(
         period_length=period,
         tag=tag,
         number_of_cycles=cycle_count,
+        workers=workers,
+        geofetch_timeout=geofetch_timeout,
+        queue_size=queue_size,
+        chunk_days=chunk_days,
     )
 
 
@@ -125,6 +264,22 @@ def check_by_date(
         None,
         help="end period (Later in the calender) ['2021/05/27']",
     ),
+    workers: int = typer.Option(
+        1,
+        help="Number of GSEs downloaded concurrently. Keep it under the database connection pool size",
+    ),
+    geofetch_timeout: int = typer.Option(
+        GEOFETCH_TIMEOUT,
+        help="Seconds before geofetch of a single GSE is killed and marked as 'timeout'",
+    ),
+    queue_size: int = typer.Option(
+        UPLOAD_QUEUE_SIZE,
+        help="Number of downloaded GSEs that may wait for the PEPhub upload. Caps memory use",
+    ),
+    chunk_days: int = typer.Option(
+        QUEUE_WINDOW_DAYS,
+        help="Split longer periods into windows of this many days, each checked as its own cycle. 0 disables splitting",
+    ),
 ):
     """
     Check if all projects were uploaded successfully in specified period and upload them if not.
@@ -136,6 +291,10 @@ def check_by_date(
         tag=tag,
         start_period=start_period,
         end_period=end_period,
+        workers=workers,
+        geofetch_timeout=geofetch_timeout,
+        queue_size=queue_size,
+        chunk_days=chunk_days,
     )
 
 
@@ -261,8 +420,9 @@ def auto_download(
 
 @app.command(
     help="Produce a dated full-namespace archive without persistent state: download the "
-    "last published archive, apply the update delta, re-tar, and publish. Intended for "
-    "unattended CI runs. Use auto-download instead when the destination survives between runs."
+    "last published archive, diff its manifest with the live namespace, merge in the "
+    "changes, and publish. Intended for unattended CI runs. "
+    "Use auto-download instead when the destination survives between runs."
 )
 def archive_update(
     namespace: str = typer.Option(
@@ -275,8 +435,9 @@ def archive_update(
     ),
     start_period: str = typer.Option(
         None,
-        help="Override the delta start ['2024/09/06']. Defaults to the previous "
-        "archive's creation date. Widen it to re-pull projects earlier runs skipped",
+        help="Also re-pull projects updated since this date ['2024/09/06'], even if "
+        "their digest did not change. Defaults to the previous archive's creation date "
+        "for archives without a manifest",
     ),
     workers: int = typer.Option(
         4,
@@ -306,6 +467,15 @@ def archive_update(
     )
 
 
+@app.command()
+def init_db():
+    """
+    Create the status tables and their indexes. Run once per deployment and after upgrades
+    """
+    get_base_db_engine().create_schema()
+    typer.echo("Status tables and indexes are up to date")
+
+
 @app.command()
 def clean_history(
     days: int = typer.Option(
@@ -319,6 +489,54 @@ def clean_history(
     clean_history_function(days=days)
 
 
+@app.command()
+def bench(
+    gses: int = typer.Option(200, help="Number of synthetic GSEs"),
+    samples: int = typer.Option(20, help="Number of samples in every project"),
+    latency: float = typer.Option(
+        0.05, help="Seconds every synthetic geofetch run takes"
+    ),
+    workers: int = typer.Option(4, help="Number of GSEs downloaded concurrently"),
+    ncbi_rate: float = typer.Option(
+        0, help="NCBI requests per second. 0 disables the rate limit"
+    ),
+    dsn: str = typer.Option(
+        None,
+        help="Throwaway database for the status tables and PEPhub, e.g. a local Postgres. Default: SQLite files in the workdir",
+    ),
+    workdir: str = typer.Option(
+        None, help="Directory of the databases, S3 objects and archives. Default: temporary"
+    ),
+    archive: bool = typer.Option(True, help="Benchmark build_archive too"),
+    json_output: bool = typer.Option(False, "--json", help="Print results as JSON"),
+):
+    """
+    Benchmark the queuer, uploader and archive builder offline, against synthetic GEO, SQLite and local S3
+    """
+    import json
+
+    from geopephub.bench import run_bench
+
+    results = run_bench(
+        gses=gses,
+        samples=samples,
+        latency=latency,
+        workers=workers,
+        ncbi_rate=ncbi_rate,
+        dsn=dsn,
+        workdir=workdir,
+        archive_runs=archive,
+    )
+    if json_output:
+        typer.echo(json.dumps(results, indent=2))
+        return
+    for step, measurements in results.items():
+        typer.echo(
+            f"{step}: "
+            + ", ".join(f"{name}={value}" for name, value in measurements.items())
+        )
+
+
 def version_callback(value: bool):
     if value:
         typer.echo(f"geopephub version: {__version__}")
@@ -346,7 +564,17 @@ def common(
     ),
     logdev: bool = typer.Option(False, "--logdev", help="Use developer logging format"),
     silent: bool = typer.Option(False, "--silent", help="Silence logging"),
+    metrics_file: str = typer.Option(
+        None,
+        "--metrics-file",
+        envvar="GEOPEPHUB_METRICS_FILE",
+        help="Write Prometheus metrics to this file when the command exits",
+    ),
 ):
     # This callback runs before any command, so it is where logging gets
     # configured. Don't move this into `__init__.py`.
     logmuse.init_logger("geopephub", verbosity=verbosity, devmode=logdev, silent=silent)
+    if metrics_file:
+        ctx.call_on_close(
+            partial(write_job_metrics, metrics_file, ctx.invoked_subcommand, time.time())
+        )
@@ -9,8 +9,58 @@ STATUS_OPTIONS = [
     "failure",
     "warning",
     "initial",
+    # already uploaded after its last GEO update, not processed again
+    "skipped",
 ]
 
+# seconds before a geofetch run of a single GSE is killed
+GEOFETCH_TIMEOUT = 240
+
+# number of downloaded GSEs that may wait for the PEPhub upload
+UPLOAD_QUEUE_SIZE = 4
+
+# run-uploader --async: number of GSEs in flight at once
+ASYNC_IN_FLIGHT = 200
+
+# NCBI E-utilities requests per second (without and with NCBI_API_KEY)
+NCBI_RATE_LIMIT = 3
+NCBI_RATE_LIMIT_API_KEY = 10
+# Estimated number of NCBI requests made by a single geofetch run, per target.
+# geofetch runs in a subprocess, so its requests are not counted one by one;
+# the rate limiter charges this many tokens per run instead. Processed-data
+# targets list supplementary files of every sample, so they make more requests.
+GEOFETCH_NCBI_REQUESTS = {
+    "geo": 2,
+    "bedbase": 6,
+    "accbase": 6,
+}
+
+# in-process retries of transient failures (jittered exponential backoff)
+RETRY_ATTEMPTS = 3
+RETRY_BASE_DELAY = 2
+RETRY_MAX_DELAY = 30
+
+# projects with more samples fail as permanent ("project too large")
+MAX_PROJECT_SAMPLES = 1_000_000
+
+# failure classes, stored in status_info of failed GSEs
+ERROR_TRANSIENT = "transient"
+ERROR_PERMANENT = "permanent"
+ERROR_UNKNOWN = "unknown"
+
+# local cache of geofetch results
+DEFAULT_CACHE_DIR = "~/.cache/geopephub/geofetch"
+DEFAULT_CACHE_MAX_SIZE = "2GB"
+
+# S3 transfers: multipart part size, parts in flight and attempts of every request
+DEFAULT_S3_PART_SIZE = "64MB"
+DEFAULT_S3_CONCURRENCY = 16
+DEFAULT_S3_MAX_ATTEMPTS = 5
+# S3 rejects smaller parts (except the last one)
+S3_MIN_PART_SIZE = 5 * 1024**2
+# seconds between progress messages of a running transfer
+S3_PROGRESS_INTERVAL = 10
+
 # number of last days used in Finder
 LAST_UPDATE_DATES = 1
 
@@ -20,6 +70,26 @@ DEFAULT_POSTGRES_HOST = "localhost"
 DEFAULT_POSTGRES_DB = "pep-db"
 DEFAULT_POSTGRES_PORT = 5432
 
+# connection pool of the status tables engine (SQLAlchemy defaults)
+DEFAULT_POOL_SIZE = 5
+DEFAULT_POOL_MAX_OVERFLOW = 10
+
+# number of status rows fetched at once when streaming a cycle
+STREAM_BATCH_SIZE = 500
+
+# run-worker: number of queued GSEs claimed at once, and seconds a claim stays
+# valid without a heartbeat
+WORKER_BATCH_SIZE = 20
+WORKER_LEASE_SECONDS = 300
+
+# A GSE found by Finder in a window is skipped if it was uploaded this many hours
+# after the start of the window's end date (UTC). GEO dates are US Eastern, so
+# 30 hours cover the whole end date in any US timezone.
+SKIP_UPLOADED_AFTER_HOURS = 30
+
+# maximum number of values in one IN (...) list
+QUERY_IN_BATCH_SIZE = 5000
+
 # db_dialects
 POSTGRES_DIALECT = "postgresql+psycopg"
 
@@ -28,3 +98,17 @@ BEDBASE_MAX_SIZE = "500MB"
 # Accbase specific constants
 ACCBASE_FINDER_FILTER = "((ATAC-seq) OR (scATAC-seq) OR (DNase-seq))"
 ACCBASE_MAX_SIZE = "1GB"
+
+# GEO search filters of the targets
+FINDER_FILTERS = {
+    "geo": None,
+    # get projects only with this filter
+    "bedbase": "((bed) OR narrowPeak) OR broadPeak",
+    # get chromatin accessibility projects (ATAC-seq, scATAC-seq, DNase-seq)
+    "accbase": ACCBASE_FINDER_FILTER,
+}
+
+# long queuer/checker periods are split into windows of this many days, each
+# queued as its own cycle; Finder queries of the windows run concurrently
+QUEUE_WINDOW_DAYS = 7
+FINDER_WORKERS = 3
@@ -0,0 +1,76 @@
+# Leases of the status rows.
+#
+# Whoever processes a cycle or a GSE (run-uploader, run-worker) writes its
+# worker id and a lease expiration time to the row, and a heartbeat thread keeps
+# extending the lease. If the process dies, the lease expires and
+# `run-uploader --resume` (or any run-worker) puts the work back in the queue.
+
+import logging
+import os
+import socket
+import threading
+import uuid
+
+from geopephub.const import WORKER_LEASE_SECONDS
+from geopephub.db_utils import BaseEngine
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def make_worker_id() -> str:
+    """
+    Get id of this worker, unique across hosts and processes
+
+    :return: worker id [e.g. "host-1:4242:1a2b3c4d"]
+    """
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class LeaseHeartbeat:
+    """
+    Background thread, that keeps leases of the claimed cycles and projects alive.
+    """
+
+    def __init__(
+        self,
+        log_connection: BaseEngine,
+        worker_id: str,
+        lease_seconds: int = WORKER_LEASE_SECONDS,
+    ):
+        """
+        :param log_connection: BaseEngine object connected to db
+        :param worker_id: id of the worker, that owns the leases
+        :param lease_seconds: lease length. Leases are extended every third of it
+        """
+        self.log_connection = log_connection
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name=f"heartbeat-{worker_id}", daemon=True
+        )
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._thread.join()
+
+    def beat(self) -> int:
+        """
+        Extend leases once
+
+        :return: number of extended leases
+        """
+        return self.log_connection.extend_project_leases(
+            self.worker_id, self.lease_seconds
+        ) + self.log_connection.extend_cycle_leases(self.worker_id, self.lease_seconds)
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.lease_seconds / 3):
+            try:
+                self.beat()
+            except Exception as err:
+                # the next beat may succeed before the leases expire
+                _LOGGER.warning(f"Heartbeat of {self.worker_id} failed: {err}")
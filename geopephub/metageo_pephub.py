@@ -1,6 +1,11 @@
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import geofetch
 import pepdbagent
-from typing import NoReturn, Dict
+from typing import NoReturn, Dict, Iterable, List, Optional, Sized, Tuple
 import datetime
 import logging
 
@@ -11,28 +16,67 @@ from datetime import timedelta
 
 import peppy
 
-from geopephub.const import LAST_UPDATE_DATES, BEDBASE_MAX_SIZE, ACCBASE_FINDER_FILTER, ACCBASE_MAX_SIZE
+from geopephub.const import (
+    LAST_UPDATE_DATES,
+    BEDBASE_MAX_SIZE,
+    ACCBASE_MAX_SIZE,
+    GEOFETCH_TIMEOUT,
+    UPLOAD_QUEUE_SIZE,
+    GEOFETCH_NCBI_REQUESTS,
+    ERROR_UNKNOWN,
+    WORKER_LEASE_SECONDS,
+    FINDER_FILTERS,
+    FINDER_WORKERS,
+    QUEUE_WINDOW_DAYS,
+    SKIP_UPLOADED_AFTER_HOURS,
+    MAX_PROJECT_SAMPLES,
+)
 from geopephub.utils import get_agent, get_base_db_engine
 from geopephub.models import StatusModel, CycleModel
-from geopephub.utils import run_geofetch, add_link_to_description
+from geopephub.utils import (
+    run_geofetch,
+    add_link_to_description,
+    get_geofetch_cache,
+    is_throttling_error,
+    split_period,
+    FunctionTimeoutError,
+    GeofetchCache,
+)
+from geopephub.throttle import AdaptiveConcurrency, TokenBucket, get_ncbi_rate_limiter
+from geopephub.retry import ProjectTooLargeError, classify_error, retry_call
+from geopephub.lease import LeaseHeartbeat, make_worker_id
+from geopephub.pephub import get_stored_projects, is_project_unchanged, write_projects
+from geopephub.timing import summarize_stage_metrics, timed
+from geopephub.metrics import GSE_QUEUED, UPLOAD_THROUGHPUT, observe_gse
 
 
 _LOGGER = logging.getLogger(__name__)
 
+# put on the fetch queue by every download worker when it runs out of GSEs
+_FETCH_DONE = object()
+
 
 def add_to_queue_by_period(
     target: str,
     tag: str,
     start_period: str,
     end_period: str,
-) -> None:
+    chunk_days: int = QUEUE_WINDOW_DAYS,
+    finder_workers: int = FINDER_WORKERS,
+) -> List[CycleModel]:
     """
+    Queue GSEs updated in the period. Periods longer than chunk_days are split
+    into windows, each queued as its own cycle, so that it can be checked and
+    retried independently. Finder queries of the windows run concurrently
+    (within the NCBI rate limit), and a GSE found in several windows is queued once.
 
     :param target: Namespace of the projects (bedbase, geo)
     :param tag: Tag of the projects
     :param start_period: start date of cycle [e.g. 2023/02/07]
     :param end_period: end date of cycle [e.g. 2023/02/08]
-    :return: NoReturn
+    :param chunk_days: maximum length of a window in days. 0 disables splitting
+    :param finder_workers: number of concurrent Finder queries
+    :return: list of cycles, one per window
     """
     status_db_connection = get_base_db_engine()
 
@@ -43,76 +87,143 @@ def add_to_queue_by_period(
     _LOGGER.info(f"pepdbagent version: {pepdbagent.__version__}")
     _LOGGER.info(f"peppy version: {peppy.__version__}")
 
-    today_date_str = end_period
-    start_date_str = start_period
+    windows = split_period(start_period, end_period, chunk_days)
+    cycles = []
+    for window_start, window_end in windows:
+        this_cycle = CycleModel(
+            target=target,
+            status="initial",
+            start_period=window_start,
+            end_period=window_end,
+        )
+        cycles.append(status_db_connection.update_upload_cycle(this_cycle))
 
-    this_cycle = CycleModel(
-        target=target,
-        status="initial",
-        start_period=start_date_str,
-        end_period=today_date_str,
+    if target not in FINDER_FILTERS:
+        for this_cycle in cycles:
+            this_cycle.status = "failure"
+            status_db_connection.update_upload_cycle(this_cycle)
+        raise Exception(f"Error in target: {target}")
+
+    _LOGGER.info(f"Searching GEO in {len(windows)} windows of {chunk_days} days")
+    with ThreadPoolExecutor(
+        max_workers=max(1, min(finder_workers, len(windows)))
+    ) as executor:
+        futures = [
+            executor.submit(_find_gse_by_date, target, window_start, window_end)
+            for window_start, window_end in windows
+        ]
+
+    queued_gse = set()
+    number_of_projects = 0
+    for this_cycle, future in zip(cycles, futures):
+        try:
+            gse_list = future.result()
+        except Exception as err:
+            _LOGGER.error(
+                f"Finder failed for {this_cycle.start_period}:{this_cycle.end_period}: {err}"
+            )
+            this_cycle.status = "failure"
+            status_db_connection.update_upload_cycle(this_cycle)
+            continue
+        # windows share boundary dates, keep a GSE in the first window only
+        gse_list = [gse for gse in dict.fromkeys(gse_list) if gse not in queued_gse]
+        queued_gse.update(gse_list)
+        _queue_cycle(status_db_connection, this_cycle, gse_list, target, tag)
+        number_of_projects += len(gse_list)
+
+    _LOGGER.info("================== Finished ==================")
+    _LOGGER.info(
+        f"\033[32mAfter run report: Added {number_of_projects} projects\033[0m"
     )
-    status_db_connection.update_upload_cycle(this_cycle)
+    return cycles
+
+
+def _find_gse_by_date(target: str, start_period: str, end_period: str) -> List[str]:
+    """
+    Search GEO for GSEs of the target updated in the period
+
+    :param target: Namespace of the projects (bedbase, geo)
+    :param start_period: start date [e.g. 2023/02/07]
+    :param end_period: end date [e.g. 2023/02/08]
+    :return: list of GSEs
+    """
+    finder = geofetch.Finder(filters=FINDER_FILTERS[target])
+    get_ncbi_rate_limiter().acquire()
+    return finder.get_gse_by_date(start_period, end_period)
 
-    if target == "bedbase":
-        # get projects only with this filter
-        gse_list = geofetch.Finder(
-            filters="((bed) OR narrowPeak) OR broadPeak"
-        ).get_gse_by_date(start_date_str, today_date_str)
-    elif target == "accbase":
-        # get chromatin accessibility projects (ATAC-seq, scATAC-seq, DNase-seq)
-        gse_list = geofetch.Finder(
-            filters=ACCBASE_FINDER_FILTER
-        ).get_gse_by_date(start_date_str, today_date_str)
-    elif target == "geo":
-        gse_list = geofetch.Finder().get_gse_by_date(start_date_str, today_date_str)
-    else:
-        this_cycle.status = "failure"
-        status_db_connection.update_upload_cycle(this_cycle)
-        raise Exception(f"Error in target: {target}")
 
+def _queue_cycle(
+    status_db_connection,
+    this_cycle: CycleModel,
+    gse_list: List[str],
+    target: str,
+    tag: str,
+) -> CycleModel:
+    """
+    Add GSEs of the cycle to the queue and mark the cycle as queued
+
+    :param status_db_connection: BaseEngine object connected to db
+    :param this_cycle: cycle of the GSEs
+    :param gse_list: GSEs to queue
+    :param target: Namespace of the projects (bedbase, geo)
+    :param tag: Tag of the projects
+    :return: the same cycle model
+    """
     this_cycle.number_of_projects = len(gse_list)
     status_db_connection.update_upload_cycle(this_cycle)
 
-    _LOGGER.info(
-        f"Number of projects that will be processed: {this_cycle.number_of_projects}"
+    # Finder found the GSEs, because they were updated in the window. Those
+    # uploaded after the window ended already have the update. GEO gives no
+    # time of the update, so the end of the window (plus a margin) stands in
+    # for it.
+    uploaded_after = datetime.datetime.strptime(
+        this_cycle.end_period, "%Y/%m/%d"
+    ).replace(tzinfo=datetime.timezone.utc) + timedelta(hours=SKIP_UPLOADED_AFTER_HOURS)
+    uploaded_gses = status_db_connection.get_uploaded_gses(
+        target, gse_list, uploaded_after
     )
 
-    log_model_dict = {}
+    _LOGGER.info(
+        f"Number of projects that will be processed in "
+        f"{this_cycle.start_period}:{this_cycle.end_period}: "
+        f"{this_cycle.number_of_projects}"
+    )
 
-    for gse in gse_list:
-        model_l = StatusModel(
+    log_models = [
+        StatusModel(
             target=target,
             gse=gse,
             log_stage=0,
-            status="queued",
+            status="skipped" if gse in uploaded_gses else "queued",
+            status_info="uploaded" if gse in uploaded_gses else None,
             registry_path=f"{target}/{gse}:{tag}",
             upload_cycle_id=this_cycle.id,
         )
-        model_l = status_db_connection.upload_project_log(model_l)
-        log_model_dict[gse] = model_l
-
-        _LOGGER.info(f"GSE: '{gse}' was added to the queue! Target: {target}")
-
-    this_cycle.status = "queued"
-    status_db_connection.update_upload_cycle(this_cycle)
-
-    _LOGGER.info("================== Finished ==================")
+        for gse in gse_list
+    ]
+    status_db_connection.upload_project_logs(log_models)
+    GSE_QUEUED.inc(len(log_models) - len(uploaded_gses), target=target)
     _LOGGER.info(
-        f"\033[32mAfter run report: Added {this_cycle.number_of_projects} projects\033[0m"
+        f"{len(log_models) - len(uploaded_gses)} GSEs were added to the queue, "
+        f"{len(uploaded_gses)} were skipped as already uploaded! Target: {target}"
     )
 
+    this_cycle.status = "queued"
+    return status_db_connection.update_upload_cycle(this_cycle)
+
 
 def add_to_queue(
     target: str,
     tag: str,
     period: int = LAST_UPDATE_DATES,
+    chunk_days: int = QUEUE_WINDOW_DAYS,
 ) -> NoReturn:
     """
 
     :param target: Namespace of the projects (bedbase, geo)
     :param tag: Tag of the projects
     :param period: number of last days to add to the queue
+    :param chunk_days: maximum length of a queued cycle in days. 0 disables splitting
     :return: NoReturn
     """
     today_date = datetime.datetime.today()
@@ -125,13 +236,33 @@ def add_to_queue(
         tag=tag,
         start_period=start_date_str,
         end_period=end_date_str,
+        chunk_days=chunk_days,
     )
 
 
 def upload_queued_projects(
     target: str,
     tag: str = None,
+    workers: int = 1,
+    geofetch_timeout: int = GEOFETCH_TIMEOUT,
+    queue_size: int = UPLOAD_QUEUE_SIZE,
+    resume: bool = False,
+    lease_seconds: int = WORKER_LEASE_SECONDS,
 ) -> None:
+    """
+    Upload projects of the queued cycles
+
+    :param target: Namespace of the projects (bedbase, geo)
+    :param tag: Tag of the projects
+    :param workers: number of GSEs processed concurrently
+    :param geofetch_timeout: seconds before geofetch of a single GSE is killed
+    :param queue_size: number of downloaded GSEs that may wait for upload
+    :param resume: first requeue cycles and projects of uploaders and workers,
+        whose leases expired (they were killed or crashed)
+    :param lease_seconds: seconds before a claimed cycle is considered abandoned,
+        if this uploader stops sending heartbeats
+    :return: None
+    """
     # LOG info
     time_now = datetime.datetime.now()
     _LOGGER.info(f"Time now: {time_now}")
@@ -141,60 +272,118 @@ def upload_queued_projects(
 
     agent = get_agent()
     status_db_connection = get_base_db_engine()
+    worker_id = make_worker_id()
+
+    if resume:
+        status_db_connection.requeue_expired(target)
 
     list_of_cycles = status_db_connection.get_queued_cycle(target=target)
 
     if not list_of_cycles:
         _LOGGER.info("No queued cycles found. Quitting..")
 
-    for this_cycle in list_of_cycles:
-        this_cycle.status = "processing"
-        this_cycle = status_db_connection.update_upload_cycle(this_cycle)
-        gse_log_list = status_db_connection.get_queued_project(cycle_id=this_cycle.id)
+    heartbeat = LeaseHeartbeat(status_db_connection, worker_id, lease_seconds)
+    heartbeat.start()
+    try:
+        for this_cycle in list_of_cycles:
+            if not status_db_connection.claim_cycle(
+                this_cycle.id, worker_id, lease_seconds
+            ):
+                _LOGGER.info(f"Cycle {this_cycle.id} was taken by another uploader")
+                continue
+            this_cycle.status = "processing"
+            status_counts = status_db_connection.get_cycle_status_counts(
+                this_cycle.id
+            )
 
-        log_model_dict = {}
-        for gse_log_item in gse_log_list:
-            log_model_dict[gse_log_item.gse] = gse_log_item
+            _upload_gse_project(
+                agent,
+                status_db_connection,
+                status_db_connection.iter_claimed_projects(
+                    target, this_cycle.id, worker_id, lease_seconds=lease_seconds
+                ),
+                target,
+                tag,
+                total_nb=status_counts.get("queued", 0),
+                workers=workers,
+                geofetch_timeout=geofetch_timeout,
+                queue_size=queue_size,
+            )
 
-        status_dict = _upload_gse_project(
-            agent, status_db_connection, log_model_dict, target, tag
-        )
+            _finish_cycle(status_db_connection, this_cycle)
+    finally:
+        heartbeat.stop()
 
-        this_cycle.number_of_projects = status_dict.get("total")
-        # this_cycle.number_of_successes = status_dict.get("success") + status_dict.get(
-        #     "warning"
-        # )
-        this_cycle.number_of_successes = (
-            status_db_connection.get_number_samples_success(this_cycle.id)
-            + status_db_connection.get_number_samples_warnings(this_cycle.id)
-        )
-        # this_cycle.number_of_failures = status_dict.get("failure")
-        this_cycle.number_of_failures = (
-            status_db_connection.get_number_samples_failures(this_cycle.id)
-        )
 
-        this_cycle.status = "success"
+def _finish_cycle(status_db_connection, cycle: CycleModel) -> bool:
+    """
+    Mark the cycle of an uploader as successful, with its counters and stage
+    summary, unless some of its projects are still processed by workers, that
+    claimed them before the uploader took the cycle. The last of them finishes it.
 
-        status_db_connection.update_upload_cycle(this_cycle)
+    :param status_db_connection: BaseEngine object connected to db
+    :param cycle: cycle model of the uploader
+    :return: True if the cycle was finished
+    """
+    if not status_db_connection.finalize_cycle(cycle.id):
+        _LOGGER.info(f"Cycle {cycle.id} has projects of other workers left")
+        return False
+    _set_cycle_counters(status_db_connection, cycle)
+    cycle.status = "success"
+    status_db_connection.update_upload_cycle(cycle)
+    return True
 
 
-def _upload_gse_project(
-    agent,
-    log_connection,
-    log_model_dict,
-    target,
-    tag=None,
-) -> Dict[str, int]:
+def _set_cycle_counters(status_db_connection, cycle: CycleModel) -> CycleModel:
     """
-    Get, upload to PEPhub and load log to database of GSE project
-    :param agent: pepdbagent object connected to db
-    :param log_connection: UploadStatusConnection object connected to db
-    :param log_model_dict: dictionary with StatusModel (seq table model), where keys are GSEs
+    Set number of projects, successes and failures of the cycle from its project
+    statuses
+
+    :param status_db_connection: BaseEngine object connected to db
+    :param cycle: cycle model to update (not written to the db)
+    :return: the same cycle model
+    """
+    status_counts = status_db_connection.get_cycle_status_counts(cycle.id)
+    # counts the projects of a resumed cycle, processed before the crash, too
+    cycle.number_of_projects = sum(status_counts.values())
+    cycle.number_of_successes = (
+        status_counts.get("success", 0)
+        + status_counts.get("warning", 0)
+        + status_counts.get("skipped", 0)
+    )
+    cycle.number_of_failures = status_counts.get("failure", 0)
+    cycle.stage_summary = _cycle_stage_summary(status_db_connection, cycle.id)
+    return cycle
+
+
+def _cycle_stage_summary(status_db_connection, cycle_id: int) -> dict:
+    """
+    Get p50/p95/max of the stage metrics of the projects of the cycle
+
+    :param status_db_connection: BaseEngine object connected to db
+    :param cycle_id: id of the cycle
+    :return: stage summary
+    """
+    stage_summary = summarize_stage_metrics(
+        status_db_connection.iter_stage_metrics(cycle_id)
+    )
+    for key, summary in stage_summary.items():
+        _LOGGER.info(
+            f"Cycle {cycle_id} {key}: p50={summary['p50']:g}, "
+            f"p95={summary['p95']:g}, max={summary['max']:g} (n={summary['n']})"
+        )
+    return stage_summary
+
+
+def _geofetcher_kwargs(target: str) -> dict:
+    """
+    Geofetcher settings for a target namespace
+
     :param target: namespace where project's should be added
-    :return: NoReturn
+    :return: keyword arguments for geofetch.Geofetcher
     """
     if target == "bedbase":
-        geofetcher_obj = geofetch.Geofetcher(
+        return dict(
             filter=r"\.(bed|bigBed|narrowPeak|broadPeak)\.",
             filter_size=BEDBASE_MAX_SIZE,
             data_source="all",
@@ -203,99 +392,450 @@ def _upload_gse_project(
     elif target == "accbase":
         # For accbase, we want all files from ATAC-seq/DNase-seq projects
         # No file extension filter - we filter by assay type in the Finder
-        geofetcher_obj = geofetch.Geofetcher(
+        return dict(
             filter_size=ACCBASE_MAX_SIZE,
             data_source="all",
             processed=True,
         )
-    else:
-        geofetcher_obj = geofetch.Geofetcher()
-    total_nb = len(log_model_dict.keys())
-    process_nb = 0
+    return {}
+
+
+def _upload_gse_project(
+    agent,
+    log_connection,
+    gse_logs: Iterable[StatusModel],
+    target,
+    tag=None,
+    total_nb: int = None,
+    workers: int = 1,
+    geofetch_timeout: int = GEOFETCH_TIMEOUT,
+    queue_size: int = UPLOAD_QUEUE_SIZE,
+) -> Dict[str, int]:
+    """
+    Get, upload to PEPhub and load log to database of GSE project
+
+    Runs as a two-stage pipeline: `workers` threads download GSEs with geofetch
+    and hand the projects over a bounded queue to the calling thread, which
+    writes them to PEPhub. Downloads of the next GSEs overlap with the writes.
+
+    :param agent: pepdbagent object connected to db
+    :param log_connection: UploadStatusConnection object connected to db
+    :param gse_logs: StatusModels (seq table model) of the GSEs. Consumed lazily,
+        so a streaming iterator keeps memory flat
+    :param target: namespace where project's should be added
+    :param total_nb: number of GSEs expected in gse_logs (for logging)
+    :param workers: number of GSEs downloaded concurrently. Each worker holds a
+        status connection, so keep this under the SQLAlchemy pool size
+    :param geofetch_timeout: seconds before geofetch of a single GSE is killed
+    :param queue_size: number of downloaded GSEs that may wait for upload. Together
+        with workers, caps how many projects are held in memory
+    :return: dict with number of processed projects by status
+    """
+    geofetcher_obj = geofetch.Geofetcher(**_geofetcher_kwargs(target))
+    geofetch_cache = get_geofetch_cache()
+    rate_limiter = get_ncbi_rate_limiter()
+    workers = max(1, workers)
+    concurrency = AdaptiveConcurrency(
+        max_limit=workers, is_throttled=is_throttling_error
+    )
+    start_time = time.monotonic()
+    start_requests = rate_limiter.acquired
+
+    if total_nb is None and isinstance(gse_logs, Sized):
+        total_nb = len(gse_logs)
     _LOGGER.info(f"Number of projects that will be processed: {total_nb}")
     status_dict = {
-        "total": total_nb,
+        "total": 0,
         "success": 0,
         "failure": 0,
         "warning": 0,
     }
-    for gse in log_model_dict.keys():
-        gse_log = log_model_dict[gse]
 
-        gse_log.status = "processing"
-        gse_log.log_stage = 1
-        log_connection.upload_project_log(gse_log)
+    fetched_queue = queue.Queue(maxsize=max(1, queue_size))
+    gse_iterator = enumerate(gse_logs, 1)
+    iterator_lock = threading.Lock()
+    # errors of gse_logs itself (e.g. lost db cursor), re-raised in this thread
+    iterator_errors = []
+
+    def _fetch_worker() -> None:
+        try:
+            while True:
+                with iterator_lock:
+                    if iterator_errors:
+                        return
+                    try:
+                        process_nb, gse_log = next(gse_iterator, (None, None))
+                    except Exception as err:
+                        iterator_errors.append(err)
+                        return
+                if gse_log is None:
+                    return
+                try:
+                    project_dict, fetch_status = _fetch_gse(
+                        log_connection,
+                        gse_log,
+                        geofetcher_obj,
+                        process_nb,
+                        total_nb,
+                        geofetch_timeout=geofetch_timeout,
+                        geofetch_cache=geofetch_cache,
+                        rate_limiter=rate_limiter,
+                        concurrency=concurrency,
+                        ncbi_requests=GEOFETCH_NCBI_REQUESTS.get(
+                            target, GEOFETCH_NCBI_REQUESTS["geo"]
+                        ),
+                    )
+                except Exception as err:
+                    # status writes themselves failed; the GSE stays in "processing"
+                    _LOGGER.error(f"Failed to process {gse_log.gse}: {err}")
+                    project_dict, fetch_status = None, {"failure": 1}
+                fetched_queue.put((gse_log, project_dict, fetch_status))
+        finally:
+            fetched_queue.put(_FETCH_DONE)
+
+    fetch_threads = [
+        threading.Thread(target=_fetch_worker, name=f"geofetch-{i}", daemon=True)
+        for i in range(workers)
+    ]
+    for thread in fetch_threads:
+        thread.start()
+
+    finished_workers = 0
+    while finished_workers < workers:
+        item = fetched_queue.get()
+        if item is _FETCH_DONE:
+            finished_workers += 1
+            continue
+        gse_log, project_dict, gse_status = item
+        status_dict["total"] += 1
+        if project_dict:
+            try:
+                gse_status = _create_gse_projects(
+                    agent, log_connection, gse_log, project_dict, target
+                )
+            except Exception as err:
+                _LOGGER.error(f"Failed to upload {gse_log.gse}: {err}")
+                gse_status = {"failure": 1}
+        for status, count in gse_status.items():
+            status_dict[status] += count
+        observe_gse(target, gse_log.stage_metrics, gse_status)
+
+    for thread in fetch_threads:
+        thread.join()
+
+    if iterator_errors:
+        _LOGGER.error(
+            f"Reading GSEs failed after {status_dict['total']} projects: "
+            f"{iterator_errors[0]}"
+        )
+        raise iterator_errors[0]
+
+    _LOGGER.info("================== Finished ==================")
+    _LOGGER.info(f"\033[32mAfter run report: {status_dict}\033[0m")
+    elapsed = time.monotonic() - start_time
+    UPLOAD_THROUGHPUT.set(status_dict["total"] / max(elapsed, 1e-9), target=target)
+    _log_rate_limit_report(
+        status_dict["total"],
+        elapsed,
+        rate_limiter.acquired - start_requests,
+        rate_limiter.rate,
+        concurrency,
+    )
+    return status_dict
+
+
+def _log_rate_limit_report(
+    number_of_gse: int,
+    elapsed: float,
+    number_of_requests: float,
+    rate: float,
+    concurrency: AdaptiveConcurrency,
+) -> None:
+    """
+    Log throughput of the cycle relative to the NCBI rate-limit budget
+
+    :param number_of_gse: number of processed GSEs
+    :param elapsed: cycle duration in seconds
+    :param number_of_requests: number of NCBI requests taken from the rate limiter
+    :param rate: allowed NCBI requests per second
+    :param concurrency: concurrency limiter used in the cycle
+    """
+    elapsed = max(elapsed, 1e-9)
+    budget = rate * elapsed
+    _LOGGER.info(
+        f"Throughput: {number_of_gse / elapsed:.3f} GSE/s, "
+        f"{number_of_gse / budget:.3f} GSE per NCBI request allowed. "
+        f"NCBI requests: {number_of_requests:g} of {budget:.0f} allowed "
+        f"({number_of_requests / budget:.1%} of budget). "
+        f"Throttled: {concurrency.throttled} times, "
+        f"final concurrency {concurrency.limit}/{concurrency.max_limit}"
+    )
+
+
+def _fetch_gse(
+    log_connection,
+    gse_log: StatusModel,
+    geofetcher_obj: geofetch.Geofetcher,
+    process_nb: int,
+    total_nb: int,
+    geofetch_timeout: int = GEOFETCH_TIMEOUT,
+    geofetch_cache: GeofetchCache = None,
+    rate_limiter: TokenBucket = None,
+    concurrency: AdaptiveConcurrency = None,
+    ncbi_requests: int = GEOFETCH_NCBI_REQUESTS["geo"],
+) -> Tuple[Optional[Dict[str, peppy.Project]], Dict[str, int]]:
+    """
+    Download one GSE with geofetch (log stages 1 and 2)
+
+    :param log_connection: UploadStatusConnection object connected to db
+    :param gse_log: StatusModel of the GSE
+    :param geofetcher_obj: Geofetcher object, copied into the geofetch subprocess
+    :param process_nb: position of the GSE in the cycle (for logging)
+    :param total_nb: number of GSEs in the cycle (for logging)
+    :param geofetch_timeout: seconds before geofetch is killed
+    :param geofetch_cache: local cache of geofetch results
+    :param rate_limiter: limiter of NCBI requests, shared between workers
+    :param concurrency: limiter of concurrent geofetch runs, shared between workers
+    :param ncbi_requests: estimated number of NCBI requests made by one geofetch run
+    :return: dict of peppys (None if there is nothing to upload) and
+        dict with number of projects by status, that were finished in this stage
+    """
+    gse = gse_log.gse
+
+    gse_log.status = "processing"
+    gse_log.log_stage = 1
+    gse_log.stage_metrics = {}
+    _write_status(log_connection, gse_log)
+
+    _LOGGER.info(f"\033[0;33mProcessing GSE: {gse}. {process_nb}/{total_nb}\033[0m")
+
+    try:
+        gse_log.status_info = "geofetcher"
+        gse_log.log_stage = 2
+        fetch_kwargs = dict(
+            timeout=geofetch_timeout,
+            cache=geofetch_cache,
+            rate_limiter=rate_limiter,
+            ncbi_requests=ncbi_requests,
+            stage_metrics=gse_log.stage_metrics,
+        )
+        if concurrency:
+            project_dict = retry_call(
+                concurrency.run, run_geofetch, gse, geofetcher_obj, **fetch_kwargs
+            )
+        else:
+            project_dict = retry_call(run_geofetch, gse, geofetcher_obj, **fetch_kwargs)
+        _LOGGER.info("Project has been downloaded using geofetch")
+        gse_log.stage_metrics["samples"] = _count_samples(project_dict)
+    except FunctionTimeoutError as err:
+        gse_log.status = "failure"
+        gse_log.status_info = "timeout"
+        gse_log.info = str(err)
+        _write_status(log_connection, gse_log)
+        return None, {"failure": 1}
+    except Exception as err:
+        gse_log.status = "failure"
+        gse_log.status_info = _failure_info(err, "geofetcher")
+        gse_log.info = str(err)
+        _write_status(log_connection, gse_log)
+        return None, {"failure": 1}
+
+    if len(list(project_dict.keys())) == 0:
+        gse_log.status = "warning"
+        gse_log.info = "No data was fetched from GEO, check if project has any data"
+        gse_log.status_info = "geofetcher"
+        _write_status(log_connection, gse_log)
+        return None, {"warning": 1}
+
+    return project_dict, {}
+
+
+def _count_samples(project_dict: Dict[str, peppy.Project]) -> int:
+    """
+    Count samples of the projects of a GSE
+
+    :param project_dict: dict of peppys returned by geofetch
+    :return: number of samples
+    :raise ProjectTooLargeError: if a project has more than MAX_PROJECT_SAMPLES
+    """
+    for prj_name, project in project_dict.items():
+        if len(project.samples) > MAX_PROJECT_SAMPLES:
+            raise ProjectTooLargeError(
+                f"{prj_name} has {len(project.samples)} samples, "
+                f"more than {MAX_PROJECT_SAMPLES}"
+            )
+    return sum(len(project.samples) for project in project_dict.values())
+
 
-        process_nb += 1
-        _LOGGER.info(f"\033[0;33mProcessing GSE: {gse}. {process_nb}/{total_nb}\033[0m")
+def _create_gse_projects(
+    agent,
+    log_connection,
+    gse_log: StatusModel,
+    project_dict: Dict[str, peppy.Project],
+    target: str,
+) -> Dict[str, int]:
+    """
+    Upload downloaded projects of one GSE to PEPhub (log stage 3)
+
+    :param agent: pepdbagent object connected to db
+    :param log_connection: UploadStatusConnection object connected to db
+    :param gse_log: StatusModel of the GSE
+    :param project_dict: dict of peppys returned by geofetch
+    :param target: namespace where project's should be added
+    :return: dict with number of processed projects by status
+    """
+    status_dict = {"success": 0, "failure": 0}
+    if gse_log.stage_metrics is None:
+        gse_log.stage_metrics = {}
+
+    # (name, PEPhub tag, geofetch tag, project)
+    projects = []
+    results = {}
+    to_write = []
+    with timed(gse_log.stage_metrics, "prepare"):
+        for prj_name, project in project_dict.items():
+            pep_name, pep_tag = prj_name.split("_")[:2]
+            project = add_link_to_description(gse=pep_name, pep=project)
+            projects.append((pep_name, _pephub_tag(target, pep_tag), pep_tag, project))
 
         try:
-            gse_log.status_info = "geofetcher"
-            gse_log.log_stage = 2
-            project_dict = run_geofetch(gse, geofetcher_obj)
-            _LOGGER.info("Project has been downloaded using geofetch")
+            stored_projects = get_stored_projects(
+                agent, target, [(pep_name, tag) for pep_name, tag, _, _ in projects]
+            )
         except Exception as err:
+            _LOGGER.warning(
+                f"Can't compare {gse_log.gse} with PEPhub, writing it: {err}"
+            )
+            stored_projects = {}
+
+        for pep_name, tag, pep_tag, project in projects:
+            try:
+                if is_project_unchanged(
+                    project, pep_name, tag, project.description, stored_projects
+                ):
+                    _LOGGER.info(
+                        f"{target}/{pep_name}:{tag} is unchanged, skipping write"
+                    )
+                    results[(pep_name, tag)] = "unchanged"
+                else:
+                    to_write.append((pep_name, tag, project))
+            except Exception as err:
+                results[(pep_name, tag)] = err
+
+    gse_log.log_stage = 3
+    _LOGGER.info(f"Writing {len(to_write)} projects of {gse_log.gse} to {target}")
+    with timed(gse_log.stage_metrics, "create"):
+        written = _write_projects(agent, target, to_write)
+    for (pep_name, tag, _), error in zip(to_write, written):
+        results[(pep_name, tag)] = error
+
+    first_failure = None
+    for pep_name, tag, pep_tag, _ in projects:
+        result = results[(pep_name, tag)]
+        gse_log.registry_path = f"{target}/{pep_name}:{pep_tag}"
+        if isinstance(result, Exception):
             gse_log.status = "failure"
-            gse_log.info = str(err)
-            log_connection.upload_project_log(gse_log)
+            gse_log.status_info = _failure_info(result, "pepdbagent")
+            gse_log.info = str(result)
             status_dict["failure"] += 1
-            continue
+            first_failure = first_failure or gse_log.model_copy()
+        else:
+            gse_log.status = "success"
+            gse_log.status_info = result or "pepdbagent"
+            gse_log.info = ""
+            status_dict["success"] += 1
+        _write_status(log_connection, gse_log)
+
+    # the status of the GSE is the last one written: it is a success only if
+    # none of its PEPs failed, so that the failed ones are retried
+    if first_failure and gse_log.status != "failure":
+        gse_log.registry_path = first_failure.registry_path
+        gse_log.status = first_failure.status
+        gse_log.status_info = first_failure.status_info
+        gse_log.info = first_failure.info
+        _write_status(log_connection, gse_log)
 
-        if len(list(project_dict.keys())) == 0:
-            gse_log.status = "warning"
-            gse_log.info = "No data was fetched from GEO, check if project has any data"
-            gse_log.status_info = "geofetcher"
-            log_connection.upload_project_log(gse_log)
-            status_dict["warning"] += 1
-            continue
+    return status_dict
 
-        for prj_name in project_dict:
-            prj_name_list = prj_name.split("_")
-            pep_name = prj_name_list[0]
-            pep_tag = prj_name_list[1]
 
-            gse_log.registry_path = f"{target}/{pep_name}:{pep_tag}"
-            log_connection.upload_project_log(gse_log)
+def _write_status(log_connection, gse_log: StatusModel) -> StatusModel:
+    """
+    Write status of the GSE, and add the time it took to its stage metrics
 
-            _LOGGER.info(
-                f"Namespace = {target} ; Project_name = {pep_name} ; Tag = {pep_tag}"
-            )
-            project_dict[prj_name] = add_link_to_description(
-                gse=prj_name_list[0], pep=project_dict[prj_name]
+    :param log_connection: UploadStatusConnection object connected to db
+    :param gse_log: StatusModel of the GSE
+    :return: StatusModel
+    """
+    if gse_log.stage_metrics is None:
+        gse_log.stage_metrics = {}
+    with timed(gse_log.stage_metrics, "status"):
+        return log_connection.upload_project_log(gse_log)
+
+
+def _write_projects(
+    agent, target: str, projects: List[Tuple[str, str, peppy.Project]]
+) -> List[Optional[Exception]]:
+    """
+    Write projects of a GSE to PEPhub in one transaction. If the transaction
+    itself fails, the projects are written one by one
+
+    :param agent: pepdbagent object connected to db
+    :param target: namespace where project's should be added
+    :param projects: list of (name, tag, project)
+    :return: list of errors, in the order of projects. None if the project was written
+    """
+    if not projects:
+        return []
+    try:
+        return retry_call(write_projects, agent, target, projects)
+    except Exception as err:
+        _LOGGER.warning(f"Batched write failed, writing projects one by one: {err}")
+
+    errors = []
+    for pep_name, tag, project in projects:
+        try:
+            retry_call(
+                agent.project.create,
+                project=project,
+                namespace=target,
+                name=pep_name,
+                tag=tag,
+                overwrite=True,
+                description=project.description,
+                pep_schema=None,
             )
-            gse_log.log_stage = 3
-            gse_log.status_info = "pepdbagent"
-            if target == "bedbase":
-                tag = pep_tag
-            elif target == "accbase":
-                tag = pep_tag
-            else:
-                tag = "default"
-            try:
-                agent.project.create(
-                    project=project_dict[prj_name],
-                    namespace=target,
-                    name=pep_name,
-                    tag=tag,
-                    overwrite=True,
-                    description=project_dict[prj_name].description,
-                    pep_schema=None,
-                )
-                gse_log.status = "success"
-                gse_log.info = ""
-                log_connection.upload_project_log(gse_log)
+            errors.append(None)
+        except Exception as err:
+            errors.append(err)
+    return errors
 
-                status_dict["success"] += 1
-            except Exception as err:
-                gse_log.status = "failure"
-                gse_log.info = str(err)
-                log_connection.upload_project_log(gse_log)
 
-                status_dict["failure"] += 1
+def _pephub_tag(target: str, pep_tag: str) -> str:
+    """
+    Get PEPhub tag of a geofetch project
 
-    _LOGGER.info("================== Finished ==================")
-    _LOGGER.info(f"\033[32mAfter run report: {status_dict}\033[0m")
-    return status_dict
+    :param target: namespace where project's should be added
+    :param pep_tag: tag part of the geofetch project name
+    :return: tag of the project in PEPhub
+    """
+    if target in ("bedbase", "accbase"):
+        return pep_tag
+    return "default"
+
+
+def _failure_info(err: Exception, stage: str) -> str:
+    """
+    Get status_info of a failed GSE: class of the error, or the failed stage
+    if the error is not classified
+
+    :param err: exception that failed the GSE
+    :param stage: name of the failed stage ("geofetcher", "pepdbagent")
+    :return: status_info
+    """
+    error_class = classify_error(err)
+    if error_class == ERROR_UNKNOWN:
+        return stage
+    return error_class
 
 
 def run_upload_checker(
@@ -303,6 +843,10 @@ def run_upload_checker(
     period_length: int,
     tag: str,
     number_of_cycles: int = 1,
+    workers: int = 1,
+    geofetch_timeout: int = GEOFETCH_TIMEOUT,
+    queue_size: int = UPLOAD_QUEUE_SIZE,
+    chunk_days: int = QUEUE_WINDOW_DAYS,
 ) -> NoReturn:
     """
     Check if previous run (cycle) was successful.
@@ -311,6 +855,10 @@ def run_upload_checker(
     :param period_length: length of the period
     :param tag: tag of the projects
     :param number_of_cycles: what cycle behind should be checked?
+    :param workers: number of GSEs processed concurrently
+    :param geofetch_timeout: seconds before geofetch of a single GSE is killed
+    :param queue_size: number of downloaded GSEs that may wait for upload
+    :param chunk_days: maximum length of a window in days. 0 disables splitting
     :return: NoReturn
     """
 
@@ -325,6 +873,10 @@ def run_upload_checker(
         start_period=start_period,
         end_period=end_period,
         tag=tag,
+        workers=workers,
+        geofetch_timeout=geofetch_timeout,
+        queue_size=queue_size,
+        chunk_days=chunk_days,
     )
 
 
@@ -333,24 +885,68 @@ def check_by_date(
     start_period: str,
     end_period: str,
     tag: str,
+    workers: int = 1,
+    geofetch_timeout: int = GEOFETCH_TIMEOUT,
+    queue_size: int = UPLOAD_QUEUE_SIZE,
+    chunk_days: int = QUEUE_WINDOW_DAYS,
 ) -> NoReturn:
     """
     Check if previous run (cycle) was successful.
 
+    Periods longer than chunk_days are checked window by window, the same way
+    they are queued, so only failed windows are queued and uploaded again.
+
     :param target: Namespace of the projects (bedbase, geo)
     :param start_period: start_period (Earlier in the calender) ["2020/02/25"]
     :param end_period: end period (Later in the calender) ["2021/05/27"]
     :param tag: tag of the projects
+    :param workers: number of GSEs processed concurrently
+    :param geofetch_timeout: seconds before geofetch of a single GSE is killed
+    :param queue_size: number of downloaded GSEs that may wait for upload
+    :param chunk_days: maximum length of a window in days. 0 disables splitting
     :return: NoReturn
     """
-
-    status_db_connection = get_base_db_engine()
-
     today_date = datetime.datetime.strptime(end_period, "%Y/%m/%d")
     start_date = datetime.datetime.strptime(start_period, "%Y/%m/%d")
     start_period = start_date.strftime("%Y/%m/%d")
     end_period = today_date.strftime("%Y/%m/%d")
 
+    for window_start, window_end in split_period(start_period, end_period, chunk_days):
+        _check_window(
+            target=target,
+            start_period=window_start,
+            end_period=window_end,
+            tag=tag,
+            workers=workers,
+            geofetch_timeout=geofetch_timeout,
+            queue_size=queue_size,
+        )
+
+
+def _check_window(
+    target: str,
+    start_period: str,
+    end_period: str,
+    tag: str,
+    workers: int = 1,
+    geofetch_timeout: int = GEOFETCH_TIMEOUT,
+    queue_size: int = UPLOAD_QUEUE_SIZE,
+) -> None:
+    """
+    Check the cycle of one window, and upload its failed projects again or
+    queue and upload the whole window, if its cycle was not successful.
+
+    :param target: Namespace of the projects (bedbase, geo)
+    :param start_period: start date of the window ["2020/02/25"]
+    :param end_period: end date of the window ["2020/03/03"]
+    :param tag: tag of the projects
+    :param workers: number of GSEs processed concurrently
+    :param geofetch_timeout: seconds before geofetch of a single GSE is killed
+    :param queue_size: number of downloaded GSEs that may wait for upload
+    :return: None
+    """
+    status_db_connection = get_base_db_engine()
+
     try:
         cycle_info = status_db_connection.was_run_successful(
             target=target, start_period=start_period, end_period=end_period
@@ -369,26 +965,26 @@ def check_by_date(
             if cycle_info.number_of_projects == cycle_info.number_of_successes:
                 _LOGGER.info("All uploads were successful.")
             else:
-                list_of_failed_prj = status_db_connection.get_failed_project(
+                status_counts = status_db_connection.get_cycle_status_counts(
                     cycle_info.id
                 )
 
-                log_model_dict = {}
-                for gse_log_item in list_of_failed_prj:
-                    log_model_dict[gse_log_item.gse] = gse_log_item
-
                 agent = get_agent()
 
                 status_dict = _upload_gse_project(
-                    agent, status_db_connection, log_model_dict, target, tag
-                )
-                cycle_info.number_of_successes = (
-                    status_db_connection.get_number_samples_success(cycle_info.id)
-                    + status_db_connection.get_number_samples_warnings(cycle_info.id)
-                )
-                cycle_info.number_of_failures = (
-                    status_db_connection.get_number_samples_failures(cycle_info.id)
+                    agent,
+                    status_db_connection,
+                    status_db_connection.iter_failed_project(cycle_info.id),
+                    target,
+                    tag,
+                    total_nb=sum(status_counts.values())
+                    - status_counts.get("success", 0)
+                    - status_counts.get("skipped", 0),
+                    workers=workers,
+                    geofetch_timeout=geofetch_timeout,
+                    queue_size=queue_size,
                 )
+                _set_cycle_counters(status_db_connection, cycle_info)
                 cycle_info.status = "success"
 
                 # cycle_info.number_of_failures = status_dict.get("failure")
@@ -402,10 +998,14 @@ def check_by_date(
             start_period=start_period,
             end_period=end_period,
             tag=tag,
+            chunk_days=0,
         )
         upload_queued_projects(
             target=target,
             tag=tag,
+            workers=workers,
+            geofetch_timeout=geofetch_timeout,
+            queue_size=queue_size,
         )
 
 
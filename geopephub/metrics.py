@@ -0,0 +1,414 @@
+# Pipeline metrics in the Prometheus text exposition format.
+#
+# Scheduled jobs write them to a file when the command exits
+# (`geopephub --metrics-file /var/lib/node_exporter/geopephub.prom run-uploader ...`),
+# for the node_exporter textfile collector or a Pushgateway push
+# (`curl --data-binary @geopephub.prom $PUSHGATEWAY/metrics/job/geopephub`).
+# Long-running `run-worker --metrics-port 9108` serves them over HTTP.
+# Metrics are kept in process memory, there is no client library dependency.
+
+import logging
+import math
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Sequence, Tuple
+
+from sqlalchemy import event
+
+from geopephub.throttle import get_ncbi_rate_limiter
+
+_LOGGER = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# seconds; geofetch runs take up to GEOFETCH_TIMEOUT
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 240)
+
+
+class _Metric:
+    type = ""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        function: Callable[[], float] = None,
+    ):
+        """
+        :param name: metric name
+        :param documentation: help text
+        :param labelnames: names of the labels
+        :param function: callable, that returns the value at collection time
+            (metrics without labels only)
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.function = function
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}"
+            )
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        """
+        :return: list of (sample name, labels, value)
+        """
+        if self.function:
+            return [(self.name, {}, self.function())]
+        with self._lock:
+            return [
+                (self.name, dict(zip(self.labelnames, key)), value)
+                for key, value in sorted(self._values.items())
+            ]
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        """
+        Increase the counter
+
+        :param amount: non-negative increment
+        :param labels: label values
+        """
+        if amount < 0:
+            raise ValueError("Counters can only be increased")
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        """
+        Set the gauge
+
+        :param value: new value
+        :param labels: label values
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = STAGE_BUCKETS,
+    ):
+        """
+        :param name: metric name
+        :param documentation: help text
+        :param labelnames: names of the labels
+        :param buckets: upper bounds of the buckets, +Inf is added
+        """
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels) -> None:
+        """
+        Add observation to the histogram
+
+        :param value: observed value
+        :param labels: label values
+        """
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        samples = []
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                labels = dict(zip(self.labelnames, key))
+                for bound, count in zip(self.buckets, counts):
+                    samples.append(
+                        (f"{self.name}_bucket", {**labels, "le": _format(bound)}, count)
+                    )
+                samples.append((f"{self.name}_sum", labels, total))
+                samples.append((f"{self.name}_count", labels, counts[-1]))
+        return samples
+
+
+class Registry:
+    """
+    Collection of metrics, rendered together
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        """
+        Add metric to the registry
+
+        :param metric: Counter, Gauge or Histogram
+        :return: the same metric
+        """
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """
+        Render all metrics in the Prometheus text format
+
+        :return: text exposition of the metrics
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {_escape_help(metric.documentation)}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labels)} {_format(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape_help(text: str) -> str:
+    return text.replace("\\", r"\\").replace("\n", r"\n")
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in labels.items():
+        value = str(value).replace("\\", r"\\").replace('"', r"\"")
+        pairs.append(f'{name}="{value}"'.replace("\n", r"\n"))
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+REGISTRY = Registry()
+
+JOB_START = REGISTRY.register(
+    Gauge(
+        "geopephub_job_start_time_seconds",
+        "Unix time when the geopephub command started",
+        ["job"],
+    )
+)
+JOB_DURATION = REGISTRY.register(
+    Gauge(
+        "geopephub_job_duration_seconds",
+        "Seconds the geopephub command ran, until metrics were written",
+        ["job"],
+    )
+)
+GSE_PROCESSED = REGISTRY.register(
+    Counter(
+        "geopephub_gse_processed_total",
+        "GSEs processed by the uploader",
+        ["target"],
+    )
+)
+PROJECTS = REGISTRY.register(
+    Counter(
+        "geopephub_projects_total",
+        "Outcomes of processed GSEs and their projects, by status",
+        ["target", "status"],
+    )
+)
+UPLOAD_THROUGHPUT = REGISTRY.register(
+    Gauge(
+        "geopephub_upload_gse_per_second",
+        "GSEs processed per second in the last upload of the target",
+        ["target"],
+    )
+)
+STAGE_DURATION = REGISTRY.register(
+    Histogram(
+        "geopephub_stage_duration_seconds",
+        "Duration of the upload stages of a GSE",
+        ["stage"],
+    )
+)
+GEOFETCH_BYTES = REGISTRY.register(
+    Counter(
+        "geopephub_geofetch_bytes_total",
+        "Size of the geofetch results",
+        ["target"],
+    )
+)
+GSE_QUEUED = REGISTRY.register(
+    Counter(
+        "geopephub_gse_queued_total",
+        "GSEs queued by the queuer",
+        ["target"],
+    )
+)
+DB_ROUND_TRIPS = REGISTRY.register(
+    Counter(
+        "geopephub_db_round_trips_total",
+        "Statements sent to the database",
+        ["database"],
+    )
+)
+ARCHIVE_BYTES = REGISTRY.register(
+    Counter(
+        "geopephub_archive_bytes_written_total",
+        "Size of the namespace archives written",
+        ["namespace"],
+    )
+)
+S3_BYTES = REGISTRY.register(
+    Counter(
+        "geopephub_s3_transfer_bytes_total",
+        "Bytes transferred to and from S3",
+        ["direction"],
+    )
+)
+S3_SECONDS = REGISTRY.register(
+    Counter(
+        "geopephub_s3_transfer_seconds_total",
+        "Seconds spent in S3 transfers",
+        ["direction"],
+    )
+)
+
+
+NCBI_REQUESTS = REGISTRY.register(
+    Counter(
+        "geopephub_ncbi_requests_total",
+        "NCBI requests taken from the rate limiter (estimated for geofetch runs)",
+        function=lambda: get_ncbi_rate_limiter().acquired,
+    )
+)
+NCBI_WAIT = REGISTRY.register(
+    Counter(
+        "geopephub_ncbi_rate_limit_wait_seconds_total",
+        "Seconds spent waiting for the NCBI rate limiter",
+        function=lambda: get_ncbi_rate_limiter().waited,
+    )
+)
+
+
+def observe_gse(
+    target: str, stage_metrics: Dict[str, float], gse_status: Dict[str, int]
+) -> None:
+    """
+    Record a processed GSE
+
+    :param target: namespace of the projects
+    :param stage_metrics: stage metrics of the GSE (see timing.py)
+    :param gse_status: dict with number of projects of the GSE by status
+    """
+    GSE_PROCESSED.inc(target=target)
+    for status, count in gse_status.items():
+        if count:
+            PROJECTS.inc(count, target=target, status=status)
+    for key, value in (stage_metrics or {}).items():
+        if key.endswith("_s"):
+            STAGE_DURATION.observe(value, stage=key[:-2])
+    if stage_metrics and stage_metrics.get("bytes"):
+        GEOFETCH_BYTES.inc(stage_metrics["bytes"], target=target)
+
+
+def count_db_round_trips(engine, database: str):
+    """
+    Count statements executed by the engine
+
+    :param engine: sqlalchemy engine (sync_engine of an async engine)
+    :param database: name of the database in the metric label
+    :return: the same engine
+    """
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_cursor_execute(*args, **kwargs):
+        DB_ROUND_TRIPS.inc(database=database)
+
+    return engine
+
+
+def write_textfile(path: str, registry: Registry = REGISTRY) -> None:
+    """
+    Write metrics to a file atomically, so that a collector never reads
+    a partial file
+
+    :param path: path of the metrics file
+    :param registry: metrics to write
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(registry.render())
+    os.replace(tmp_path, path)
+
+
+def write_job_metrics(path: str, job: str, start_time: float) -> None:
+    """
+    Record duration of the job and write metrics to the file
+
+    :param path: path of the metrics file
+    :param job: name of the command
+    :param start_time: unix time when the command started
+    """
+    JOB_START.set(start_time, job=job)
+    JOB_DURATION.set(time.time() - start_time, job=job)
+    write_textfile(path)
+    _LOGGER.info(f"Metrics were written to {path}")
+
+
+def start_http_server(
+    port: int, addr: str = "", registry: Registry = REGISTRY
+) -> ThreadingHTTPServer:
+    """
+    Serve metrics over HTTP in a daemon thread
+
+    :param port: port to listen on (0 picks a free one)
+    :param addr: address to listen on [Default: all interfaces]
+    :param registry: metrics to serve
+    :return: the server; server.server_port is the port it listens on
+    """
+
+    class _Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            _LOGGER.debug(format % args)
+
+    server = ThreadingHTTPServer((addr, port), _Handler)
+    server.daemon_threads = True
+    threading.Thread(
+        target=server.serve_forever, name="metrics-http", daemon=True
+    ).start()
+    _LOGGER.info(f"Serving metrics on port {server.server_port}")
+    return server
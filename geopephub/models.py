@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import Dict, Optional
 
 from pydantic import BaseModel
 from pydantic import field_validator
@@ -23,6 +23,9 @@ class CycleModel(BaseModel):
     number_of_projects: Optional[int] = 0
     number_of_successes: Optional[int] = 0
     number_of_failures: Optional[int] = 0
+    worker_id: Optional[str] = None
+    lease_expires_at: Optional[datetime.datetime] = None
+    stage_summary: Optional[Dict[str, Dict[str, float]]] = None
 
     __tablename__ = CYCLE_TABLE_NAME
 
@@ -44,3 +47,7 @@ class StatusModel(BaseModel):
     status: str
     status_info: Optional[str] = None
     info: Optional[str] = None
+    status_date: Optional[datetime.datetime] = None
+    worker_id: Optional[str] = None
+    lease_expires_at: Optional[datetime.datetime] = None
+    stage_metrics: Optional[Dict[str, float]] = None
@@ -0,0 +1,244 @@
+# Helpers around PEPhub writes made by the uploader.
+#
+# pepdbagent overwrites a project (all sample rows) on every
+# `project.create(..., overwrite=True)`, in a transaction of its own. Before
+# writing, the uploader compares the fetched PEP with the stored one:
+# pepdbagent's sample digest and the project config. Unchanged projects are
+# not written again. The rest of the projects of a GSE are written in a single
+# transaction, with a savepoint per project, so that one broken project does
+# not take the others down.
+
+import datetime
+import json
+import logging
+from typing import Dict, List, Optional, Tuple
+
+import peppy
+from pepdbagent import PEPDatabaseAgent
+from pepdbagent.const import DESCRIPTION_KEY, NAME_KEY
+from pepdbagent.db_utils import Projects, User
+from pepdbagent.modules.project import PEPDatabaseProject
+from pepdbagent.utils import create_digest
+from peppy.const import (
+    CONFIG_KEY,
+    SAMPLE_NAME_ATTR,
+    SAMPLE_RAW_DICT_KEY,
+    SAMPLE_TABLE_INDEX_KEY,
+    SUBSAMPLE_RAW_LIST_KEY,
+)
+from sqlalchemy import select, tuple_
+from sqlalchemy.orm import Session
+
+from geopephub.const import QUERY_IN_BATCH_SIZE
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def _project_dict(project: peppy.Project, name: str, description: str) -> dict:
+    """
+    Convert project to dict, normalized the way pepdbagent stores it
+
+    :param project: peppy project
+    :param name: name of the project in PEPhub
+    :param description: description of the project
+    :return: project dict with config, samples and subsamples
+    """
+    project_dict = project.to_dict(extended=True, orient="records")
+    project_dict[CONFIG_KEY][DESCRIPTION_KEY] = description
+    project_dict[CONFIG_KEY][NAME_KEY] = name.lower()
+    # stored config went through JSON
+    project_dict[CONFIG_KEY] = json.loads(json.dumps(project_dict[CONFIG_KEY]))
+    return project_dict
+
+
+def project_fingerprint(
+    project: peppy.Project, name: str, description: str
+) -> Tuple[str, dict, bool]:
+    """
+    Get digest and config of the project, as pepdbagent would store them
+
+    :param project: peppy project
+    :param name: name of the project in PEPhub
+    :param description: description of the project
+    :return: sample digest, config and if the project has subsamples
+        (not covered by the digest)
+    """
+    project_dict = _project_dict(project, name, description)
+    return (
+        create_digest(project_dict),
+        project_dict[CONFIG_KEY],
+        bool(project_dict.get(SUBSAMPLE_RAW_LIST_KEY)),
+    )
+
+
+def get_stored_projects(
+    agent: PEPDatabaseAgent, namespace: str, keys: List[Tuple[str, str]]
+) -> Dict[Tuple[str, str], Tuple[str, dict]]:
+    """
+    Get digests and configs of projects stored in PEPhub
+
+    :param agent: pepdbagent object connected to db
+    :param namespace: namespace of the projects
+    :param keys: list of (name, tag) of the projects
+    :return: dict {(name, tag): (digest, config)} of the projects that exist
+    """
+    keys = [(name.lower(), tag) for name, tag in keys]
+    stored = {}
+    with Session(agent.pep_db_engine.engine) as session:
+        for i in range(0, len(keys), QUERY_IN_BATCH_SIZE):
+            statement = (
+                select(Projects.name, Projects.tag, Projects.digest, Projects.config)
+                .where(Projects.namespace == namespace.lower())
+                .where(
+                    tuple_(Projects.name, Projects.tag).in_(
+                        keys[i : i + QUERY_IN_BATCH_SIZE]
+                    )
+                )
+            )
+            for name, tag, digest, config in session.execute(statement):
+                stored[(name, tag)] = (digest, config)
+    return stored
+
+
+def get_namespace_digests(
+    agent: PEPDatabaseAgent, namespace: str
+) -> Dict[Tuple[str, str], str]:
+    """
+    Get digests of all public projects of the namespace, in one query
+
+    :param agent: pepdbagent object connected to db
+    :param namespace: namespace of the projects
+    :return: dict {(name, tag): digest}
+    """
+    statement = select(Projects.name, Projects.tag, Projects.digest).where(
+        Projects.namespace == namespace.lower(), Projects.private.is_(False)
+    )
+    with Session(agent.pep_db_engine.engine) as session:
+        return {(name, tag): digest for name, tag, digest in session.execute(statement)}
+
+
+def is_project_unchanged(
+    project: peppy.Project,
+    name: str,
+    tag: str,
+    description: str,
+    stored: Dict[Tuple[str, str], Tuple[str, dict]],
+) -> bool:
+    """
+    Check if the project is stored in PEPhub exactly as it is
+
+    :param project: peppy project
+    :param name: name of the project in PEPhub
+    :param tag: tag of the project in PEPhub
+    :param description: description of the project
+    :param stored: stored projects, result of get_stored_projects
+    :return: True if writing the project would not change anything
+    """
+    stored_project = stored.get((name.lower(), tag))
+    if not stored_project:
+        return False
+    digest, config, has_subsamples = project_fingerprint(project, name, description)
+    if has_subsamples:
+        return False
+    return (digest, config) == tuple(stored_project)
+
+
+def write_projects(
+    agent: PEPDatabaseAgent,
+    namespace: str,
+    projects: List[Tuple[str, str, peppy.Project]],
+) -> List[Optional[Exception]]:
+    """
+    Create or overwrite projects in PEPhub in one transaction
+
+    Every project is written in its own savepoint: a project that fails is
+    rolled back alone, and the rest are committed together.
+
+    :param agent: pepdbagent object connected to db
+    :param namespace: namespace of the projects
+    :param projects: list of (name, tag, project). Description of the project
+        is taken from the project
+    :return: list of errors, in the order of projects. None if the project was written
+    """
+    namespace = namespace.lower()
+    errors = []
+    with Session(agent.pep_db_engine.engine) as session:
+        user = session.scalar(select(User).where(User.namespace == namespace))
+        if not user:
+            user = User(namespace=namespace, number_of_projects=0)
+            session.add(user)
+            session.flush()
+
+        for name, tag, project in projects:
+            try:
+                with session.begin_nested():
+                    if _write_project(session, namespace, name, tag, project):
+                        user.number_of_projects += 1
+                errors.append(None)
+            except Exception as err:
+                _LOGGER.warning(f"Failed to write {namespace}/{name}:{tag}: {err}")
+                errors.append(err)
+        session.commit()
+    return errors
+
+
+def _write_project(
+    session: Session, namespace: str, name: str, tag: str, project: peppy.Project
+) -> bool:
+    """
+    Create or overwrite one project in an open session, like pepdbagent's
+    `project.create(..., overwrite=True)` does
+
+    :param session: open session
+    :param namespace: lowercase namespace of the project
+    :param name: name of the project
+    :param tag: tag of the project
+    :param project: peppy project
+    :return: True if the project was created, False if it was overwritten
+    """
+    name = name.lower()
+    project_dict = _project_dict(project, name, project.description)
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    found_prj = session.scalar(
+        select(Projects).where(
+            Projects.namespace == namespace, Projects.name == name, Projects.tag == tag
+        )
+    )
+    created = found_prj is None
+    if created:
+        found_prj = Projects(
+            namespace=namespace,
+            name=name,
+            tag=tag,
+            private=False,
+            submission_date=now,
+        )
+        session.add(found_prj)
+    else:
+        for sample in found_prj.samples_mapping:
+            session.delete(sample)
+        for subsample in found_prj.subsamples_mapping:
+            session.delete(subsample)
+
+    found_prj.digest = create_digest(project_dict)
+    found_prj.config = project_dict[CONFIG_KEY]
+    found_prj.description = project.description
+    found_prj.number_of_samples = len(project_dict[SAMPLE_RAW_DICT_KEY])
+    found_prj.schema_id = None
+    found_prj.pop = False
+    found_prj.last_update_date = now
+
+    PEPDatabaseProject._add_samples_to_project(
+        found_prj,
+        project_dict[SAMPLE_RAW_DICT_KEY],
+        sample_table_index=project_dict[CONFIG_KEY].get(
+            SAMPLE_TABLE_INDEX_KEY, SAMPLE_NAME_ATTR
+        ),
+    )
+    if project_dict.get(SUBSAMPLE_RAW_LIST_KEY):
+        PEPDatabaseProject._add_subsamples_to_project(
+            found_prj, project_dict[SUBSAMPLE_RAW_LIST_KEY]
+        )
+    session.flush()
+    return created
@@ -0,0 +1,183 @@
+# Retries of transient failures in the uploader.
+#
+# Errors are classified as "transient" (network blips, NCBI throttling,
+# serialization conflicts and dropped connections in the database) or
+# "permanent" (malformed SOFT files, invalid projects, projects that don't fit
+# into the database). Transient errors are retried in-process with jittered
+# exponential backoff. Permanent ones fail immediately, and the checker skips
+# them for good, so only errors specific to geofetch, peppy and pepdbagent are
+# permanent. Everything else, built-in exceptions raised by a bug in our own
+# code included, is "unknown": it is not retried in-process, but the checker
+# tries it again in the next cycle, as before.
+
+import logging
+import random
+import re
+import time
+import urllib.error
+from typing import Callable
+
+import peppy.exceptions
+import requests
+from geofetch.utils import AccessionException, SoftFileException
+from pepdbagent.exceptions import PEPDatabaseAgentError
+from sqlalchemy.exc import DBAPIError
+
+from geopephub.const import (
+    ERROR_PERMANENT,
+    ERROR_TRANSIENT,
+    ERROR_UNKNOWN,
+    RETRY_ATTEMPTS,
+    RETRY_BASE_DELAY,
+    RETRY_MAX_DELAY,
+)
+
+_LOGGER = logging.getLogger(__name__)
+
+# serialization failure, deadlock, too many connections, server shutting down
+_TRANSIENT_SQLSTATES = ("40001", "40P01", "53300", "57P01", "57P02", "57P03")
+# connection exceptions
+_TRANSIENT_SQLSTATE_CLASSES = ("08",)
+# data exception, integrity violation, program limit exceeded (e.g. row too big)
+_PERMANENT_SQLSTATE_CLASSES = ("22", "23", "54")
+
+
+class ProjectTooLargeError(Exception):
+    """
+    Project has more samples than PEPhub accepts (MAX_PROJECT_SAMPLES)
+    """
+
+
+_PERMANENT_ERRORS = (
+    AccessionException,
+    SoftFileException,
+    peppy.exceptions.PeppyError,
+    PEPDatabaseAgentError,
+    ProjectTooLargeError,
+)
+
+# errors of the geofetch subprocess, that could not be pickled, reach us as
+# RuntimeError("<type name>: <message>")
+_PERMANENT_MESSAGE_RE = re.compile(
+    r"^(AccessionException|SoftFileException|PeppyError|ProjectTooLargeError):"
+)
+_TRANSIENT_MESSAGE_RE = re.compile(
+    r"\b(429|500|502|503|504)\b.*(Too Many Requests|Server Error|Bad Gateway"
+    r"|Service Unavailable|Gateway Time-?out)"
+    r"|Connection (reset|refused|aborted)|Temporary failure in name resolution",
+    re.IGNORECASE,
+)
+
+
+def _classify_http_status(status_code: int) -> str:
+    if status_code == 429 or status_code >= 500:
+        return ERROR_TRANSIENT
+    if status_code >= 400:
+        return ERROR_PERMANENT
+    return ERROR_UNKNOWN
+
+
+def _classify_db_error(err: DBAPIError) -> str:
+    if err.connection_invalidated:
+        return ERROR_TRANSIENT
+    # psycopg 3 exposes sqlstate, psycopg2 pgcode
+    sqlstate = getattr(err.orig, "sqlstate", None) or getattr(err.orig, "pgcode", None)
+    if not sqlstate:
+        return ERROR_UNKNOWN
+    if sqlstate in _TRANSIENT_SQLSTATES or sqlstate[:2] in _TRANSIENT_SQLSTATE_CLASSES:
+        return ERROR_TRANSIENT
+    if sqlstate[:2] in _PERMANENT_SQLSTATE_CLASSES:
+        return ERROR_PERMANENT
+    return ERROR_UNKNOWN
+
+
+def classify_error(err: Exception) -> str:
+    """
+    Classify exception raised while fetching or uploading a GSE
+
+    :param err: exception raised by geofetch, peppy, pepdbagent or SQLAlchemy
+    :return: "transient", "permanent" or "unknown"
+    """
+    if isinstance(err, requests.HTTPError) and err.response is not None:
+        return _classify_http_status(err.response.status_code)
+    if isinstance(err, (requests.ConnectionError, requests.Timeout)):
+        return ERROR_TRANSIENT
+    if isinstance(err, requests.RequestException):
+        return ERROR_UNKNOWN
+    if isinstance(err, urllib.error.HTTPError):
+        return _classify_http_status(err.code)
+    if isinstance(err, (urllib.error.URLError, ConnectionError, TimeoutError)):
+        return ERROR_TRANSIENT
+    if isinstance(err, DBAPIError):
+        return _classify_db_error(err)
+    if isinstance(err, _PERMANENT_ERRORS):
+        return ERROR_PERMANENT
+
+    message = str(err)
+    if _TRANSIENT_MESSAGE_RE.search(message):
+        return ERROR_TRANSIENT
+    if _PERMANENT_MESSAGE_RE.search(message):
+        return ERROR_PERMANENT
+    return ERROR_UNKNOWN
+
+
+def is_transient_error(err: Exception) -> bool:
+    """
+    Check if exception is worth retrying right away
+
+    :param err: exception
+    :return: True if the error is transient
+    """
+    return classify_error(err) == ERROR_TRANSIENT
+
+
+def backoff_delay(
+    attempt: int,
+    base_delay: float = RETRY_BASE_DELAY,
+    max_delay: float = RETRY_MAX_DELAY,
+) -> float:
+    """
+    Get jittered exponential backoff delay ("full jitter")
+
+    :param attempt: number of the failed attempt, starting from 1
+    :param base_delay: delay cap after the first attempt
+    :param max_delay: upper bound of the delay cap
+    :return: number of seconds to wait before the next attempt
+    """
+    return random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+
+
+def retry_call(
+    func: Callable,
+    *args,
+    attempts: int = RETRY_ATTEMPTS,
+    base_delay: float = RETRY_BASE_DELAY,
+    max_delay: float = RETRY_MAX_DELAY,
+    should_retry: Callable[[Exception], bool] = is_transient_error,
+    sleep: Callable[[float], None] = time.sleep,
+    **kwargs,
+):
+    """
+    Call function and retry it with jittered exponential backoff on transient errors
+
+    :param func: function to call
+    :param attempts: maximum number of calls
+    :param base_delay: delay cap after the first attempt
+    :param max_delay: upper bound of the delay cap
+    :param should_retry: predicate, that tells if an exception is worth retrying
+    :param sleep: sleep function, replaceable in tests
+    :return: result of the function. The last exception is raised if all attempts fail
+    """
+    attempt = 1
+    while True:
+        try:
+            return func(*args, **kwargs)
+        except Exception as err:
+            if attempt >= attempts or not should_retry(err):
+                raise
+            delay = backoff_delay(attempt, base_delay, max_delay)
+            _LOGGER.warning(
+                f"Attempt {attempt}/{attempts} failed: {err}. Retrying in {delay:.1f}s"
+            )
+            sleep(delay)
+            attempt += 1
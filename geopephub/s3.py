@@ -0,0 +1,235 @@
+# Shared S3 transfer layer, used for namespace archives and project uploads.
+#
+# One boto3 client per process: it is thread-safe and holds the connection
+# pool, so it is not worth creating a new one for every file. Files larger than
+# a part are sent and fetched as multipart transfers, with several parts in
+# flight. Every part is its own request and botocore retries it alone, so a
+# failed part does not restart the whole transfer. Tuned with:
+#
+#   GEOPEPHUB_S3_PART_SIZE     size of a part, e.g. "64MB"
+#   GEOPEPHUB_S3_CONCURRENCY   number of parts transferred at once
+#   GEOPEPHUB_S3_MAX_ATTEMPTS  attempts of every request (part) before giving up
+#
+# The usual AWS settings apply as well. AWS_ENDPOINT_URL points the client to
+# MinIO or another S3-compatible server.
+
+import logging
+import os
+import re
+import threading
+import time
+from functools import lru_cache
+from typing import Optional
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+
+from geopephub.const import (
+    DEFAULT_S3_CONCURRENCY,
+    DEFAULT_S3_MAX_ATTEMPTS,
+    DEFAULT_S3_PART_SIZE,
+    S3_MIN_PART_SIZE,
+    S3_PROGRESS_INTERVAL,
+)
+from geopephub.metrics import S3_BYTES, S3_SECONDS
+
+_LOGGER = logging.getLogger(__name__)
+
+_SIZE_RE = re.compile(r"^\s*(\d+)\s*(b|kb|kib|mb|mib|gb|gib)?\s*$", re.IGNORECASE)
+_SIZE_UNITS = {"b": 1, "kb": 1024, "mb": 1024**2, "gb": 1024**3}
+
+
+def parse_part_size(value: str) -> int:
+    """
+    Parse size of a multipart part
+
+    :param value: number of bytes, or integer with a unit: "8MB", "1GB"
+        (units are powers of 1024, "MiB" is accepted for "MB")
+    :return: number of bytes
+    :raise ValueError: if the value is malformed or below the S3 minimum of 5 MiB
+    """
+    match = _SIZE_RE.match(value)
+    if not match:
+        raise ValueError(
+            f"Invalid GEOPEPHUB_S3_PART_SIZE '{value}': use a number of bytes or "
+            f"an integer with a unit (B, KB, MB, GB), e.g. '64MB'"
+        )
+    number, unit = match.groups()
+    size = int(number) * _SIZE_UNITS[(unit or "b").lower().replace("i", "")]
+    if size < S3_MIN_PART_SIZE:
+        raise ValueError(
+            f"GEOPEPHUB_S3_PART_SIZE '{value}' is below the S3 minimum part "
+            f"size of {S3_MIN_PART_SIZE // 1024**2}MB"
+        )
+    return size
+
+
+def _part_size() -> int:
+    return parse_part_size(
+        os.environ.get("GEOPEPHUB_S3_PART_SIZE") or DEFAULT_S3_PART_SIZE
+    )
+
+
+def _concurrency() -> int:
+    return int(os.environ.get("GEOPEPHUB_S3_CONCURRENCY") or DEFAULT_S3_CONCURRENCY)
+
+
+def _max_attempts() -> int:
+    return int(os.environ.get("GEOPEPHUB_S3_MAX_ATTEMPTS") or DEFAULT_S3_MAX_ATTEMPTS)
+
+
+@lru_cache(maxsize=None)
+def get_s3_client():
+    """
+    Get boto3 S3 client
+
+    Created once per process and shared. The connection pool is as large as
+    the number of parts in flight, and every request is retried on its own.
+    :return: boto3 S3 client
+    """
+    return boto3.client(
+        "s3",
+        config=Config(
+            max_pool_connections=_concurrency(),
+            retries={"total_max_attempts": _max_attempts(), "mode": "standard"},
+        ),
+    )
+
+
+def get_transfer_config() -> TransferConfig:
+    """
+    Get multipart transfer settings, from GEOPEPHUB_S3_* environment variables
+
+    :return: TransferConfig
+    """
+    part_size = _part_size()
+    return TransferConfig(
+        multipart_threshold=part_size,
+        multipart_chunksize=part_size,
+        max_concurrency=_concurrency(),
+        num_download_attempts=_max_attempts(),
+        use_threads=True,
+    )
+
+
+def _megabytes(nb_bytes: float) -> str:
+    return f"{nb_bytes / 1024**2:.1f} MB"
+
+
+class TransferProgress:
+    """
+    Progress callback of a transfer, logs progress and throughput
+
+    Called by the transfer threads with the number of bytes of every chunk.
+    """
+
+    def __init__(
+        self,
+        description: str,
+        size: Optional[int] = None,
+        interval: float = S3_PROGRESS_INTERVAL,
+    ):
+        """
+        :param description: what is transferred, e.g. "Uploading x to s3://b/k"
+        :param size: size of the file in bytes, if known
+        :param interval: seconds between progress messages
+        """
+        self.description = description
+        self.size = size
+        self.interval = interval
+        self.transferred = 0
+        self.start = time.monotonic()
+        self._last_log = self.start
+        self._lock = threading.Lock()
+
+    def __call__(self, bytes_amount: int) -> None:
+        with self._lock:
+            self.transferred += bytes_amount
+            now = time.monotonic()
+            if now - self._last_log < self.interval:
+                return
+            self._last_log = now
+            message = self._message(now)
+        _LOGGER.info(message)
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.start
+
+    @property
+    def throughput(self) -> float:
+        """
+        Bytes per second, since the start of the transfer
+        """
+        return self.transferred / max(self.elapsed, 1e-9)
+
+    def _message(self, now: float) -> str:
+        done = _megabytes(self.transferred)
+        if self.size:
+            done += f" of {_megabytes(self.size)} ({self.transferred / self.size:.0%})"
+        speed = self.transferred / max(now - self.start, 1e-9)
+        return f"{self.description}: {done}, {_megabytes(speed)}/s"
+
+    def finish(self) -> float:
+        """
+        Log the summary of the finished transfer
+
+        :return: throughput, in bytes per second
+        """
+        _LOGGER.info(
+            f"{self.description}: {_megabytes(self.transferred)} in "
+            f"{self.elapsed:.1f} s ({_megabytes(self.throughput)}/s)"
+        )
+        return self.throughput
+
+
+def _transfer(direction: str, progress: TransferProgress, method, **kwargs) -> float:
+    method(Config=get_transfer_config(), Callback=progress, **kwargs)
+    throughput = progress.finish()
+    S3_BYTES.inc(progress.transferred, direction=direction)
+    S3_SECONDS.inc(progress.elapsed, direction=direction)
+    return throughput
+
+
+def upload_file(file_name: str, bucket: str, key: str) -> float:
+    """
+    Upload a file to S3, in parallel parts if it is larger than a part
+
+    :param file_name: path of the local file
+    :param bucket: destination bucket
+    :param key: destination key
+    :return: throughput, in bytes per second
+    """
+    progress = TransferProgress(
+        f"Uploading {os.path.basename(file_name)} to s3://{bucket}/{key}",
+        size=os.path.getsize(file_name),
+    )
+    return _transfer(
+        "upload",
+        progress,
+        get_s3_client().upload_file,
+        Filename=file_name,
+        Bucket=bucket,
+        Key=key,
+    )
+
+
+def download_file(bucket: str, key: str, file_name: str) -> float:
+    """
+    Download a file from S3, in parallel ranged parts if it is larger than a part
+
+    :param bucket: source bucket
+    :param key: source key
+    :param file_name: path of the local file
+    :return: throughput, in bytes per second
+    """
+    progress = TransferProgress(f"Downloading s3://{bucket}/{key}")
+    return _transfer(
+        "download",
+        progress,
+        get_s3_client().download_file,
+        Bucket=bucket,
+        Key=key,
+        Filename=file_name,
+    )
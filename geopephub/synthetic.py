@@ -0,0 +1,86 @@
+# Synthetic GEO for the benchmark (see bench.py).
+#
+# SyntheticGeofetcher is unpickled in the geofetch subprocess, which imports
+# this module. It is kept apart from bench.py and imports nothing but peppy,
+# so that the subprocess starts as fast as it does with the real Geofetcher.
+
+import time
+from typing import Dict, List
+
+import peppy
+
+
+class SyntheticGeofetcher:
+    """
+    Stand-in for geofetch.Geofetcher. Picklable, so it runs in the geofetch
+    subprocess like the real one
+    """
+
+    def __init__(self, samples: int = 20, latency: float = 0.0, **kwargs):
+        """
+        :param samples: number of samples in every project
+        :param latency: seconds every GSE takes to "download"
+        :param kwargs: Geofetcher settings, ignored
+        """
+        self.samples = samples
+        self.latency = latency
+
+    def get_projects(self, gse: str) -> Dict[str, peppy.Project]:
+        """
+        Generate the project of the GSE
+
+        :param gse: GSE accession
+        :return: dict {"<gse>_raw": project}, like geofetch returns
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        project = peppy.Project.from_dict(
+            {
+                "_config": {
+                    "pep_version": "2.1.0",
+                    "name": gse,
+                    "description": f"Synthetic project {gse}",
+                    "experiment_metadata": {
+                        "series_title": f"Benchmark series {gse}",
+                        "series_contributor": "Bench,,Mark",
+                    },
+                },
+                "_sample_dict": [
+                    _synthetic_sample(gse, i) for i in range(self.samples)
+                ],
+            }
+        )
+        project.description = f"Synthetic project {gse}"
+        return {f"{gse}_raw": project}
+
+
+def _synthetic_sample(gse: str, i: int) -> dict:
+    gsm = f"GSM{gse[3:]}{i:04d}"
+    return {
+        "sample_name": f"{gse.lower()}_sample_{i}",
+        "sample_geo_accession": gsm,
+        "sample_title": f"{gse} sample {i}",
+        "sample_organism_ch1": "Homo sapiens",
+        "sample_library_strategy": "RNA-Seq",
+        "sample_library_source": "transcriptomic",
+        "sample_characteristics_ch1": f"cell type: line {i % 7}; replicate: {i % 3}",
+        "sample_supplementary_file_1": (
+            f"ftp://ftp.ncbi.nlm.nih.gov/geo/samples/{gsm}/suppl/{gsm}.bed.gz"
+        ),
+    }
+
+
+class SyntheticFinder:
+    """
+    Stand-in for geofetch.Finder, finds the same GSEs in every window
+    """
+
+    def __init__(self, gses: List[str], filters: str = None):
+        """
+        :param gses: GSEs to find
+        :param filters: Finder filters, ignored
+        """
+        self.gses = gses
+
+    def get_gse_by_date(self, start_date: str, end_date: str = None) -> List[str]:
+        return list(self.gses)
@@ -0,0 +1,160 @@
+# Client-side throttling of NCBI requests.
+#
+# NCBI E-utilities allow 3 requests per second per IP (10 with an API key).
+# Every geofetch/Finder call made by this process goes through one shared
+# TokenBucket, so adding upload workers can't push us over that limit.
+# AdaptiveConcurrency sits on top of it and shrinks the number of concurrent
+# geofetch runs when NCBI starts throttling (HTTP 429) or runs time out.
+
+import logging
+import os
+import threading
+import time
+from functools import lru_cache
+from typing import Callable
+
+from geopephub.const import NCBI_RATE_LIMIT, NCBI_RATE_LIMIT_API_KEY
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        capacity: float = None,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        """
+        :param rate: tokens added per second
+        :param capacity: maximum burst size [Default: rate]
+        :param clock: monotonic clock, replaceable in tests
+        :param sleep: sleep function, replaceable in tests
+        """
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = self.capacity
+        self._updated = clock()
+        self._lock = threading.Lock()
+        self.acquired = 0
+        self.waited = 0.0
+
+    def acquire(self, tokens: float = 1) -> float:
+        """
+        Block until tokens are available and take them
+
+        :param tokens: number of tokens (requests) to take
+        :return: number of seconds spent waiting
+        """
+        tokens = min(tokens, self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = self._clock()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                # tolerate float rounding, otherwise the last sleep can be too short
+                if self._tokens >= tokens - 1e-9:
+                    self._tokens = max(0.0, self._tokens - tokens)
+                    self.acquired += tokens
+                    self.waited += waited
+                    return waited
+                delay = (tokens - self._tokens) / self.rate
+            self._sleep(delay)
+            waited += delay
+
+
+class AdaptiveConcurrency:
+    """
+    Concurrency limit with additive increase / multiplicative decrease.
+
+    The limit is halved whenever a call fails with a throttling error and grows
+    by one after `increase_after` successful calls in a row.
+    """
+
+    def __init__(
+        self,
+        max_limit: int,
+        min_limit: int = 1,
+        increase_after: int = 10,
+        is_throttled: Callable[[Exception], bool] = lambda err: False,
+    ):
+        """
+        :param max_limit: upper bound of the limit (and initial limit)
+        :param min_limit: lower bound of the limit
+        :param increase_after: number of successful calls in a row before the limit grows
+        :param is_throttled: predicate, that tells if an exception means we are
+            being throttled
+        """
+        self.max_limit = max(1, max_limit)
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        self.limit = self.max_limit
+        self.increase_after = increase_after
+        self.is_throttled = is_throttled
+        self.throttled = 0
+        self._in_flight = 0
+        self._successes = 0
+        self._condition = threading.Condition()
+
+    def run(self, func: Callable, *args, **kwargs):
+        """
+        Run function once the number of calls in flight is under the limit
+
+        :param func: function to run
+        :return: result of the function
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._in_flight < self.limit)
+            self._in_flight += 1
+        try:
+            result = func(*args, **kwargs)
+        except Exception as err:
+            if self.is_throttled(err):
+                self.record_throttled()
+            raise
+        else:
+            self.record_success()
+            return result
+        finally:
+            with self._condition:
+                self._in_flight -= 1
+                self._condition.notify_all()
+
+    def record_success(self) -> None:
+        with self._condition:
+            self._successes += 1
+            if self._successes >= self.increase_after and self.limit < self.max_limit:
+                self.limit += 1
+                self._successes = 0
+                _LOGGER.info(f"Concurrency limit increased to {self.limit}")
+                self._condition.notify_all()
+
+    def record_throttled(self) -> None:
+        with self._condition:
+            self.throttled += 1
+            self._successes = 0
+            new_limit = max(self.min_limit, self.limit // 2)
+            if new_limit < self.limit:
+                self.limit = new_limit
+                _LOGGER.warning(f"Throttled by NCBI. Concurrency limit reduced to {self.limit}")
+
+
+@lru_cache(maxsize=None)
+def get_ncbi_rate_limiter() -> TokenBucket:
+    """
+    Get the rate limiter shared by all NCBI calls of this process
+
+    The rate is 3 requests/s, or 10 requests/s when NCBI_API_KEY is set.
+    :return: TokenBucket
+    """
+    rate = NCBI_RATE_LIMIT_API_KEY if os.environ.get("NCBI_API_KEY") else NCBI_RATE_LIMIT
+    return TokenBucket(rate=rate)
@@ -0,0 +1,76 @@
+# Per-stage timing of GSE uploads.
+#
+# Every GSE collects its stage durations (in seconds, keys ending in "_s") and
+# sizes in a flat dict, stored in the `stage_metrics` column of its status row:
+#
+#   fetch_s    geofetch run: NCBI rate-limit wait, downloads, SOFT parsing
+#   parse_s    building peppy projects from the geofetch result
+#   prepare_s  description links and comparison with the stored projects
+#   create_s   PEPhub write
+#   status_s   status table writes
+#   samples    number of samples in the fetched projects
+#   bytes      size of the geofetch result
+#
+# When a cycle ends, p50/p95/max of every key over its GSEs is stored in the
+# `stage_summary` column of the cycle.
+
+import math
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List
+
+
+@contextmanager
+def timed(metrics: Dict[str, float], stage: str) -> Iterator[None]:
+    """
+    Add duration of the block to the stage in metrics
+
+    :param metrics: stage metrics of a GSE
+    :param stage: name of the stage, stored as "<stage>_s"
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        key = f"{stage}_s"
+        metrics[key] = round(metrics.get(key, 0) + time.perf_counter() - start, 6)
+
+
+def percentile(values: List[float], q: float) -> float:
+    """
+    Get percentile of the values, with linear interpolation
+
+    :param values: sorted list of values
+    :param q: percentile in range [0, 100]
+    :return: percentile value
+    """
+    position = (len(values) - 1) * q / 100
+    lower = math.floor(position)
+    upper = math.ceil(position)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def summarize_stage_metrics(
+    metrics: Iterable[Dict[str, float]]
+) -> Dict[str, Dict[str, float]]:
+    """
+    Get p50, p95 and max of every stage metric
+
+    :param metrics: stage metrics of the GSEs of a cycle
+    :return: dict {metric: {"n": ..., "p50": ..., "p95": ..., "max": ...}}
+    """
+    values = {}
+    for gse_metrics in metrics:
+        for key, value in gse_metrics.items():
+            values.setdefault(key, []).append(value)
+
+    summary = {}
+    for key, key_values in sorted(values.items()):
+        key_values.sort()
+        summary[key] = {
+            "n": len(key_values),
+            "p50": round(percentile(key_values, 50), 6),
+            "p95": round(percentile(key_values, 95), 6),
+            "max": key_values[-1],
+        }
+    return summary
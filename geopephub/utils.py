@@ -1,12 +1,20 @@
 import time
-import signal
+import multiprocessing
+import multiprocessing.connection
+import pickle
+import re
+import hashlib
+import json
+import threading
 import geofetch
-from typing import Dict
+from geofetch.utils import convert_size
+import requests
+from typing import Dict, List, Optional, Tuple
 import peppy
 from pepdbagent import PEPDatabaseAgent
 import os
 from dotenv import load_dotenv
-from functools import wraps
+from functools import wraps, lru_cache
 import logging
 import tarfile
 import datetime
@@ -17,15 +25,27 @@ from geopephub.const import (
     DEFAULT_POSTGRES_HOST,
     DEFAULT_POSTGRES_DB,
     DEFAULT_POSTGRES_PORT,
-    __name__,
+    DEFAULT_POOL_SIZE,
+    DEFAULT_POOL_MAX_OVERFLOW,
+    GEOFETCH_TIMEOUT,
+    GEOFETCH_NCBI_REQUESTS,
+    DEFAULT_CACHE_DIR,
+    DEFAULT_CACHE_MAX_SIZE,
+    __name__ as PKG_NAME,
 )
-from geopephub.db_utils import BaseEngine
+from geopephub.db_utils import AsyncBaseEngine, BaseEngine
+from geopephub.throttle import TokenBucket
+from geopephub.metrics import count_db_round_trips
+from geopephub.timing import timed
 
 GSE_LINK = "https://www.ncbi.nlm.nih.gov/geo/query/acc.cgi?acc={}"
+# series header only (no samples), used to check the last update date
+GSE_BRIEF_LINK = GSE_LINK + "&targ=self&form=text&view=brief"
+GSE_BRIEF_TIMEOUT = 30
 
 load_dotenv()
 
-_LOGGER = logging.getLogger(__name__)
+_LOGGER = logging.getLogger(PKG_NAME)
 
 
 class FunctionTimeoutError(Exception):
@@ -62,52 +82,381 @@ def calculate_time(func):
     return wrapper
 
 
-# TODO: consider to change it to: https://github.com/pnpnpn/timeout-decorator
-def timeout(seconds_before_timeout=60):
-    def decorate(f):
-        def handler(signum, frame):
-            raise FunctionTimeoutError("Geofetch running time is too long. TimeOut.")
-
-        def new_f(*args, **kwargs):
-            old = signal.signal(signal.SIGALRM, handler)
-            old_time_left = signal.alarm(seconds_before_timeout)
-            if (
-                0 < old_time_left < seconds_before_timeout
-            ):  # never lengthen existing timer
-                signal.alarm(old_time_left)
-            start_time = time.time()
+_MP_CONTEXT = None
+_MP_CONTEXT_LOCK = threading.Lock()
+
+
+def _get_mp_context() -> multiprocessing.context.BaseContext:
+    """
+    Multiprocessing context for geofetch workers.
+
+    Forking a process that already runs threads and holds database connections
+    is unsafe, so workers are started from a clean forkserver (with geofetch
+    and this module, which holds the worker function, preloaded to keep startup
+    cheap) or spawned where forkserver is unavailable.
+    """
+    global _MP_CONTEXT
+    with _MP_CONTEXT_LOCK:
+        if _MP_CONTEXT is None:
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                _MP_CONTEXT = multiprocessing.get_context("forkserver")
+                _MP_CONTEXT.set_forkserver_preload(
+                    ["geofetch", "peppy", "geopephub.utils"]
+                )
+            else:
+                _MP_CONTEXT = multiprocessing.get_context("spawn")
+    return _MP_CONTEXT
+
+
+def _geofetch_worker(
+    conn: multiprocessing.connection.Connection,
+    gse: str,
+    geofetcher_obj: geofetch.Geofetcher,
+) -> None:
+    """
+    Body of the geofetch subprocess. Sends back ("ok", {name: project dict})
+    or ("error", exception) through the pipe.
+    """
+    try:
+        project_dict = geofetcher_obj.get_projects(gse)
+        result = (
+            "ok",
+            {
+                name: project.to_dict(extended=True, orient="records")
+                for name, project in project_dict.items()
+            },
+        )
+    except Exception as err:
+        try:
+            pickle.dumps(err)
+        except Exception:
+            err = RuntimeError(f"{type(err).__name__}: {err}")
+        result = ("error", err)
+    try:
+        conn.send(result)
+    finally:
+        conn.close()
+
+
+def get_gse_last_update_date(gse: str) -> Optional[str]:
+    """
+    Get last update date of the GSE from GEO, without downloading the SOFT file
+
+    :param gse: Projects GSE
+    :return: last update date as reported by GEO (e.g. 'Mar 01 2024'),
+        None if it can't be retrieved
+    """
+    try:
+        response = requests.get(
+            GSE_BRIEF_LINK.format(gse), timeout=GSE_BRIEF_TIMEOUT
+        )
+        response.raise_for_status()
+    except requests.RequestException as err:
+        _LOGGER.warning(f"Unable to get last update date of {gse}: {err}")
+        return None
+    for line in response.text.splitlines():
+        if line.startswith("!Series_last_update_date"):
+            return line.split("=", 1)[1].strip()
+    return None
+
+
+class GeofetchCache:
+    """
+    On-disk, content-addressed cache of geofetch results.
+
+    Entries are keyed by GSE, its GEO last update date and the Geofetcher
+    settings, so a GSE is fetched again as soon as it changes upstream. The
+    least recently used entries are evicted once the cache exceeds max_size.
+    """
+
+    # Geofetcher attributes that change what get_projects returns
+    KEY_ATTRIBUTES = [
+        "processed",
+        "supp_by",
+        "filter_re",
+        "filter_size",
+        "acc_anno",
+        "const_limit_project",
+        "const_limit_discard",
+        "attr_limit_truncate",
+        "max_soft_size",
+    ]
+
+    def __init__(self, cache_dir: str, max_size: int):
+        """
+        :param cache_dir: directory where cached projects are stored
+        :param max_size: maximum size of the cache in bytes
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._size = sum(os.path.getsize(path) for path in self._entries())
+
+    def key(
+        self, gse: str, last_update_date: str, geofetcher_obj: geofetch.Geofetcher
+    ) -> str:
+        """
+        Cache key of the GSE
+
+        :param gse: Projects GSE
+        :param last_update_date: GSE last update date in GEO
+        :param geofetcher_obj: object of Geofetcher class
+        :return: sha256 hex digest
+        """
+        settings = {
+            attribute: repr(getattr(geofetcher_obj, attribute, None))
+            for attribute in self.KEY_ATTRIBUTES
+        }
+        key_str = json.dumps(
+            [gse.lower(), last_update_date, settings, geofetch.__version__],
+            sort_keys=True,
+        )
+        return hashlib.sha256(key_str.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, dict]]:
+        """
+        Get cached projects and mark them as recently used
+
+        :param key: cache key
+        :return: dict {project name: project dict}, None if key is not cached
+        """
+        path = self._path(key)
+        try:
+            with open(path, "r") as f:
+                project_dicts = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return project_dicts
+
+    def size(self, key: str) -> int:
+        """
+        Get size of the cached projects
+
+        :param key: cache key
+        :return: size of the cache entry in bytes, 0 if key is not cached
+        """
+        try:
+            return os.path.getsize(self._path(key))
+        except OSError:
+            return 0
+
+    def put(self, key: str, project_dicts: Dict[str, dict]) -> None:
+        """
+        Store projects in the cache and evict least recently used entries if needed
+
+        :param key: cache key
+        :param project_dicts: dict {project name: project dict}
+        :return: None
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(project_dicts, f)
+        size = os.path.getsize(tmp_path)
+        with self._lock:
             try:
-                result = f(*args, **kwargs)
-            finally:
-                if old_time_left > 0:  # deduct f's run time from the saved timer
-                    old_time_left -= time.time() - start_time
-                signal.signal(signal.SIGALRM, old)
-                signal.alarm(old_time_left)
-            return result
+                old_size = os.path.getsize(path)
+            except OSError:
+                old_size = 0
+            os.replace(tmp_path, path)
+            self._size += size - old_size
+            if self._size > self.max_size:
+                self._evict()
+
+    def _evict(self) -> None:
+        entries = []
+        for path in self._entries():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        self._size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self._size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._size -= size
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
 
-        return new_f
+    def _entries(self) -> List[str]:
+        paths = []
+        for root, _, files in os.walk(self.cache_dir):
+            paths.extend(os.path.join(root, f) for f in files if f.endswith(".json"))
+        return paths
 
-    return decorate
+
+@lru_cache(maxsize=None)
+def get_geofetch_cache() -> Optional[GeofetchCache]:
+    """
+    Get GeofetchCache object
+
+    Location and size are set by GEOPEPHUB_CACHE_DIR and GEOPEPHUB_CACHE_MAX_SIZE
+    environment variables. Setting the size to 0 disables the cache.
+    :return: GeofetchCache, or None if cache is disabled
+    """
+    max_size = convert_size(
+        (os.environ.get("GEOPEPHUB_CACHE_MAX_SIZE") or DEFAULT_CACHE_MAX_SIZE).lower()
+    )
+    if not int(max_size):
+        return None
+    cache_dir = os.path.expanduser(
+        os.environ.get("GEOPEPHUB_CACHE_DIR") or DEFAULT_CACHE_DIR
+    )
+    return GeofetchCache(cache_dir=cache_dir, max_size=int(max_size))
 
 
-@timeout(240)
 def run_geofetch(
-    gse: str, geofetcher_obj: geofetch.Geofetcher = None
+    gse: str,
+    geofetcher_obj: geofetch.Geofetcher = None,
+    timeout: int = GEOFETCH_TIMEOUT,
+    cache: GeofetchCache = None,
+    rate_limiter: TokenBucket = None,
+    ncbi_requests: int = GEOFETCH_NCBI_REQUESTS["geo"],
+    stage_metrics: Dict[str, float] = None,
 ) -> Dict[str, peppy.Project]:
     """
     geofetch wrapped in function
+
+    Geofetch runs in a separate process that is killed once the timeout is
+    reached, so this is safe to call from worker threads. The Geofetcher object
+    is copied into the subprocess and is not modified.
+
     :param gse: Projects GSE
     :param geofetcher_obj: object of Geofetcher class
+    :param timeout: number of seconds before geofetch is killed
+    :param cache: cache of previous geofetch results. GSEs that were not
+        updated in GEO since they were cached are not downloaded again
+    :param rate_limiter: limiter of NCBI requests, shared between threads
+    :param ncbi_requests: estimated number of NCBI requests made by one geofetch
+        run; taken from the rate limiter before geofetch starts
+    :param stage_metrics: stage metrics of the GSE, "fetch" and "parse" durations
+        and size of the result are added to it
     :return: dict of peppys
     """
+    if stage_metrics is None:
+        stage_metrics = {}
     if not geofetcher_obj:
         geofetcher_obj = geofetch.Geofetcher(
             const_limit_discard=1500,
             attr_limit_truncate=1000,
             const_limit_project=200,
         )
-    project_dict = geofetcher_obj.get_projects(gse)
-    return project_dict
+
+    with timed(stage_metrics, "fetch"):
+        project_dicts, size = _fetch_project_dicts(
+            gse, geofetcher_obj, timeout, cache, rate_limiter, ncbi_requests
+        )
+    stage_metrics["bytes"] = size
+    with timed(stage_metrics, "parse"):
+        return _projects_from_dicts(project_dicts)
+
+
+def _fetch_project_dicts(
+    gse: str,
+    geofetcher_obj: geofetch.Geofetcher,
+    timeout: int,
+    cache: Optional[GeofetchCache],
+    rate_limiter: Optional[TokenBucket],
+    ncbi_requests: int,
+) -> Tuple[Dict[str, dict], int]:
+    """
+    Get project dicts of the GSE from the cache, or from geofetch
+
+    :return: dict {project name: project dict} and its size in bytes
+    """
+    cache_key = None
+    if cache:
+        if rate_limiter:
+            rate_limiter.acquire()
+        last_update_date = get_gse_last_update_date(gse)
+        if last_update_date:
+            cache_key = cache.key(gse, last_update_date, geofetcher_obj)
+            cached = cache.get(cache_key)
+            if cached is not None:
+                _LOGGER.info(f"{gse} was not updated since {last_update_date}, using cache")
+                return cached, cache.size(cache_key)
+
+    if rate_limiter:
+        rate_limiter.acquire(ncbi_requests)
+    project_dicts, size = _run_geofetch_subprocess(gse, geofetcher_obj, timeout)
+    # empty results are often transient NCBI failures; don't pin them in the cache
+    if cache_key and project_dicts:
+        cache.put(cache_key, project_dicts)
+    return project_dicts, size
+
+
+_TOO_MANY_REQUESTS_RE = re.compile(r"\b429\b.*Too Many Requests", re.IGNORECASE)
+
+
+def is_throttling_error(err: Exception) -> bool:
+    """
+    Check if exception means that NCBI is throttling us (HTTP 429 or a timeout)
+
+    :param err: exception raised by geofetch or Finder
+    :return: True if the error is caused by throttling
+    """
+    if isinstance(err, (FunctionTimeoutError, requests.Timeout)):
+        return True
+    response = getattr(err, "response", None)
+    if getattr(response, "status_code", None) == 429:
+        return True
+    # geofetch errors may only reach us as text, e.g. when raised in the subprocess
+    return bool(_TOO_MANY_REQUESTS_RE.search(str(err)))
+
+
+def _projects_from_dicts(project_dicts: Dict[str, dict]) -> Dict[str, peppy.Project]:
+    return {name: peppy.Project.from_dict(data) for name, data in project_dicts.items()}
+
+
+def _run_geofetch_subprocess(
+    gse: str, geofetcher_obj: geofetch.Geofetcher, timeout: int
+) -> Tuple[Dict[str, dict], int]:
+    """
+    Run geofetch in a killable subprocess
+
+    :return: dict {project name: project dict} and size of the pickled result
+    """
+    ctx = _get_mp_context()
+    parent_conn, child_conn = ctx.Pipe(duplex=False)
+    process = ctx.Process(
+        target=_geofetch_worker,
+        args=(child_conn, gse, geofetcher_obj),
+        name=f"geofetch-{gse}",
+        daemon=True,
+    )
+    process.start()
+    child_conn.close()
+    try:
+        if not parent_conn.poll(timeout):
+            raise FunctionTimeoutError(
+                f"Geofetch running time is too long (> {timeout} s). TimeOut."
+            )
+        data = parent_conn.recv_bytes()
+        status, payload = pickle.loads(data)
+    except EOFError:
+        process.join()
+        raise RuntimeError(
+            f"Geofetch worker for {gse} exited unexpectedly (exit code {process.exitcode})"
+        )
+    finally:
+        if process.is_alive():
+            process.kill()
+        process.join()
+        parent_conn.close()
+
+    if status == "error":
+        raise payload
+    return payload, len(data)
 
 
 def add_link_to_description(gse: str, pep: peppy.Project) -> peppy.Project:
@@ -126,12 +475,12 @@ def add_link_to_description(gse: str, pep: peppy.Project) -> peppy.Project:
     return pep
 
 
-def get_agent() -> PEPDatabaseAgent:
+def _db_connection_kwargs() -> dict:
     """
-    Get PEPDatabaseAgent object
-    :return: PEPDatabaseAgent
+    Database connection parameters from the environment
+    :return: dict of connection kwargs
     """
-    return PEPDatabaseAgent(
+    return dict(
         user=os.environ.get("POSTGRES_USER") or DEFAULT_POSTGRES_USER,
         password=os.environ.get("POSTGRES_PASSWORD") or DEFAULT_POSTGRES_PASSWORD,
         host=os.environ.get("POSTGRES_HOST") or DEFAULT_POSTGRES_HOST,
@@ -140,18 +489,59 @@ def get_agent() -> PEPDatabaseAgent:
     )
 
 
+@lru_cache(maxsize=None)
+def get_agent() -> PEPDatabaseAgent:
+    """
+    Get PEPDatabaseAgent object
+
+    Created once per process and shared, so every caller uses the same engine
+    and connection pool.
+    :return: PEPDatabaseAgent
+    """
+    agent = PEPDatabaseAgent(**_db_connection_kwargs())
+    count_db_round_trips(agent.pep_db_engine.engine, "pephub")
+    return agent
+
+
+@lru_cache(maxsize=None)
 def get_base_db_engine() -> BaseEngine:
     """
     Get BaseEngine object
+
+    Created once per process and shared, so every caller uses the same engine
+    and connection pool. Pool size is set by POSTGRES_POOL_SIZE and
+    POSTGRES_MAX_OVERFLOW environment variables.
     :return: BaseEngine
     """
-    return BaseEngine(
-        user=os.environ.get("POSTGRES_USER") or DEFAULT_POSTGRES_USER,
-        password=os.environ.get("POSTGRES_PASSWORD") or DEFAULT_POSTGRES_PASSWORD,
-        host=os.environ.get("POSTGRES_HOST") or DEFAULT_POSTGRES_HOST,
-        database=os.environ.get("POSTGRES_DB") or DEFAULT_POSTGRES_DB,
-        port=os.environ.get("POSTGRES_PORT") or DEFAULT_POSTGRES_PORT,
+    engine = BaseEngine(
+        **_db_connection_kwargs(),
+        pool_size=int(os.environ.get("POSTGRES_POOL_SIZE") or DEFAULT_POOL_SIZE),
+        max_overflow=int(
+            os.environ.get("POSTGRES_MAX_OVERFLOW") or DEFAULT_POOL_MAX_OVERFLOW
+        ),
     )
+    count_db_round_trips(engine._engine, "status")
+    return engine
+
+
+def get_async_base_db_engine() -> AsyncBaseEngine:
+    """
+    Get AsyncBaseEngine object
+
+    Not shared: an async engine belongs to the event loop it runs in, so every
+    async run creates its own and disposes it at the end. Pool size is set the
+    same way as in get_base_db_engine.
+    :return: AsyncBaseEngine
+    """
+    engine = AsyncBaseEngine(
+        **_db_connection_kwargs(),
+        pool_size=int(os.environ.get("POSTGRES_POOL_SIZE") or DEFAULT_POOL_SIZE),
+        max_overflow=int(
+            os.environ.get("POSTGRES_MAX_OVERFLOW") or DEFAULT_POOL_MAX_OVERFLOW
+        ),
+    )
+    count_db_round_trips(engine._engine.sync_engine, "status")
+    return engine
 
 
 def create_gse_sub_name(name: str) -> str:
@@ -202,3 +592,31 @@ def date_today(separator: str = "_") -> str:
 
     today_date = datetime.datetime.today()
     return today_date.strftime(f"%Y{separator}%m{separator}%d")
+
+
+def split_period(
+    start_period: str, end_period: str, chunk_days: int
+) -> List[Tuple[str, str]]:
+    """
+    Split period into consecutive windows of at most chunk_days days.
+    Neighbouring windows share the boundary date, like consecutive daily cycles.
+
+    :param start_period: start date of the period [e.g. 2023/02/07]
+    :param end_period: end date of the period [e.g. 2023/05/08]
+    :param chunk_days: maximum length of a window. 0 disables splitting
+    :return: list of (start_period, end_period) windows
+    """
+    start_date = datetime.datetime.strptime(start_period, "%Y/%m/%d")
+    end_date = datetime.datetime.strptime(end_period, "%Y/%m/%d")
+    if chunk_days <= 0 or (end_date - start_date).days <= chunk_days:
+        return [(start_period, end_period)]
+
+    windows = []
+    window_start = start_date
+    while window_start < end_date:
+        window_end = min(window_start + datetime.timedelta(days=chunk_days), end_date)
+        windows.append(
+            (window_start.strftime("%Y/%m/%d"), window_end.strftime("%Y/%m/%d"))
+        )
+        window_start = window_end
+    return windows
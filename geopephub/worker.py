@@ -0,0 +1,105 @@
+# Distributed uploader workers.
+#
+# Any number of `geopephub run-worker` processes, on any number of hosts, can
+# work on the same queue. Each one claims small batches of queued GSEs with
+# SELECT ... FOR UPDATE SKIP LOCKED, keeps its claims alive with a heartbeat,
+# and uploads them like the regular uploader. The worker that finishes the
+# last GSE of a cycle finalizes it. PostgreSQL is the only coordination
+# service.
+
+import datetime
+import logging
+from typing import Dict
+
+import geofetch
+import pepdbagent
+import peppy
+
+from geopephub.const import (
+    GEOFETCH_TIMEOUT,
+    UPLOAD_QUEUE_SIZE,
+    WORKER_BATCH_SIZE,
+    WORKER_LEASE_SECONDS,
+)
+from geopephub.lease import LeaseHeartbeat, make_worker_id
+from geopephub.metageo_pephub import _cycle_stage_summary, _upload_gse_project
+from geopephub.utils import get_agent, get_base_db_engine
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def run_worker(
+    target: str,
+    tag: str = None,
+    batch_size: int = WORKER_BATCH_SIZE,
+    workers: int = 1,
+    geofetch_timeout: int = GEOFETCH_TIMEOUT,
+    queue_size: int = UPLOAD_QUEUE_SIZE,
+    lease_seconds: int = WORKER_LEASE_SECONDS,
+    worker_id: str = None,
+) -> Dict[str, int]:
+    """
+    Claim and upload queued projects in batches, until the queue is empty
+
+    Projects of workers, whose leases expired, are requeued first.
+
+    :param target: Namespace of the projects (bedbase, geo)
+    :param tag: Tag of the projects
+    :param batch_size: number of queued GSEs claimed at once
+    :param workers: number of GSEs downloaded concurrently by this worker
+    :param geofetch_timeout: seconds before geofetch of a single GSE is killed
+    :param queue_size: number of downloaded GSEs that may wait for upload
+    :param lease_seconds: seconds before claimed GSEs are given up, if this
+        worker stops sending heartbeats
+    :param worker_id: id of the worker [Default: host:pid:random]
+    :return: dict with number of processed projects by status
+    """
+    worker_id = worker_id or make_worker_id()
+    _LOGGER.info(f"Time now: {datetime.datetime.now()}")
+    _LOGGER.info(f"Worker id: {worker_id}")
+    _LOGGER.info(f"geofetch version: {geofetch.__version__}")
+    _LOGGER.info(f"pepdbagent version: {pepdbagent.__version__}")
+    _LOGGER.info(f"peppy version: {peppy.__version__}")
+
+    agent = get_agent()
+    status_db_connection = get_base_db_engine()
+
+    total_dict = {"total": 0, "success": 0, "failure": 0, "warning": 0}
+    # GSEs of workers that died go back to the queue
+    status_db_connection.requeue_expired(target)
+
+    heartbeat = LeaseHeartbeat(status_db_connection, worker_id, lease_seconds)
+    heartbeat.start()
+    try:
+        while True:
+            batch = status_db_connection.claim_queued_projects(
+                target, worker_id, batch_size=batch_size, lease_seconds=lease_seconds
+            )
+            if not batch:
+                _LOGGER.info("No queued projects left. Quitting..")
+                break
+
+            status_dict = _upload_gse_project(
+                agent,
+                status_db_connection,
+                batch,
+                target,
+                tag,
+                workers=workers,
+                geofetch_timeout=geofetch_timeout,
+                queue_size=queue_size,
+            )
+            for status, count in status_dict.items():
+                total_dict[status] = total_dict.get(status, 0) + count
+
+            for cycle_id in sorted({model.upload_cycle_id for model in batch}):
+                if status_db_connection.finalize_cycle(cycle_id):
+                    _LOGGER.info(f"Cycle {cycle_id} is finished")
+                    status_db_connection.set_cycle_stage_summary(
+                        cycle_id, _cycle_stage_summary(status_db_connection, cycle_id)
+                    )
+    finally:
+        heartbeat.stop()
+
+    _LOGGER.info(f"\033[32mWorker {worker_id} report: {total_dict}\033[0m")
+    return total_dict
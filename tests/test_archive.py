@@ -1,17 +1,25 @@
-"""Offline tests for the v2 archive builder. No database, no network."""
+"""Offline tests for the v2 archive builder. No network; PEPhub in SQLite."""
 
 import os
 import tarfile
 
 import pytest
 
+import peppy
+from pepdbagent import PEPDatabaseAgent
+from pepdbagent.db_utils import Base
+
+from geopephub import archive, s3
 from geopephub.archive import (
-    count_projects,
-    extract_archive,
+    MANIFEST_MEMBER,
+    diff_manifest,
     gse_shard,
+    live_projects,
+    merge_archive,
     normalize_archive_key,
-    resolve_shards,
+    read_manifest,
 )
+from geopephub.bench import LocalS3
 from geopephub.utils import create_gse_sub_name, tar_folder
 
 
@@ -25,6 +33,15 @@ def make_pep(peps_dir, shard, name):
     return path
 
 
+def tar_members(tar_path):
+    with tarfile.open(tar_path) as tar:
+        return {
+            member.name: tar.extractfile(member).read().decode()
+            for member in tar
+            if member.isfile() and member.name != MANIFEST_MEMBER
+        }
+
+
 class TestGseShard:
     @pytest.mark.parametrize(
         "name,expected",
@@ -81,148 +98,387 @@ class TestNormalizeArchiveKey:
         assert normalize_archive_key(stored) == expected
 
 
-class TestResolveShards:
+def merge_tree(tmp_path, peps):
+    """Tar a peps/ tree the v1 way and merge it with an empty delta."""
+    previous = tar_folder(peps, str(tmp_path / "previous"))
+    delta = tmp_path / "delta" / "peps"
+    delta.mkdir(parents=True, exist_ok=True)
+    output = str(tmp_path / "geo.tar")
+    return merge_archive(previous, str(delta), output), output
+
+
+class TestShardRepair:
     def test_relocates_flat_pile(self, tmp_path):
         """The gsennn pile left by the v1 regression gets redistributed."""
-        peps = str(tmp_path / "peps")
+        peps = str(tmp_path / "gen1" / "peps")
         for name in ["gse100000", "gse100001", "gse271386", "gse12345678"]:
             make_pep(peps, "gsennn", name)
 
-        moved = resolve_shards(peps)
+        stats, output = merge_tree(tmp_path, peps)
 
-        assert moved == 4
-        assert os.path.exists(os.path.join(peps, "gse100nnn", "gse100000.zip"))
-        assert os.path.exists(os.path.join(peps, "gse100nnn", "gse100001.zip"))
-        assert os.path.exists(os.path.join(peps, "gse271nnn", "gse271386.zip"))
-        assert os.path.exists(os.path.join(peps, "gse12345nnn", "gse12345678.zip"))
+        assert stats["relocated"] == 4
+        assert set(tar_members(output)) == {
+            "peps/gse100nnn/gse100000.zip",
+            "peps/gse100nnn/gse100001.zip",
+            "peps/gse271nnn/gse271386.zip",
+            "peps/gse12345nnn/gse12345678.zip",
+        }
 
     def test_leaves_correct_shards_alone(self, tmp_path):
-        peps = str(tmp_path / "peps")
+        peps = str(tmp_path / "gen1" / "peps")
         make_pep(peps, "gse100nnn", "gse100000")
         make_pep(peps, "gse271nnn", "gse271386")
 
-        assert resolve_shards(peps) == 0
+        stats, _ = merge_tree(tmp_path, peps)
+
+        assert stats["relocated"] == 0
+        assert stats["kept"] == 2
 
     def test_short_names_stay_in_gsennn(self, tmp_path):
         """Names of 6 chars or fewer legitimately shard to gsennn."""
-        peps = str(tmp_path / "peps")
+        peps = str(tmp_path / "gen1" / "peps")
         make_pep(peps, "gsennn", "gse123")
         make_pep(peps, "gsennn", "gse1")
 
-        assert resolve_shards(peps) == 0
-        assert os.path.exists(os.path.join(peps, "gsennn", "gse123.zip"))
-        assert os.path.exists(os.path.join(peps, "gsennn", "gse1.zip"))
-
-    def test_idempotent(self, tmp_path):
-        peps = str(tmp_path / "peps")
-        for name in ["gse100000", "gse271386"]:
-            make_pep(peps, "gsennn", name)
-
-        assert resolve_shards(peps) == 2
-        assert resolve_shards(peps) == 0
-
-    def test_preserves_project_count(self, tmp_path):
-        peps = str(tmp_path / "peps")
-        names = ["gse100000", "gse100001", "gse271386", "gse123", "gse12345678"]
-        for name in names:
-            make_pep(peps, "gsennn", name)
+        stats, output = merge_tree(tmp_path, peps)
 
-        before = count_projects(peps)
-        resolve_shards(peps)
-        assert count_projects(peps) == before == len(names)
+        assert stats["relocated"] == 0
+        assert set(tar_members(output)) == {
+            "peps/gsennn/gse123.zip",
+            "peps/gsennn/gse1.zip",
+        }
 
     def test_mixed_tree(self, tmp_path):
         """A real archive: correct shards from Sept 2024 plus a later pile."""
-        peps = str(tmp_path / "peps")
+        peps = str(tmp_path / "gen1" / "peps")
         make_pep(peps, "gse100nnn", "gse100000")
         make_pep(peps, "gse271nnn", "gse271386")
         make_pep(peps, "gsennn", "gse250000")
         make_pep(peps, "gsennn", "gse260000")
 
-        assert resolve_shards(peps) == 2
-        assert count_projects(peps) == 4
-        assert os.path.exists(os.path.join(peps, "gse250nnn", "gse250000.zip"))
-        assert os.path.exists(os.path.join(peps, "gse100nnn", "gse100000.zip"))
+        stats, output = merge_tree(tmp_path, peps)
 
+        assert stats["relocated"] == 2
+        assert stats["projects"] == 4
+        assert set(tar_members(output)) == {
+            "peps/gse100nnn/gse100000.zip",
+            "peps/gse271nnn/gse271386.zip",
+            "peps/gse250nnn/gse250000.zip",
+            "peps/gse260nnn/gse260000.zip",
+        }
 
-class TestCountProjects:
-    def test_counts_recursively(self, tmp_path):
-        peps = str(tmp_path / "peps")
-        make_pep(peps, "gse100nnn", "gse100000")
-        make_pep(peps, "gse100nnn", "gse100001")
-        make_pep(peps, "gse271nnn", "gse271386")
-
-        assert count_projects(peps) == 3
-
-    def test_ignores_non_zip(self, tmp_path):
-        peps = str(tmp_path / "peps")
-        make_pep(peps, "gse100nnn", "gse100000")
-        with open(os.path.join(peps, "gse100nnn", "README.md"), "w") as f:
-            f.write("not a pep")
+    def test_idempotent(self, tmp_path):
+        peps = str(tmp_path / "gen1" / "peps")
+        for name in ["gse100000", "gse271386"]:
+            make_pep(peps, "gsennn", name)
+        stats, output = merge_tree(tmp_path, peps)
+        assert stats["relocated"] == 2
 
-        assert count_projects(peps) == 1
+        empty = tmp_path / "empty" / "peps"
+        empty.mkdir(parents=True)
+        stats = merge_archive(output, str(empty), str(tmp_path / "again.tar"))
 
-    def test_empty_tree(self, tmp_path):
-        peps = str(tmp_path / "peps")
-        os.makedirs(peps)
-        assert count_projects(peps) == 0
+        assert stats["relocated"] == 0
+        assert stats["kept"] == 2
 
 
 class TestArchiveRoundTrip:
-    def test_tar_then_extract(self, tmp_path):
-        """tar_folder (v1) output must be readable by extract_archive (v2)."""
-        source = tmp_path / "source"
-        peps = str(source / "peps")
+    def test_tar_then_merge(self, tmp_path):
+        """tar_folder (v1) output must be readable by merge_archive (v2)."""
+        peps = str(tmp_path / "gen1" / "peps")
         names = ["gse100000", "gse100001", "gse271386"]
         for name in names:
             make_pep(peps, gse_shard(name), name)
 
-        tar_path = tar_folder(peps, str(tmp_path / "geo_2026_07_31"))
-        assert tar_path.endswith(".tar")
+        stats, output = merge_tree(tmp_path, peps)
 
-        extracted_root = tmp_path / "extracted"
-        peps_out = extract_archive(tar_path, str(extracted_root))
-
-        assert os.path.basename(peps_out) == "peps"
-        assert count_projects(peps_out) == len(names)
-        for name in names:
-            assert os.path.exists(os.path.join(peps_out, gse_shard(name), f"{name}.zip"))
+        assert stats["projects"] == stats["kept"] == len(names)
+        assert tar_members(output) == {
+            f"peps/{gse_shard(name)}/{name}.zip": name for name in names
+        }
+        assert len(read_manifest(output)) == len(names)
 
     def test_round_trip_is_stable_across_generations(self, tmp_path):
-        """Extract, add a project, re-tar, extract again -- the update cycle."""
+        """Merge a delta into the previous archive, twice -- the update cycle."""
         peps = str(tmp_path / "gen1" / "peps")
         make_pep(peps, "gse100nnn", "gse100000")
         tar1 = tar_folder(peps, str(tmp_path / "gen1_archive"))
 
-        gen2 = tmp_path / "gen2"
-        peps2 = extract_archive(tar1, str(gen2))
-        make_pep(peps2, "gse271nnn", "gse271386")
-        tar2 = tar_folder(peps2, str(tmp_path / "gen2_archive"))
+        delta2 = str(tmp_path / "delta2" / "peps")
+        make_pep(delta2, "gse271nnn", "gse271386")
+        tar2 = str(tmp_path / "gen2.tar")
+        merge_archive(tar1, delta2, tar2)
 
-        gen3 = tmp_path / "gen3"
-        peps3 = extract_archive(tar2, str(gen3))
+        delta3 = tmp_path / "delta3" / "peps"
+        delta3.mkdir(parents=True)
+        tar3 = str(tmp_path / "gen3.tar")
+        stats = merge_archive(tar2, str(delta3), tar3)
 
-        assert count_projects(peps3) == 2
-        assert os.path.exists(os.path.join(peps3, "gse100nnn", "gse100000.zip"))
-        assert os.path.exists(os.path.join(peps3, "gse271nnn", "gse271386.zip"))
+        assert stats["projects"] == 2
+        assert set(tar_members(tar3)) == {
+            "peps/gse100nnn/gse100000.zip",
+            "peps/gse271nnn/gse271386.zip",
+        }
+
+    def test_rejects_path_traversal(self, tmp_path):
+        tar_path = str(tmp_path / "evil.tar")
+        payload = tmp_path / "payload"
+        payload.write_text("x")
+        with tarfile.open(tar_path, "w") as tar:
+            tar.add(str(payload), arcname="peps/../../escaped.zip")
+        delta = tmp_path / "delta" / "peps"
+        delta.mkdir(parents=True)
+
+        with pytest.raises(ValueError, match="escapes"):
+            merge_archive(tar_path, str(delta), str(tmp_path / "geo.tar"))
+        assert not (tmp_path.parent / "escaped.zip").exists()
+
+
+class TestMergeArchive:
+    def test_cold_start(self, tmp_path):
+        delta = str(tmp_path / "delta" / "peps")
+        make_pep(delta, "gse100nnn", "gse100000")
+        make_pep(delta, "gse271nnn", "gse271386")
+        output = str(tmp_path / "geo.tar")
+
+        stats = merge_archive(None, delta, output)
+
+        assert stats == {
+            "projects": 2,
+            "kept": 0,
+            "replaced": 0,
+            "added": 2,
+            "dropped": 0,
+            "relocated": 0,
+        }
+        assert tar_members(output) == {
+            "peps/gse100nnn/gse100000.zip": "gse100000",
+            "peps/gse271nnn/gse271386.zip": "gse271386",
+        }
+
+    def test_replaces_adds_and_relocates(self, tmp_path):
+        peps = str(tmp_path / "gen1" / "peps")
+        make_pep(peps, "gse100nnn", "gse100000")
+        make_pep(peps, "gse100nnn", "gse100001")
+        make_pep(peps, "gsennn", "gse250000")
+        previous = tar_folder(peps, str(tmp_path / "previous"))
+
+        delta = str(tmp_path / "delta" / "peps")
+        path = make_pep(delta, "gse100nnn", "gse100001")
+        with open(path, "w") as f:
+            f.write("revised")
+        make_pep(delta, "gse271nnn", "gse271386")
+        output = str(tmp_path / "geo.tar")
+
+        stats = merge_archive(previous, delta, output)
+
+        assert stats == {
+            "projects": 4,
+            "kept": 2,
+            "replaced": 1,
+            "added": 1,
+            "dropped": 0,
+            "relocated": 1,
+        }
+        assert tar_members(output) == {
+            "peps/gse100nnn/gse100000.zip": "gse100000",
+            "peps/gse100nnn/gse100001.zip": "revised",
+            "peps/gse250nnn/gse250000.zip": "gse250000",
+            "peps/gse271nnn/gse271386.zip": "gse271386",
+        }
+
+    def test_output_may_overwrite_previous(self, tmp_path):
+        peps = str(tmp_path / "gen1" / "peps")
+        make_pep(peps, "gse100nnn", "gse100000")
+        previous = tar_folder(peps, str(tmp_path / "geo_2026_07_31"))
+        delta = str(tmp_path / "delta" / "peps")
+        make_pep(delta, "gse271nnn", "gse271386")
+
+        stats = merge_archive(previous, delta, previous)
+
+        assert stats["projects"] == 2
+        assert set(tar_members(previous)) == {
+            "peps/gse100nnn/gse100000.zip",
+            "peps/gse271nnn/gse271386.zip",
+        }
+        assert not os.path.exists(f"{previous}.part")
 
     def test_rejects_unexpected_layout(self, tmp_path):
-        """A tar not rooted at peps/ must be refused, not silently built upon."""
         stray = tmp_path / "elsewhere"
         stray.mkdir()
         (stray / "gse100000.zip").write_text("x")
-
-        tar_path = tar_folder(str(stray), str(tmp_path / "bad"))
+        previous = tar_folder(str(stray), str(tmp_path / "bad"))
+        delta = tmp_path / "delta" / "peps"
+        delta.mkdir(parents=True)
 
         with pytest.raises(ValueError, match="not rooted at"):
-            extract_archive(tar_path, str(tmp_path / "out"))
+            merge_archive(previous, str(delta), str(tmp_path / "geo.tar"))
 
-    def test_rejects_path_traversal(self, tmp_path):
-        tar_path = str(tmp_path / "evil.tar")
-        payload = tmp_path / "payload"
-        payload.write_text("x")
-        with tarfile.open(tar_path, "w") as tar:
-            tar.add(str(payload), arcname="peps/../../escaped.zip")
+    def test_drops_and_writes_manifest(self, tmp_path):
+        peps = str(tmp_path / "gen1" / "peps")
+        make_pep(peps, "gse100nnn", "gse100000")
+        make_pep(peps, "gse100nnn", "gse100001")
+        previous = tar_folder(peps, str(tmp_path / "previous"))
+        delta = str(tmp_path / "delta" / "peps")
+        make_pep(delta, "gse271nnn", "gse271386")
+        output = str(tmp_path / "geo.tar")
+
+        stats = merge_archive(
+            previous,
+            delta,
+            output,
+            drop=["peps/gse100nnn/gse100001.zip"],
+            projects={
+                "peps/gse271nnn/gse271386.zip": {
+                    "name": "gse271386",
+                    "tag": "default",
+                    "digest": "abc",
+                }
+            },
+        )
+
+        assert stats["dropped"] == 1
+        assert set(tar_members(output)) == {
+            "peps/gse100nnn/gse100000.zip",
+            "peps/gse271nnn/gse271386.zip",
+        }
+        manifest = read_manifest(output)
+        assert manifest["peps/gse271nnn/gse271386.zip"]["digest"] == "abc"
+        assert manifest["peps/gse100nnn/gse100000.zip"]["name"] == "gse100000"
+        with tarfile.open(output) as tar:
+            for path, entry in manifest.items():
+                tar.fileobj.seek(entry["offset"])
+                member = tarfile.TarInfo.fromtarfile(tar)
+                assert member.name == path
+                assert member.size == entry["size"]
+
+    def test_manifest_is_replaced(self, tmp_path):
+        delta = str(tmp_path / "delta" / "peps")
+        make_pep(delta, "gse100nnn", "gse100000")
+        first = str(tmp_path / "first.tar")
+        merge_archive(None, delta, first)
+        empty = tmp_path / "empty" / "peps"
+        empty.mkdir(parents=True)
+        second = str(tmp_path / "second.tar")
+
+        merge_archive(first, str(empty), second)
+
+        with tarfile.open(second) as tar:
+            names = tar.getnames()
+        assert names.count(MANIFEST_MEMBER) == 1
+        assert names[-1] == MANIFEST_MEMBER
+        assert list(read_manifest(second)) == ["peps/gse100nnn/gse100000.zip"]
+
+    def test_legacy_archive_has_no_manifest(self, tmp_path):
+        peps = str(tmp_path / "peps")
+        make_pep(peps, "gse100nnn", "gse100000")
 
-        with pytest.raises(ValueError):
-            extract_archive(tar_path, str(tmp_path / "out"))
+        assert read_manifest(tar_folder(peps, str(tmp_path / "legacy"))) is None
+
+
+class TestDiffManifest:
+    def test_live_projects_prefers_default_tag(self):
+        live = live_projects(
+            {
+                ("gse100000", "raw"): "a",
+                ("gse100000", "default"): "b",
+                ("gse271386", "samples"): "c",
+                ("gse271386", "raw"): "d",
+            }
+        )
+
+        assert live == {
+            "peps/gse100nnn/gse100000.zip": {
+                "name": "gse100000",
+                "tag": "default",
+                "digest": "b",
+            },
+            "peps/gse271nnn/gse271386.zip": {
+                "name": "gse271386",
+                "tag": "raw",
+                "digest": "d",
+            },
+        }
+
+    def test_diff(self):
+        previous = {
+            "peps/gsennn/gse1.zip": {"digest": "same"},
+            "peps/gsennn/gse2.zip": {"digest": "old"},
+            "peps/gsennn/gse3.zip": {"digest": "deleted"},
+            "peps/gsennn/gse5.zip": {"digest": "same"},
+        }
+        live = {
+            "peps/gsennn/gse1.zip": {"digest": "same"},
+            "peps/gsennn/gse2.zip": {"digest": "new"},
+            "peps/gsennn/gse4.zip": {"digest": "added"},
+            "peps/gsennn/gse5.zip": {"digest": "same"},
+        }
+
+        fetch, drop = diff_manifest(previous, live, updated=["peps/gsennn/gse5.zip"])
+
+        assert fetch == [
+            "peps/gsennn/gse2.zip",
+            "peps/gsennn/gse4.zip",
+            "peps/gsennn/gse5.zip",
+        ]
+        assert drop == ["peps/gsennn/gse3.zip"]
+
+
+class TestBuildArchive:
+    @pytest.fixture
+    def agent(self, tmp_path, monkeypatch):
+        agent = PEPDatabaseAgent(dsn=f"sqlite:///{tmp_path / 'pephub.db'}")
+        Base.metadata.create_all(agent.pep_db_engine.engine)
+        monkeypatch.setattr(archive, "get_agent", lambda: agent)
+        local_s3 = LocalS3(str(tmp_path / "s3"))
+        monkeypatch.setattr(s3, "get_s3_client", lambda: local_s3)
+        return agent
+
+    @staticmethod
+    def store(agent, name, value=1):
+        project = peppy.Project.from_dict(
+            {
+                "_config": {"pep_version": "2.1.0"},
+                "_sample_dict": [{"sample_name": "s1", "value": value}],
+            }
+        )
+        agent.project.create(
+            project, namespace="geo", name=name, tag="default", overwrite=True
+        )
+
+    def build(self, tmp_path, run, monkeypatch, agent):
+        fetched = []
+        get = agent.project.get
+
+        def _get(**kwargs):
+            fetched.append(kwargs["name"])
+            return get(**kwargs)
+
+        monkeypatch.setattr(agent.project, "get", _get)
+        tar_path = archive.build_archive(
+            workdir=str(tmp_path / run), workers=2, bucket="test"
+        )
+        return tar_path, sorted(fetched)
+
+    def test_reconciles_with_live_namespace(self, tmp_path, monkeypatch, agent):
+        for name in ["gse100000", "gse100001", "gse100002"]:
+            self.store(agent, name)
+        tar_path, fetched = self.build(tmp_path, "first", monkeypatch, agent)
+        assert fetched == ["gse100000", "gse100001", "gse100002"]
+        assert len(read_manifest(tar_path)) == 3
+
+        self.store(agent, "gse100001", value=2)
+        agent.project.delete(namespace="geo", name="gse100002", tag="default")
+        self.store(agent, "gse271386")
+        tar_path, fetched = self.build(tmp_path, "second", monkeypatch, agent)
+
+        assert fetched == ["gse100001", "gse271386"]
+        manifest = read_manifest(tar_path)
+        assert sorted(entry["name"] for entry in manifest.values()) == [
+            "gse100000",
+            "gse100001",
+            "gse271386",
+        ]
+        with tarfile.open(tar_path) as tar:
+            archived = {name for name in tar.getnames() if name.endswith(".zip")}
+        assert archived == set(manifest)
@@ -0,0 +1,122 @@
+"""Offline tests of the asyncio uploader. geofetch, PEPhub and status db are faked."""
+
+import asyncio
+
+import pytest
+
+from geopephub import async_uploader, metageo_pephub
+from geopephub.db_utils import AsyncBaseEngine
+from geopephub.models import StatusModel
+
+from test_uploader import FakeAgent, FakeLogConnection, fake_geofetch, make_logs
+
+
+class FakeAsyncLogConnection(FakeLogConnection):
+    async def upload_project_log(self, model: StatusModel) -> StatusModel:
+        await asyncio.sleep(0)
+        return super().upload_project_log(model)
+
+
+async def aiter_logs(gses):
+    for gse_log in make_logs(gses):
+        await asyncio.sleep(0)
+        yield gse_log
+
+
+@pytest.fixture
+def fake_async_geofetch(fake_geofetch, monkeypatch):
+    monkeypatch.setattr(async_uploader, "run_geofetch", metageo_pephub.run_geofetch)
+    monkeypatch.setattr(async_uploader, "get_geofetch_cache", lambda: None)
+
+
+def upload_async(agent, log_connection, gses, **kwargs):
+    return asyncio.run(
+        async_uploader._upload_gse_project_async(
+            agent, log_connection, aiter_logs(gses), "geo", **kwargs
+        )
+    )
+
+
+@pytest.mark.parametrize("workers, in_flight", [(1, 1), (2, 5), (4, 200)])
+def test_matches_sync_uploader(fake_async_geofetch, workers, in_flight):
+    gses = [f"GSE1000{i}" for i in range(10)]
+    sync_agent = FakeAgent(fail_names=["GSE10003"])
+    sync_log = FakeLogConnection()
+    async_agent = FakeAgent(fail_names=["GSE10003"])
+    async_log = FakeAsyncLogConnection()
+
+    sync_status = metageo_pephub._upload_gse_project(
+        sync_agent, sync_log, make_logs(gses), "geo", workers=workers
+    )
+    async_status = upload_async(
+        async_agent, async_log, gses, workers=workers, in_flight=in_flight
+    )
+
+    assert async_status == sync_status
+    assert sorted(async_agent.project.created) == sorted(sync_agent.project.created)
+    for gse in gses:
+        assert [
+            log.model_dump(exclude={"stage_metrics"}) for log in async_log.writes[gse]
+        ] == [log.model_dump(exclude={"stage_metrics"}) for log in sync_log.writes[gse]]
+        # durations differ between runs, the measured stages don't
+        assert (
+            async_log.writes[gse][-1].stage_metrics.keys()
+            == sync_log.writes[gse][-1].stage_metrics.keys()
+        )
+
+
+def test_in_flight_is_bounded(fake_async_geofetch):
+    gses = [f"GSE2000{i:02d}" for i in range(30)]
+    consumed = []
+
+    async def counted_logs():
+        async for gse_log in aiter_logs(gses):
+            consumed.append(gse_log.gse)
+            yield gse_log
+
+    class InFlightLogConnection(FakeAsyncLogConnection):
+        max_ahead = 0
+
+        async def upload_project_log(self, model):
+            finished = sum(
+                log.status != "processing"
+                for writes in self.writes.values()
+                for log in writes[-1:]
+            )
+            self.max_ahead = max(self.max_ahead, len(consumed) - finished)
+            return await super().upload_project_log(model)
+
+    log_connection = InFlightLogConnection()
+    status_dict = asyncio.run(
+        async_uploader._upload_gse_project_async(
+            FakeAgent(), log_connection, counted_logs(), "geo", in_flight=3
+        )
+    )
+
+    assert status_dict["total"] == 30
+    # the next GSE is read, while it waits for a free slot
+    assert log_connection.max_ahead <= 3 + 1
+
+
+def test_log_stream_error_is_raised(fake_async_geofetch):
+    async def broken_logs():
+        async for gse_log in aiter_logs(["GSE10002", "GSE10003"]):
+            yield gse_log
+        raise ConnectionError("server closed the connection unexpectedly")
+
+    log_connection = FakeAsyncLogConnection()
+    with pytest.raises(ConnectionError):
+        asyncio.run(
+            async_uploader._upload_gse_project_async(
+                FakeAgent(), log_connection, broken_logs(), "geo"
+            )
+        )
+    # GSEs read before the error are finished
+    assert log_connection.writes["GSE10002"][-1].status == "success"
+
+
+def test_async_engine_uses_async_driver():
+    engine = AsyncBaseEngine(user="user", password="password")
+
+    assert engine._engine.dialect.is_async
+    assert engine._engine.dialect.driver == "psycopg"
@@ -0,0 +1,36 @@
+"""Offline test of the benchmark harness, on a handful of synthetic GSEs."""
+
+import os
+
+import geofetch
+
+from geopephub import s3
+from geopephub.bench import BENCH_BUCKET, run_bench
+from geopephub.synthetic import SyntheticGeofetcher
+
+
+def test_synthetic_geofetcher():
+    projects = SyntheticGeofetcher(samples=3).get_projects("GSE123")
+
+    (name,) = projects
+    assert name == "GSE123_raw"
+    assert len(projects[name].samples) == 3
+    assert projects[name].description == "Synthetic project GSE123"
+
+
+def test_run_bench(tmp_path):
+    geofetcher_class = geofetch.Geofetcher
+    get_s3_client = s3.get_s3_client
+
+    results = run_bench(gses=6, samples=3, latency=0, workers=2, workdir=str(tmp_path))
+
+    assert results["queuer"]["gses"] == 6
+    assert results["uploader"]["statuses"] == {"success": 6}
+    assert results["uploader"]["gse_per_second"] > 0
+    assert results["archive_cold"]["projects"] == 6
+    assert results["archive_incremental"]["projects"] == 6
+    assert results["archive_cold"]["mb_per_second"] > 0
+    assert os.listdir(tmp_path / "s3" / BENCH_BUCKET / "geo")
+    # stand-ins are removed
+    assert geofetch.Geofetcher is geofetcher_class
+    assert s3.get_s3_client is get_s3_client
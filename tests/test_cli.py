@@ -0,0 +1,52 @@
+"""Offline tests for the command line options of the checker commands."""
+
+import pytest
+from typer.testing import CliRunner
+
+from geopephub import cli, metageo_pephub
+
+
+@pytest.fixture
+def checked(monkeypatch):
+    calls = []
+    monkeypatch.delenv("GEOPEPHUB_METRICS_FILE", raising=False)
+    monkeypatch.setattr(
+        metageo_pephub, "check_by_date", lambda **kwargs: calls.append(kwargs)
+    )
+    monkeypatch.setattr(
+        cli, "check_by_date_function", lambda **kwargs: calls.append(kwargs)
+    )
+    return calls
+
+
+def invoke(*args):
+    result = CliRunner().invoke(cli.app, list(args))
+    assert result.exit_code == 0, result.output
+    return result
+
+
+def test_check_by_date(checked):
+    invoke(
+        "check-by-date",
+        "--target",
+        "geo",
+        "--start-period",
+        "2024/01/01",
+        "--end-period",
+        "2024/03/01",
+        "--chunk-days",
+        "14",
+    )
+
+    (kwargs,) = checked
+    assert kwargs["start_period"] == "2024/01/01"
+    assert kwargs["end_period"] == "2024/03/01"
+    assert kwargs["chunk_days"] == 14
+
+
+def test_run_checker_passes_chunk_days(checked):
+    invoke("run-checker", "--target", "geo", "--period", "30", "--chunk-days", "7")
+
+    (kwargs,) = checked
+    assert kwargs["target"] == "geo"
+    assert kwargs["chunk_days"] == 7
@@ -0,0 +1,317 @@
+"""Offline tests for the status tables, run against a throwaway SQLite file."""
+
+import datetime
+import time
+
+import pytest
+from sqlalchemy import inspect, select, text
+from sqlalchemy.orm import Session
+
+from geopephub.const import CYCLE_TABLE_NAME, STATUS_TABLE_NAME
+from geopephub import metageo_pephub
+from geopephub.db_utils import BaseEngine, CycleModelSA, ProjectModelSA
+from geopephub.models import CycleModel, StatusModel
+
+HOUR = datetime.timedelta(hours=1)
+
+
+@pytest.fixture
+def db(tmp_path):
+    engine = BaseEngine(dsn=f"sqlite:///{tmp_path / 'status.db'}")
+    engine.create_schema()
+    return engine
+
+
+def make_cycle(db, status="queued", target="geo"):
+    return db.update_upload_cycle(
+        CycleModel(
+            target=target,
+            status=status,
+            start_period="2024/01/01",
+            end_period="2024/01/02",
+        )
+    )
+
+
+def queued_logs(cycle_id, gses, target="geo"):
+    return [
+        StatusModel(
+            gse=gse,
+            target=target,
+            log_stage=0,
+            status="queued",
+            registry_path=f"{target}/{gse}:default",
+            upload_cycle_id=cycle_id,
+        )
+        for gse in gses
+    ]
+
+
+class TestUploadProjectLogs:
+    def test_assigns_ids_in_order(self, db):
+        cycle = make_cycle(db)
+        gses = [f"GSE{i}" for i in range(100, 150)]
+
+        models = db.upload_project_logs(queued_logs(cycle.id, gses))
+
+        assert [m.gse for m in models] == gses
+        assert all(m.id for m in models)
+        with Session(db._engine) as session:
+            rows = session.execute(
+                select(ProjectModelSA.id, ProjectModelSA.gse)
+            ).all()
+        assert {row.id: row.gse for row in rows} == {m.id: m.gse for m in models}
+
+    def test_rows_are_queued(self, db):
+        cycle = make_cycle(db)
+        db.upload_project_logs(queued_logs(cycle.id, ["GSE1", "GSE2"]))
+
+        queued = db.get_queued_project(cycle.id)
+        assert sorted(m.gse for m in queued) == ["GSE1", "GSE2"]
+        assert all(m.registry_path == f"geo/{m.gse}:default" for m in queued)
+
+    def test_empty_list(self, db):
+        assert db.upload_project_logs([]) == []
+
+
+class TestUpsert:
+    def test_project_log_insert_then_update(self, db):
+        cycle = make_cycle(db)
+        model = db.upload_project_log(queued_logs(cycle.id, ["GSE1"])[0])
+        assert model.id
+
+        model.status = "success"
+        model.log_stage = 3
+        db.upload_project_log(model)
+
+        with Session(db._engine) as session:
+            row = session.get(ProjectModelSA, model.id)
+            assert (row.status, row.log_stage) == ("success", 3)
+
+    def test_missing_project_log_raises(self, db):
+        model = queued_logs(1, ["GSE1"])[0]
+        model.id = 12345
+        with pytest.raises(ValueError, match="does not exists"):
+            db.upload_project_log(model)
+
+    def test_cycle_insert_then_update(self, db):
+        cycle = make_cycle(db, status="initial")
+        assert cycle.id
+
+        cycle.status = "queued"
+        cycle.number_of_projects = 7
+        db.update_upload_cycle(cycle)
+
+        queued = db.get_queued_cycle(target="geo")
+        assert [(c.id, c.number_of_projects) for c in queued] == [(cycle.id, 7)]
+
+    def test_missing_cycle_raises(self, db):
+        cycle = CycleModel(id=999, target="geo", status="queued")
+        with pytest.raises(ValueError, match="does not exists"):
+            db.update_upload_cycle(cycle)
+
+    def test_exists(self, db):
+        cycle = make_cycle(db)
+        model = db.upload_project_log(queued_logs(cycle.id, ["GSE1"])[0])
+        assert db.cycle_exists(cycle.id)
+        assert not db.cycle_exists(cycle.id + 1)
+        assert db.project_status_exists(model.id)
+        assert not db.project_status_exists(model.id + 1)
+
+
+class TestCycleStatusCounts:
+    def test_counts_by_status(self, db):
+        cycle = make_cycle(db)
+        other = make_cycle(db)
+        models = db.upload_project_logs(queued_logs(cycle.id, [f"GSE{i}" for i in range(6)]))
+        db.upload_project_logs(queued_logs(other.id, ["GSE100"]))
+        for model, status in zip(models, ["success", "success", "failure", "warning"]):
+            model.status = status
+            db.upload_project_log(model)
+
+        assert db.get_cycle_status_counts(cycle.id) == {
+            "success": 2,
+            "failure": 1,
+            "warning": 1,
+            "queued": 2,
+        }
+        assert db.get_number_samples_success(cycle.id) == 2
+        assert db.get_number_samples_failures(cycle.id) == 1
+        assert db.get_number_samples_warnings(cycle.id) == 1
+        assert db.get_cycle_status_counts(other.id) == {"queued": 1}
+
+    def test_empty_cycle(self, db):
+        cycle = make_cycle(db)
+        assert db.get_cycle_status_counts(cycle.id) == {}
+        assert db.get_number_samples_success(cycle.id) == 0
+
+
+class TestStageMetrics:
+    def test_summary_of_cycle(self, db):
+        cycle = make_cycle(db, status="processing")
+        models = db.upload_project_logs(queued_logs(cycle.id, ["GSE1", "GSE2", "GSE3"]))
+        for model, fetch_s in zip(models[:2], [1.0, 3.0]):
+            model.status = "success"
+            model.stage_metrics = {"fetch_s": fetch_s, "samples": 4}
+            db.upload_project_log(model)
+
+        assert list(db.iter_stage_metrics(cycle.id)) == [
+            {"fetch_s": 1.0, "samples": 4},
+            {"fetch_s": 3.0, "samples": 4},
+        ]
+
+        metageo_pephub._set_cycle_counters(db, cycle)
+        db.update_upload_cycle(cycle)
+
+        with Session(db._engine) as session:
+            stored = session.scalar(
+                select(CycleModelSA.stage_summary).where(CycleModelSA.id == cycle.id)
+            )
+        assert stored["fetch_s"] == {"n": 2, "p50": 2.0, "p95": 2.9, "max": 3.0}
+        assert stored["samples"]["n"] == 2
+
+
+class TestIndexes:
+    def test_created_with_tables(self, db):
+        inspector = inspect(db._engine)
+        assert {i["name"] for i in inspector.get_indexes(STATUS_TABLE_NAME)} == {
+            f"ix_{STATUS_TABLE_NAME}_cycle_status",
+            f"ix_{STATUS_TABLE_NAME}_worker_id",
+            f"ix_{STATUS_TABLE_NAME}_status_lease",
+            f"ix_{STATUS_TABLE_NAME}_target_gse",
+        }
+        assert {i["name"] for i in inspector.get_indexes(CYCLE_TABLE_NAME)} == {
+            f"ix_{CYCLE_TABLE_NAME}_target_period",
+            f"ix_{CYCLE_TABLE_NAME}_status_target",
+        }
+
+    def test_added_to_existing_tables(self, db):
+        """Deployments created before the indexes existed get them on the next run."""
+        with db._engine.begin() as connection:
+            for table in [STATUS_TABLE_NAME, CYCLE_TABLE_NAME]:
+                for index in inspect(connection).get_indexes(table):
+                    connection.execute(text(f"DROP INDEX {index['name']}"))
+        assert inspect(db._engine).get_indexes(STATUS_TABLE_NAME) == []
+
+        db.create_schema()
+        db.create_schema()
+
+        columns = {
+            i["name"]: i["column_names"]
+            for i in inspect(db._engine).get_indexes(STATUS_TABLE_NAME)
+        }
+        assert columns[f"ix_{STATUS_TABLE_NAME}_cycle_status"] == [
+            "upload_cycle_id",
+            "status",
+        ]
+        assert len(inspect(db._engine).get_indexes(CYCLE_TABLE_NAME)) == 2
+
+
+class TestMissingColumns:
+    def test_added_to_existing_tables(self, db):
+        """Deployments created before a column existed get it on the next run."""
+        with db._engine.begin() as connection:
+            connection.execute(text(f"DROP INDEX ix_{STATUS_TABLE_NAME}_worker_id"))
+            connection.execute(
+                text(f"ALTER TABLE {STATUS_TABLE_NAME} DROP COLUMN worker_id")
+            )
+        assert "worker_id" not in {
+            c["name"] for c in inspect(db._engine).get_columns(STATUS_TABLE_NAME)
+        }
+
+        db.create_schema()
+        db.create_schema()
+
+        assert "worker_id" in {
+            c["name"] for c in inspect(db._engine).get_columns(STATUS_TABLE_NAME)
+        }
+
+
+class TestStreaming:
+    def test_iter_queued_project(self, db):
+        cycle = make_cycle(db)
+        gses = [f"GSE{i}" for i in range(25)]
+        db.upload_project_logs(queued_logs(cycle.id, gses))
+
+        iterator = db.iter_queued_project(cycle.id, batch_size=4)
+        first = next(iterator)
+        assert isinstance(first, StatusModel)
+        assert [first.gse] + [m.gse for m in iterator] == gses
+
+    def test_iter_failed_project(self, db):
+        cycle = make_cycle(db)
+        models = db.upload_project_logs(queued_logs(cycle.id, ["GSE1", "GSE2", "GSE3"]))
+        for model, status in zip(models, ["success", "failure", "warning"]):
+            model.status = status
+            db.upload_project_log(model)
+
+        assert [m.gse for m in db.iter_failed_project(cycle.id, batch_size=1)] == [
+            "GSE2",
+            "GSE3",
+        ]
+        assert [m.gse for m in db.get_failed_project(cycle.id)] == ["GSE2", "GSE3"]
+
+    def test_iter_failed_project_leaves_out_skipped(self, db):
+        cycle = make_cycle(db)
+        models = db.upload_project_logs(queued_logs(cycle.id, ["GSE1", "GSE2"]))
+        models[0].status = "skipped"
+        db.upload_project_log(models[0])
+
+        assert [m.gse for m in db.iter_failed_project(cycle.id)] == ["GSE2"]
+
+    def test_iter_failed_project_skips_permanent_failures(self, db):
+        cycle = make_cycle(db)
+        models = db.upload_project_logs(queued_logs(cycle.id, ["GSE1", "GSE2", "GSE3"]))
+        for model, status_info in zip(models, ["permanent", "transient", None]):
+            model.status = "failure"
+            model.status_info = status_info
+            db.upload_project_log(model)
+
+        assert [m.gse for m in db.iter_failed_project(cycle.id)] == ["GSE2", "GSE3"]
+
+
+class TestUploadedGses:
+    def test_successes_after_the_date(self, db):
+        cycle = make_cycle(db)
+        models = db.upload_project_logs(
+            queued_logs(cycle.id, ["GSE1", "GSE2", "GSE3"])
+            + queued_logs(cycle.id, ["GSE4"], target="bedbase")
+        )
+        for model, status in zip(models, ["success", "failure", "queued", "success"]):
+            model.status = status
+            db.upload_project_log(model)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        gses = ["GSE1", "GSE2", "GSE3", "GSE4", "GSE5"]
+
+        assert db.get_uploaded_gses("geo", gses, now - HOUR) == {"GSE1"}
+        assert db.get_uploaded_gses("geo", gses, now + HOUR) == set()
+        assert db.get_uploaded_gses("bedbase", gses, now - HOUR) == {"GSE4"}
+
+    def test_registry_path_must_match(self, db):
+        cycle = make_cycle(db)
+        (model,) = db.upload_project_logs(queued_logs(cycle.id, ["GSE1"]))
+        model.status = "success"
+        model.registry_path = "bedbase/GSE1:default"
+        db.upload_project_log(model)
+        now = datetime.datetime.now(datetime.timezone.utc)
+
+        assert db.get_uploaded_gses("geo", ["GSE1"], now - HOUR) == set()
+
+        model.registry_path = "geo/GSE1:raw"
+        db.upload_project_log(model)
+
+        assert db.get_uploaded_gses("geo", ["GSE1"], now - HOUR) == {"GSE1"}
+
+    def test_status_date_follows_updates(self, db):
+        cycle = make_cycle(db)
+        db.upload_project_logs(queued_logs(cycle.id, ["GSE1"]))
+        (queued,) = db.get_queued_project(cycle.id)
+        assert queued.status_date is not None
+
+        time.sleep(0.01)
+        queued.status = "success"
+        db.upload_project_log(queued)
+
+        with Session(db._engine) as session:
+            status_date = session.scalar(select(ProjectModelSA.status_date))
+        assert status_date > queued.status_date
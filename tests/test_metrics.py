@@ -0,0 +1,126 @@
+"""Offline tests for the Prometheus metrics exporter."""
+
+import urllib.request
+
+import pytest
+from sqlalchemy import create_engine, text
+
+from geopephub import metrics
+from geopephub.metrics import (
+    Counter,
+    Gauge,
+    Histogram,
+    Registry,
+    count_db_round_trips,
+    observe_gse,
+    start_http_server,
+    write_textfile,
+)
+
+
+@pytest.fixture
+def registry():
+    registry = Registry()
+    counter = registry.register(
+        Counter("gse_total", "Processed GSEs", ["target", "status"])
+    )
+    gauge = registry.register(Gauge("gse_per_second", "Throughput", ["target"]))
+    histogram = registry.register(
+        Histogram("stage_seconds", "Stage duration", ["stage"], buckets=[1, 5])
+    )
+    counter.inc(target="geo", status="success")
+    counter.inc(2, target="geo", status="failure")
+    gauge.set(1.5, target="geo")
+    histogram.observe(0.5, stage="fetch")
+    histogram.observe(3, stage="fetch")
+    return registry
+
+
+def test_render(registry):
+    assert registry.render() == (
+        "# HELP gse_total Processed GSEs\n"
+        "# TYPE gse_total counter\n"
+        'gse_total{target="geo",status="failure"} 2\n'
+        'gse_total{target="geo",status="success"} 1\n'
+        "# HELP gse_per_second Throughput\n"
+        "# TYPE gse_per_second gauge\n"
+        'gse_per_second{target="geo"} 1.5\n'
+        "# HELP stage_seconds Stage duration\n"
+        "# TYPE stage_seconds histogram\n"
+        'stage_seconds_bucket{stage="fetch",le="1"} 1\n'
+        'stage_seconds_bucket{stage="fetch",le="5"} 2\n'
+        'stage_seconds_bucket{stage="fetch",le="+Inf"} 2\n'
+        'stage_seconds_sum{stage="fetch"} 3.5\n'
+        'stage_seconds_count{stage="fetch"} 2\n'
+    )
+
+
+def test_label_values_are_escaped():
+    registry = Registry()
+    counter = registry.register(Counter("errors_total", "Errors", ["error"]))
+    counter.inc(error='bad "quote"\\')
+
+    assert 'errors_total{error="bad \\"quote\\"\\\\"} 1' in registry.render()
+
+
+def test_wrong_labels_are_rejected():
+    counter = Counter("gse_total", "Processed GSEs", ["target"])
+
+    with pytest.raises(ValueError):
+        counter.inc(namespace="geo")
+    with pytest.raises(ValueError):
+        counter.inc(-1, target="geo")
+
+
+def test_write_textfile(registry, tmp_path):
+    path = tmp_path / "geopephub.prom"
+
+    write_textfile(str(path), registry)
+
+    assert path.read_text() == registry.render()
+    assert [p.name for p in tmp_path.iterdir()] == ["geopephub.prom"]
+
+
+def test_http_server(registry):
+    server = start_http_server(0, addr="127.0.0.1", registry=registry)
+    try:
+        with urllib.request.urlopen(
+            f"http://127.0.0.1:{server.server_port}/metrics", timeout=10
+        ) as response:
+            body = response.read().decode()
+            content_type = response.headers["Content-Type"]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert body == registry.render()
+    assert content_type.startswith("text/plain; version=0.0.4")
+
+
+def test_count_db_round_trips():
+    engine = count_db_round_trips(create_engine("sqlite://"), "test_round_trips")
+    before = dict(metrics.DB_ROUND_TRIPS._values)
+
+    with engine.connect() as connection:
+        for _ in range(3):
+            connection.execute(text("SELECT 1"))
+
+    key = ("test_round_trips",)
+    assert metrics.DB_ROUND_TRIPS._values[key] - before.get(key, 0) == 3
+
+
+def test_observe_gse():
+    target = "test_observe_gse"
+    stage_metrics = {"fetch_s": 2.0, "create_s": 0.2, "samples": 10, "bytes": 4096}
+
+    observe_gse(target, stage_metrics, {"success": 2, "failure": 0, "warning": 1})
+    observe_gse(target, None, {"failure": 1})
+
+    assert metrics.GSE_PROCESSED._values[(target,)] == 2
+    assert metrics.PROJECTS._values[(target, "success")] == 2
+    assert metrics.PROJECTS._values[(target, "failure")] == 1
+    assert (target, "warning") in metrics.PROJECTS._values
+    assert metrics.GEOFETCH_BYTES._values[(target,)] == 4096
+    rendered = metrics.REGISTRY.render()
+    assert 'geopephub_stage_duration_seconds_count{stage="fetch"}' in rendered
+    assert "geopephub_ncbi_requests_total " in rendered
@@ -0,0 +1,267 @@
+"""Tests for PEPhub write helpers. pepdbagent tables in a throwaway SQLite file."""
+
+import inspect
+import os
+from types import SimpleNamespace
+
+import pepdbagent
+import peppy
+import pytest
+from pepdbagent.db_utils import Base, Projects, User
+from pepdbagent.modules.project import PEPDatabaseProject
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import Session
+
+from geopephub import metageo_pephub
+from geopephub.models import StatusModel
+from geopephub.pephub import (
+    get_namespace_digests,
+    get_stored_projects,
+    is_project_unchanged,
+    write_projects,
+)
+
+from test_uploader import FakeLogConnection
+
+
+def make_project(value=1, description="Data from GEO"):
+    project = peppy.Project.from_dict(
+        {
+            "_config": {"pep_version": "2.1.0"},
+            "_sample_dict": [{"sample_name": "s1", "value": value}],
+        }
+    )
+    project.description = description
+    return project
+
+
+@pytest.fixture
+def agent(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'pephub.db'}")
+    Base.metadata.create_all(engine)
+    pep_db_engine = SimpleNamespace(engine=engine)
+    return SimpleNamespace(
+        pep_db_engine=pep_db_engine, project=PEPDatabaseProject(pep_db_engine)
+    )
+
+
+def store(agent, project, name="GSE1", tag="default"):
+    agent.project.create(
+        project=project,
+        namespace="geo",
+        name=name,
+        tag=tag,
+        overwrite=True,
+        description=project.description,
+    )
+
+
+class TestUnchanged:
+    def test_same_project(self, agent):
+        store(agent, make_project())
+        stored = get_stored_projects(agent, "geo", [("GSE1", "default")])
+
+        assert is_project_unchanged(
+            make_project(), "GSE1", "default", "Data from GEO", stored
+        )
+
+    @pytest.mark.parametrize(
+        "project, name, tag",
+        [
+            (make_project(value=2), "GSE1", "default"),
+            (make_project(description="New"), "GSE1", "default"),
+            (make_project(), "GSE1", "raw"),
+            (make_project(), "GSE2", "default"),
+        ],
+    )
+    def test_changed_or_missing(self, agent, project, name, tag):
+        store(agent, make_project())
+        stored = get_stored_projects(agent, "geo", [(name, tag)])
+
+        assert not is_project_unchanged(
+            project, name, tag, project.description, stored
+        )
+
+
+@pytest.fixture
+def unwritable_raw(monkeypatch):
+    """Samples of projects tagged "raw" fail to serialize, when they are flushed."""
+    add_samples = PEPDatabaseProject._add_samples_to_project
+
+    def _add_samples_to_project(projects_sa, samples, sample_table_index):
+        if projects_sa.tag == "raw":
+            samples = [{"sample_name": "s1", "value": object()}]
+        add_samples(projects_sa, samples, sample_table_index=sample_table_index)
+
+    monkeypatch.setattr(
+        PEPDatabaseProject,
+        "_add_samples_to_project",
+        staticmethod(_add_samples_to_project),
+    )
+
+
+class TestWriteProjects:
+    def test_created_and_overwritten(self, agent):
+        store(agent, make_project(), name="GSE1")
+        errors = write_projects(
+            agent,
+            "geo",
+            [
+                ("GSE1", "default", make_project(value=2, description="New")),
+                ("GSE2", "default", make_project()),
+            ],
+        )
+
+        assert errors == [None, None]
+        project = agent.project.get("geo", "gse1", "default", raw=False)
+        assert project.description == "New"
+        assert [sample.value for sample in project.samples] == [2]
+        stored = get_stored_projects(agent, "geo", [("GSE1", "default")])
+        assert is_project_unchanged(
+            make_project(value=2, description="New"), "GSE1", "default", "New", stored
+        )
+        with Session(agent.pep_db_engine.engine) as session:
+            assert session.scalar(select(User.number_of_projects)) == 2
+
+    def test_failed_project_rolled_back_alone(self, agent, unwritable_raw):
+        errors = write_projects(
+            agent,
+            "geo",
+            [("GSE1", "raw", make_project()), ("GSE1", "default", make_project())],
+        )
+
+        assert errors[0] is not None and errors[1] is None
+        with Session(agent.pep_db_engine.engine) as session:
+            assert session.execute(select(Projects.name, Projects.tag)).all() == [
+                ("gse1", "default")
+            ]
+            assert session.scalar(select(User.number_of_projects)) == 1
+
+
+class TestPepdbagentInternals:
+    """write_projects relies on pepdbagent internals, pinned in pyproject.toml."""
+
+    def test_private_helpers(self):
+        assert list(
+            inspect.signature(PEPDatabaseProject._add_samples_to_project).parameters
+        ) == ["projects_sa", "samples", "sample_table_index"]
+        assert list(
+            inspect.signature(PEPDatabaseProject._add_subsamples_to_project).parameters
+        ) == ["projects_sa", "subsamples"]
+
+    def test_pinned_version(self):
+        with open(os.path.join(os.path.dirname(__file__), "..", "pyproject.toml")) as f:
+            assert f'pepdbagent= "{pepdbagent.__version__}"' in f.read()
+
+    def test_writes_like_create(self, agent):
+        project = peppy.Project.from_dict(
+            {
+                "_config": {"pep_version": "2.1.0", "sample_table_index": "sample_id"},
+                "_sample_dict": [
+                    {"sample_id": "s1", "value": 1},
+                    {"sample_id": "s2", "value": 2},
+                ],
+                "_subsample_list": [[{"sample_id": "s1", "file": "a.txt"}]],
+            }
+        )
+        project.description = "Data from GEO"
+        store(agent, project, tag="create")
+        assert write_projects(agent, "geo", [("GSE1", "write", project)]) == [None]
+
+        created, written = (
+            agent.project.get("geo", "gse1", tag, raw=True)
+            for tag in ("create", "write")
+        )
+        assert written == created
+        with Session(agent.pep_db_engine.engine) as session:
+            rows = session.execute(
+                select(
+                    Projects.digest,
+                    Projects.config,
+                    Projects.description,
+                    Projects.number_of_samples,
+                    Projects.private,
+                    Projects.pop,
+                ).order_by(Projects.tag)
+            ).all()
+        assert rows[0] == rows[1]
+
+
+@pytest.fixture
+def written(monkeypatch):
+    """Names of the projects written by the uploader."""
+    names = []
+
+    def _write_projects(agent, namespace, projects):
+        names.extend(name for name, _, _ in projects)
+        return write_projects(agent, namespace, projects)
+
+    monkeypatch.setattr(metageo_pephub, "write_projects", _write_projects)
+    return names
+
+
+def test_uploader_skips_unchanged_projects(agent, written):
+    gse_log = StatusModel(gse="GSE1", target="geo", log_stage=2, status="processing")
+
+    def fetched():
+        return {"GSE1_default": make_project()}
+
+    log_connection = FakeLogConnection()
+    first = metageo_pephub._create_gse_projects(
+        agent, log_connection, gse_log, fetched(), "geo"
+    )
+    second = metageo_pephub._create_gse_projects(
+        agent, log_connection, gse_log, fetched(), "geo"
+    )
+
+    assert first == second == {"success": 1, "failure": 0}
+    assert written == ["GSE1"]
+    assert log_connection.writes["GSE1"][-1].status_info == "unchanged"
+
+
+def test_uploader_reports_each_project(agent, written, unwritable_raw):
+    gse_log = StatusModel(
+        gse="GSE1", target="bedbase", log_stage=2, status="processing"
+    )
+    log_connection = FakeLogConnection()
+
+    status = metageo_pephub._create_gse_projects(
+        agent,
+        log_connection,
+        gse_log,
+        {"GSE1_samples": make_project(), "GSE1_raw": make_project()},
+        "bedbase",
+    )
+
+    assert status == {"success": 1, "failure": 1}
+    assert written == ["GSE1", "GSE1"]
+    assert [
+        (log.registry_path, log.status) for log in log_connection.writes["GSE1"]
+    ] == [("bedbase/GSE1:samples", "success"), ("bedbase/GSE1:raw", "failure")]
+
+
+def test_get_namespace_digests(agent):
+    store(agent, make_project(), name="GSE1")
+    store(agent, make_project(value=2), name="GSE2", tag="raw")
+    agent.project.create(
+        project=make_project(),
+        namespace="geo",
+        name="GSE3",
+        tag="default",
+        is_private=True,
+    )
+    store(agent, make_project(), name="GSE4")
+    with Session(agent.pep_db_engine.engine) as session:
+        expected = {
+            (name, tag): digest
+            for name, tag, digest in session.execute(
+                select(Projects.name, Projects.tag, Projects.digest).where(
+                    Projects.private.is_(False)
+                )
+            )
+        }
+
+    digests = get_namespace_digests(agent, "GEO")
+
+    assert digests == expected
+    assert set(digests) == {("gse1", "default"), ("gse2", "raw"), ("gse4", "default")}
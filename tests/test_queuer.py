@@ -0,0 +1,178 @@
+"""Offline tests for the queuer and the checker. No network; status tables in SQLite."""
+
+import datetime
+import threading
+
+import pytest
+
+from geopephub import metageo_pephub
+from geopephub.throttle import TokenBucket
+
+from test_db_utils import db, queued_logs
+
+
+class FakeFinder:
+    """GSEs of a window are given by its start date; "fail" makes the search fail."""
+
+    results = {}
+    calls = []
+    lock = threading.Lock()
+
+    def __init__(self, filters=None):
+        self.filters = filters
+
+    def get_gse_by_date(self, start_date, end_date=None):
+        with self.lock:
+            self.calls.append((start_date, end_date))
+        result = self.results.get(start_date, [])
+        if result == "fail":
+            raise RuntimeError("esearch timed out")
+        return result
+
+
+@pytest.fixture
+def finder(db, monkeypatch):
+    FakeFinder.results = {}
+    FakeFinder.calls = []
+    monkeypatch.setattr(metageo_pephub.geofetch, "Finder", FakeFinder)
+    monkeypatch.setattr(metageo_pephub, "get_base_db_engine", lambda: db)
+    monkeypatch.setattr(
+        metageo_pephub, "get_ncbi_rate_limiter", lambda: TokenBucket(rate=1000)
+    )
+    return FakeFinder
+
+
+def queued_gses(db, cycle):
+    return [m.gse for m in db.get_queued_project(cycle.id)]
+
+
+class TestQueueByPeriod:
+    def test_short_period_is_one_cycle(self, db, finder):
+        finder.results = {"2024/01/01": ["GSE1", "GSE2", "GSE1"]}
+
+        (cycle,) = metageo_pephub.add_to_queue_by_period(
+            "geo", "default", "2024/01/01", "2024/01/02"
+        )
+
+        assert cycle.status == "queued"
+        assert cycle.number_of_projects == 2
+        assert queued_gses(db, cycle) == ["GSE1", "GSE2"]
+
+    def test_windows_are_deduplicated(self, db, finder):
+        finder.results = {
+            "2024/01/01": ["GSE1", "GSE2"],
+            "2024/01/08": ["GSE2", "GSE3"],
+            "2024/01/15": ["GSE4"],
+        }
+
+        cycles = metageo_pephub.add_to_queue_by_period(
+            "geo", "default", "2024/01/01", "2024/01/20", chunk_days=7
+        )
+
+        assert [(c.start_period, c.end_period) for c in cycles] == [
+            ("2024/01/01", "2024/01/08"),
+            ("2024/01/08", "2024/01/15"),
+            ("2024/01/15", "2024/01/20"),
+        ]
+        assert sorted(finder.calls) == [(c.start_period, c.end_period) for c in cycles]
+        assert [queued_gses(db, c) for c in cycles] == [
+            ["GSE1", "GSE2"],
+            ["GSE3"],
+            ["GSE4"],
+        ]
+
+    def test_failed_window_does_not_stop_others(self, db, finder):
+        finder.results = {"2024/01/01": "fail", "2024/01/08": ["GSE3"]}
+
+        cycles = metageo_pephub.add_to_queue_by_period(
+            "geo", "default", "2024/01/01", "2024/01/15", chunk_days=7
+        )
+
+        assert [c.status for c in cycles] == ["failure", "queued"]
+        assert queued_gses(db, cycles[1]) == ["GSE3"]
+
+    def test_unknown_target(self, db, finder):
+        with pytest.raises(Exception, match="Error in target"):
+            metageo_pephub.add_to_queue_by_period(
+                "nobase", "default", "2024/01/01", "2024/01/02"
+            )
+        assert db.was_run_successful("2024/01/01", "2024/01/02").status == "failure"
+
+
+class TestSkipUploaded:
+    def test_uploaded_after_window_is_skipped(self, db, finder):
+        finder.results = {"2024/01/01": ["GSE1", "GSE2"]}
+        (first,) = metageo_pephub.add_to_queue_by_period(
+            "geo", "default", "2024/01/01", "2024/01/02"
+        )
+        (uploaded, failed) = db.get_queued_project(first.id)
+        uploaded.status = "success"
+        db.upload_project_log(uploaded)
+        failed.status = "failure"
+        db.upload_project_log(failed)
+
+        (again,) = metageo_pephub.add_to_queue_by_period(
+            "geo", "default", "2024/01/01", "2024/01/02"
+        )
+
+        assert queued_gses(db, again) == ["GSE2"]
+        assert db.get_cycle_status_counts(again.id) == {"queued": 1, "skipped": 1}
+
+    def test_update_after_upload_is_queued(self, db, finder):
+        """A GSE uploaded before the end of the window may miss the update."""
+        today = datetime.datetime.now(datetime.timezone.utc).strftime("%Y/%m/%d")
+        finder.results = {today: ["GSE1"]}
+        (first,) = metageo_pephub.add_to_queue_by_period(
+            "geo", "default", today, today
+        )
+        (uploaded,) = db.get_queued_project(first.id)
+        uploaded.status = "success"
+        db.upload_project_log(uploaded)
+
+        (again,) = metageo_pephub.add_to_queue_by_period(
+            "geo", "default", today, today
+        )
+
+        assert queued_gses(db, again) == ["GSE1"]
+
+    def test_skipped_count_as_successes(self, db, finder):
+        cycle = db.update_upload_cycle(
+            metageo_pephub.CycleModel(target="geo", status="processing")
+        )
+        db.upload_project_logs(queued_logs(cycle.id, ["GSE1", "GSE2"]))
+        skipped, failed = db.get_queued_project(cycle.id)
+        skipped.status = "skipped"
+        db.upload_project_log(skipped)
+        failed.status = "failure"
+        db.upload_project_log(failed)
+
+        metageo_pephub._set_cycle_counters(db, cycle)
+
+        assert cycle.number_of_successes == 1
+        assert cycle.number_of_failures == 1
+
+
+def test_check_by_date_requeues_only_failed_windows(db, finder, monkeypatch):
+    uploads = []
+    monkeypatch.setattr(
+        metageo_pephub,
+        "upload_queued_projects",
+        lambda target, tag, **kwargs: uploads.append(target),
+    )
+    finder.results = {"2024/01/01": "fail", "2024/01/08": ["GSE3"]}
+    cycles = metageo_pephub.add_to_queue_by_period(
+        "geo", "default", "2024/01/01", "2024/01/15", chunk_days=7
+    )
+    cycles[1].status = "success"
+    cycles[1].number_of_successes = 1
+    db.update_upload_cycle(cycles[1])
+    finder.calls = []
+    finder.results = {"2024/01/01": ["GSE1"]}
+
+    metageo_pephub.check_by_date("geo", "2024/01/01", "2024/01/15", "default")
+
+    assert finder.calls == [("2024/01/01", "2024/01/08")]
+    assert uploads == ["geo"]
+    latest = db.was_run_successful("2024/01/01", "2024/01/08", target="geo")
+    assert latest.status == "queued"
+    assert queued_gses(db, latest) == ["GSE1"]
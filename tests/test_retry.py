@@ -0,0 +1,207 @@
+"""Offline tests for retries and failure classification. No network."""
+
+import urllib.error
+
+import pytest
+import requests
+from geofetch.utils import SoftFileException
+from pepdbagent.exceptions import ProjectUniqueNameError
+from sqlalchemy.exc import OperationalError
+
+from geopephub import metageo_pephub, retry
+from geopephub.retry import (
+    ProjectTooLargeError,
+    backoff_delay,
+    classify_error,
+    retry_call,
+)
+
+from test_uploader import FakeAgent, FakeLogConnection, make_logs, make_project
+
+
+def http_error(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    return requests.HTTPError(f"{status_code} Error", response=response)
+
+
+class FakeDBError(Exception):
+    def __init__(self, sqlstate):
+        super().__init__(sqlstate)
+        self.sqlstate = sqlstate
+
+
+class TestClassifyError:
+    @pytest.mark.parametrize(
+        "err",
+        [
+            http_error(429),
+            http_error(503),
+            requests.ConnectionError("reset"),
+            requests.Timeout("slow"),
+            urllib.error.URLError("no route"),
+            ConnectionResetError(),
+            OperationalError("UPDATE", {}, FakeDBError("40001")),
+            OperationalError("SELECT", {}, FakeDBError("08006")),
+            RuntimeError("HTTPError: 503 Server Error: Service Unavailable"),
+        ],
+    )
+    def test_transient(self, err):
+        assert classify_error(err) == "transient"
+
+    @pytest.mark.parametrize(
+        "err",
+        [
+            http_error(404),
+            SoftFileException("GSE1"),
+            ProjectUniqueNameError("geo/GSE1:default"),
+            ProjectTooLargeError("GSE1_default has 2000000 samples"),
+            OperationalError("INSERT", {}, FakeDBError("54000")),
+            RuntimeError("SoftFileException: GSE1 SOFT is malformed"),
+        ],
+    )
+    def test_permanent(self, err):
+        assert classify_error(err) == "permanent"
+
+    @pytest.mark.parametrize(
+        "err",
+        [
+            RuntimeError("Geofetch worker for GSE142900 exited unexpectedly"),
+            OperationalError("SELECT", {}, Exception("no sqlstate")),
+            Exception("error in requesting tar_files_list"),
+            # built-in errors may come from a bug of ours, the checker retries them
+            KeyError("sample_name"),
+            IndexError("list index out of range"),
+            ValueError("invalid literal for int()"),
+            MemoryError(),
+            RuntimeError("ValueError: invalid literal for int()"),
+        ],
+    )
+    def test_unknown(self, err):
+        assert classify_error(err) == "unknown"
+
+
+class TestRetryCall:
+    def test_retries_transient_errors(self):
+        calls, sleeps = [], []
+
+        def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise requests.ConnectionError("reset")
+            return "ok"
+
+        assert retry_call(flaky, attempts=3, sleep=sleeps.append) == "ok"
+        assert len(calls) == 3
+        assert len(sleeps) == 2
+
+    def test_gives_up_after_attempts(self):
+        calls = []
+
+        def failing():
+            calls.append(1)
+            raise requests.ConnectionError("reset")
+
+        with pytest.raises(requests.ConnectionError):
+            retry_call(failing, attempts=3, sleep=lambda s: None)
+        assert len(calls) == 3
+
+    @pytest.mark.parametrize("err", [SoftFileException("GSE1"), RuntimeError("?")])
+    def test_does_not_retry_other_errors(self, err):
+        calls = []
+
+        def failing():
+            calls.append(1)
+            raise err
+
+        with pytest.raises(type(err)):
+            retry_call(failing, attempts=3, sleep=lambda s: None)
+        assert len(calls) == 1
+
+    def test_backoff_is_capped_and_jittered(self):
+        for attempt in range(1, 10):
+            delay = backoff_delay(attempt, base_delay=2, max_delay=30)
+            assert 0 <= delay <= min(30, 2 * 2 ** (attempt - 1))
+
+
+class TestUploaderRetries:
+    @pytest.fixture(autouse=True)
+    def no_backoff(self, monkeypatch):
+        monkeypatch.setattr(retry.random, "uniform", lambda a, b: 0)
+        monkeypatch.setattr(metageo_pephub.geofetch, "Geofetcher", lambda **kw: None)
+        monkeypatch.setattr(metageo_pephub, "get_geofetch_cache", lambda: None)
+
+    def test_transient_fetch_error_is_retried(self, monkeypatch):
+        calls = []
+
+        def _run_geofetch(gse, geofetcher_obj=None, **kwargs):
+            calls.append(gse)
+            if len(calls) == 1:
+                raise requests.ConnectionError("reset")
+            return {f"{gse}_default": make_project()}
+
+        monkeypatch.setattr(metageo_pephub, "run_geofetch", _run_geofetch)
+        status_dict = metageo_pephub._upload_gse_project(
+            FakeAgent(), FakeLogConnection(), make_logs(["GSE1"]), "geo"
+        )
+
+        assert calls == ["GSE1", "GSE1"]
+        assert status_dict["success"] == 1
+
+    def test_failure_class_is_stored(self, monkeypatch):
+        def _run_geofetch(gse, geofetcher_obj=None, **kwargs):
+            if gse == "GSE1":
+                raise SoftFileException(gse)
+            raise requests.ConnectionError("reset")
+
+        monkeypatch.setattr(metageo_pephub, "run_geofetch", _run_geofetch)
+        log_connection = FakeLogConnection()
+        metageo_pephub._upload_gse_project(
+            FakeAgent(), log_connection, make_logs(["GSE1", "GSE2"]), "geo"
+        )
+
+        assert log_connection.writes["GSE1"][-1].status_info == "permanent"
+        assert log_connection.writes["GSE2"][-1].status_info == "transient"
+
+    def test_too_large_project_is_permanent(self, monkeypatch):
+        monkeypatch.setattr(metageo_pephub, "MAX_PROJECT_SAMPLES", 0)
+        monkeypatch.setattr(
+            metageo_pephub,
+            "run_geofetch",
+            lambda gse, geofetcher_obj=None, **kwargs: {
+                f"{gse}_default": make_project()
+            },
+        )
+        agent, log_connection = FakeAgent(), FakeLogConnection()
+        metageo_pephub._upload_gse_project(
+            agent, log_connection, make_logs(["GSE1"]), "geo"
+        )
+
+        assert log_connection.writes["GSE1"][-1].status_info == "permanent"
+        assert agent.project.created == []
+
+    def test_transient_upload_error_is_retried(self, monkeypatch):
+        monkeypatch.setattr(
+            metageo_pephub,
+            "run_geofetch",
+            lambda gse, geofetcher_obj=None, **kwargs: {
+                f"{gse}_default": make_project()
+            },
+        )
+        agent = FakeAgent()
+        create = agent.project.create
+        calls = []
+
+        def flaky_create(**kwargs):
+            calls.append(1)
+            if len(calls) == 1:
+                raise OperationalError("INSERT", {}, FakeDBError("40P01"))
+            create(**kwargs)
+
+        agent.project.create = flaky_create
+        status_dict = metageo_pephub._upload_gse_project(
+            agent, FakeLogConnection(), make_logs(["GSE1"]), "geo"
+        )
+
+        assert len(calls) == 2
+        assert status_dict["success"] == 1
@@ -0,0 +1,149 @@
+"""Offline tests for the S3 transfer layer, against local stand-ins of S3."""
+
+import logging
+import threading
+
+import boto3
+import pytest
+from botocore.stub import ANY, Stubber
+
+from geopephub import metrics, s3
+from geopephub.bench import LocalS3
+from geopephub.bunch_geo import upload_to_s3_file
+from geopephub.s3 import (
+    TransferProgress,
+    download_file,
+    parse_part_size,
+    upload_file,
+)
+
+MB = 1024**2
+
+
+@pytest.fixture(autouse=True)
+def s3_env(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "test")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "test")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    get_s3_client = s3.get_s3_client
+    get_s3_client.cache_clear()
+    yield
+    get_s3_client.cache_clear()
+
+
+@pytest.fixture
+def local_s3(tmp_path, monkeypatch):
+    local_s3 = LocalS3(str(tmp_path / "s3"))
+    monkeypatch.setattr(s3, "get_s3_client", lambda: local_s3)
+    return local_s3
+
+
+def test_transfer_settings_from_env(monkeypatch):
+    monkeypatch.setenv("GEOPEPHUB_S3_PART_SIZE", "8MB")
+    monkeypatch.setenv("GEOPEPHUB_S3_CONCURRENCY", "4")
+    monkeypatch.setenv("GEOPEPHUB_S3_MAX_ATTEMPTS", "3")
+
+    config = s3.get_transfer_config()
+    client = s3.get_s3_client()
+
+    assert config.multipart_threshold == config.multipart_chunksize == 8 * MB
+    assert config.max_request_concurrency == 4
+    assert config.num_download_attempts == 3
+    assert client.meta.config.max_pool_connections == 4
+    assert client.meta.config.retries == {"total_max_attempts": 3, "mode": "standard"}
+    assert s3.get_s3_client() is client
+
+
+@pytest.mark.parametrize(
+    "value, size",
+    [("8MB", 8 * MB), ("8 mb", 8 * MB), ("1GiB", 1024 * MB), (str(5 * MB), 5 * MB)],
+)
+def test_parse_part_size(value, size):
+    assert parse_part_size(value) == size
+
+
+@pytest.mark.parametrize("value", ["1.5gb", "8 XB", "MB", "", "4MB", "5000000"])
+def test_invalid_part_size_is_rejected(value, monkeypatch):
+    monkeypatch.setenv("GEOPEPHUB_S3_PART_SIZE", value or " ")
+
+    with pytest.raises(ValueError, match="GEOPEPHUB_S3_PART_SIZE"):
+        s3.get_transfer_config()
+
+
+def test_progress_is_thread_safe(caplog):
+    progress = TransferProgress("Uploading x", size=400 * 1000, interval=0)
+
+    def transfer():
+        for _ in range(1000):
+            progress(100)
+
+    with caplog.at_level(logging.INFO, logger="geopephub.s3"):
+        threads = [threading.Thread(target=transfer) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        throughput = progress.finish()
+
+    assert progress.transferred == 400 * 1000
+    assert throughput > 0
+    assert "of 0.4 MB (100%)" in caplog.messages[-2]
+    assert caplog.messages[-1].startswith("Uploading x: 0.4 MB in ")
+
+
+def test_upload_and_download(local_s3, tmp_path):
+    source = tmp_path / "archive.tar"
+    source.write_bytes(b"x" * (3 * MB + 5))
+    uploaded = dict(metrics.S3_BYTES._values)
+
+    assert upload_file(str(source), "bucket", "geo/archive.tar") > 0
+    assert download_file("bucket", "geo/archive.tar", str(tmp_path / "copy.tar")) > 0
+
+    assert (tmp_path / "copy.tar").read_bytes() == source.read_bytes()
+    for direction in ("upload", "download"):
+        key = (direction,)
+        assert metrics.S3_BYTES._values[key] - uploaded.get(key, 0) == 3 * MB + 5
+
+
+def test_multipart_upload_in_parts(tmp_path, monkeypatch):
+    # boto3 does not go below 5MB parts
+    monkeypatch.setenv("GEOPEPHUB_S3_PART_SIZE", "5MB")
+    monkeypatch.setenv("GEOPEPHUB_S3_CONCURRENCY", "1")
+    source = tmp_path / "archive.tar"
+    source.write_bytes(b"x" * (11 * MB))
+    target = {"Bucket": "bucket", "Key": "geo/archive.tar", "ChecksumAlgorithm": ANY}
+    upload = {"Bucket": "bucket", "Key": "geo/archive.tar", "UploadId": "upload"}
+
+    with Stubber(s3.get_s3_client()) as stubber:
+        stubber.add_response("create_multipart_upload", {"UploadId": "upload"}, target)
+        for part_number in (1, 2, 3):
+            stubber.add_response(
+                "upload_part",
+                {"ETag": f'"{part_number}"'},
+                {**upload, **target, "PartNumber": part_number, "Body": ANY},
+            )
+        stubber.add_response(
+            "complete_multipart_upload", {}, {**upload, "MultipartUpload": ANY}
+        )
+
+        upload_file(str(source), "bucket", "geo/archive.tar")
+
+        stubber.assert_no_pending_responses()
+
+
+def test_upload_to_s3_file_shares_client(tmp_path, monkeypatch):
+    local_s3 = LocalS3(str(tmp_path / "s3"))
+    created = []
+    monkeypatch.setattr(
+        boto3, "client", lambda *args, **kwargs: created.append(args) or local_s3
+    )
+    for name in ("gse1.zip", "gse2.zip"):
+        (tmp_path / name).write_bytes(b"pep")
+
+        assert upload_to_s3_file(str(tmp_path / name), bucket="pephub")
+
+    assert created == [("s3",)]
+    assert sorted(p.name for p in (tmp_path / "s3" / "pephub").iterdir()) == [
+        "gse1.zip",
+        "gse2.zip",
+    ]
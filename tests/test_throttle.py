@@ -0,0 +1,137 @@
+"""Offline tests for NCBI throttling helpers. No network."""
+
+import threading
+import time
+
+import pytest
+import requests
+
+from geopephub.throttle import AdaptiveConcurrency, TokenBucket
+from geopephub.utils import FunctionTimeoutError, is_throttling_error
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TestTokenBucket:
+    def test_burst_then_rate(self):
+        clock = FakeClock()
+        bucket = TokenBucket(rate=3, clock=clock, sleep=clock.sleep)
+
+        for _ in range(3):
+            assert bucket.acquire() == 0
+        assert bucket.acquire() == pytest.approx(1 / 3)
+        assert clock.now == pytest.approx(1 / 3)
+
+    def test_long_run_respects_rate(self):
+        clock = FakeClock()
+        bucket = TokenBucket(rate=10, clock=clock, sleep=clock.sleep)
+
+        for _ in range(110):
+            bucket.acquire()
+
+        # 10 burst tokens, then 10 per second
+        assert clock.now == pytest.approx(10.0)
+        assert bucket.acquired == 110
+
+    def test_multi_token_acquire(self):
+        clock = FakeClock()
+        bucket = TokenBucket(rate=3, clock=clock, sleep=clock.sleep)
+
+        bucket.acquire(3)
+        bucket.acquire(2)
+        assert clock.now == pytest.approx(2 / 3)
+
+    def test_shared_between_threads(self):
+        bucket = TokenBucket(rate=50)
+        start = time.monotonic()
+        threads = [
+            threading.Thread(target=lambda: [bucket.acquire() for _ in range(10)])
+            for _ in range(10)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # 50 burst tokens, the remaining 50 need about a second
+        assert time.monotonic() - start >= 0.9
+        assert bucket.acquired == 100
+
+
+class TestAdaptiveConcurrency:
+    def test_shrinks_on_throttling_and_grows_back(self):
+        concurrency = AdaptiveConcurrency(
+            max_limit=8, increase_after=2, is_throttled=is_throttling_error
+        )
+
+        def _throttled():
+            raise FunctionTimeoutError("too long")
+
+        for expected in [4, 2, 1, 1]:
+            with pytest.raises(FunctionTimeoutError):
+                concurrency.run(_throttled)
+            assert concurrency.limit == expected
+        assert concurrency.throttled == 4
+
+        for _ in range(4):
+            concurrency.run(lambda: None)
+        assert concurrency.limit == 3
+
+    def test_other_errors_do_not_shrink(self):
+        concurrency = AdaptiveConcurrency(max_limit=4, is_throttled=is_throttling_error)
+        with pytest.raises(ValueError):
+            concurrency.run(lambda: (_ for _ in ()).throw(ValueError("bad SOFT")))
+        assert concurrency.limit == 4
+
+    def test_limits_calls_in_flight(self):
+        concurrency = AdaptiveConcurrency(max_limit=2)
+        lock = threading.Lock()
+        state = {"in_flight": 0, "max": 0}
+
+        def _call():
+            with lock:
+                state["in_flight"] += 1
+                state["max"] = max(state["max"], state["in_flight"])
+            time.sleep(0.02)
+            with lock:
+                state["in_flight"] -= 1
+
+        threads = [threading.Thread(target=concurrency.run, args=(_call,)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert state["max"] == 2
+
+
+class TestIsThrottlingError:
+    def test_http_429(self):
+        response = requests.Response()
+        response.status_code = 429
+        assert is_throttling_error(requests.HTTPError(response=response))
+
+    def test_wrapped_message(self):
+        assert is_throttling_error(RuntimeError("HTTPError: 429 Client Error: Too Many Requests"))
+
+    def test_timeouts(self):
+        assert is_throttling_error(FunctionTimeoutError("too long"))
+        assert is_throttling_error(requests.Timeout())
+
+    def test_other_errors(self):
+        assert not is_throttling_error(ValueError("malformed SOFT"))
+
+    def test_accession_digits_are_not_throttling(self):
+        assert not is_throttling_error(
+            RuntimeError("Geofetch worker for GSE142900 exited unexpectedly")
+        )
+        assert not is_throttling_error(ValueError("Unable to parse SOFT of GSE74290"))
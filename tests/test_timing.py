@@ -0,0 +1,36 @@
+"""Offline tests for per-stage timing."""
+
+import pytest
+
+from geopephub.timing import percentile, summarize_stage_metrics, timed
+
+
+def test_timed_adds_up(monkeypatch):
+    clock = iter([0.0, 1.5, 10.0, 10.25])
+    monkeypatch.setattr("geopephub.timing.time.perf_counter", lambda: next(clock))
+    metrics = {}
+
+    with timed(metrics, "fetch"):
+        pass
+    with pytest.raises(RuntimeError):
+        with timed(metrics, "fetch"):
+            raise RuntimeError("NCBI error")
+
+    assert metrics == {"fetch_s": 1.75}
+
+
+@pytest.mark.parametrize("q, expected", [(0, 1), (50, 5.5), (95, 9.55), (100, 10)])
+def test_percentile(q, expected):
+    assert percentile(list(range(1, 11)), q) == pytest.approx(expected)
+
+
+def test_summarize_stage_metrics():
+    metrics = [{"fetch_s": float(i), "samples": 2} for i in range(1, 101)]
+    metrics.append({"status_s": 0.5})
+
+    summary = summarize_stage_metrics(metrics)
+
+    assert summary["fetch_s"] == {"n": 100, "p50": 50.5, "p95": 95.05, "max": 100.0}
+    assert summary["samples"]["max"] == 2
+    assert summary["status_s"] == {"n": 1, "p50": 0.5, "p95": 0.5, "max": 0.5}
+    assert summarize_stage_metrics([]) == {}
@@ -0,0 +1,194 @@
+"""Offline tests for the GSE uploader. No database, no network."""
+
+import threading
+import time
+
+import peppy
+import pytest
+
+from geopephub import metageo_pephub
+from geopephub.models import StatusModel
+
+
+class FakeLogConnection:
+    """Records every status write, keyed by GSE."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.writes = {}
+
+    def upload_project_log(self, model: StatusModel) -> StatusModel:
+        with self.lock:
+            self.writes.setdefault(model.gse, []).append(model.model_copy())
+        return model
+
+
+class FakeProjectModule:
+    def __init__(self, fail_names=()):
+        self.fail_names = set(fail_names)
+        self.created = []
+
+    def create(self, project, namespace, name, tag, **kwargs):
+        if name in self.fail_names:
+            raise RuntimeError(f"cannot create {name}")
+        self.created.append(f"{namespace}/{name}:{tag}")
+
+
+class FakeAgent:
+    def __init__(self, fail_names=()):
+        self.project = FakeProjectModule(fail_names)
+
+
+def make_project():
+    return peppy.Project.from_dict(
+        {"_config": {"pep_version": "2.1.0"}, "_sample_dict": [{"sample_name": "s1"}]}
+    )
+
+
+@pytest.fixture
+def fake_geofetch(monkeypatch):
+    """GSEs ending in 0 fail in geofetch, 4 time out, 1 return nothing."""
+
+    def _run_geofetch(gse, geofetcher_obj=None, **kwargs):
+        if gse.endswith("4"):
+            raise metageo_pephub.FunctionTimeoutError("too long")
+        if gse.endswith("0"):
+            raise RuntimeError("NCBI error")
+        if gse.endswith("1"):
+            return {}
+        return {f"{gse}_default": make_project()}
+
+    monkeypatch.setattr(metageo_pephub, "run_geofetch", _run_geofetch)
+    monkeypatch.setattr(metageo_pephub.geofetch, "Geofetcher", lambda **kwargs: None)
+    monkeypatch.setattr(metageo_pephub, "get_geofetch_cache", lambda: None)
+
+
+def make_logs(gses):
+    return (
+        StatusModel(
+            gse=gse, target="geo", log_stage=0, status="queued", upload_cycle_id=1
+        )
+        for gse in gses
+    )
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_status_totals_add_up(fake_geofetch, workers):
+    gses = [f"GSE1000{i}" for i in range(10)]
+    agent = FakeAgent(fail_names=["GSE10003"])
+    log_connection = FakeLogConnection()
+
+    status_dict = metageo_pephub._upload_gse_project(
+        agent, log_connection, make_logs(gses), "geo", workers=workers
+    )
+
+    assert status_dict == {"total": 10, "success": 6, "failure": 3, "warning": 1}
+    assert sorted(agent.project.created) == sorted(
+        f"geo/{gse}:default" for gse in gses if gse[-1] not in "0134"
+    )
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_status_transitions(fake_geofetch, workers):
+    gses = ["GSE10000", "GSE10001", "GSE10002", "GSE10004"]
+    log_connection = FakeLogConnection()
+
+    metageo_pephub._upload_gse_project(
+        FakeAgent(), log_connection, make_logs(gses), "geo", workers=workers
+    )
+
+    for gse in gses:
+        assert log_connection.writes[gse][0].status == "processing"
+        assert log_connection.writes[gse][0].log_stage == 1
+    assert log_connection.writes["GSE10000"][-1].status == "failure"
+    assert log_connection.writes["GSE10001"][-1].status == "warning"
+    assert log_connection.writes["GSE10002"][-1].status == "success"
+    assert log_connection.writes["GSE10002"][-1].log_stage == 3
+    assert log_connection.writes["GSE10004"][-1].status == "failure"
+    assert log_connection.writes["GSE10004"][-1].status_info == "timeout"
+    assert log_connection.writes["GSE10000"][-1].status_info == "geofetcher"
+    assert log_connection.writes["GSE10002"][-1].stage_metrics.keys() >= {
+        "samples",
+        "prepare_s",
+        "create_s",
+        "status_s",
+    }
+    assert log_connection.writes["GSE10002"][-1].stage_metrics["samples"] == 1
+
+
+def test_gse_fails_if_any_pep_failed(monkeypatch):
+    monkeypatch.setattr(
+        metageo_pephub,
+        "_write_projects",
+        lambda agent, target, projects: [RuntimeError("too many columns"), None],
+    )
+    log_connection = FakeLogConnection()
+    (gse_log,) = make_logs(["GSE1"])
+
+    status_dict = metageo_pephub._create_gse_projects(
+        FakeAgent(),
+        log_connection,
+        gse_log,
+        {"GSE1_raw": make_project(), "GSE1_samples": make_project()},
+        "bedbase",
+    )
+
+    assert status_dict == {"success": 1, "failure": 1}
+    writes = log_connection.writes["GSE1"]
+    assert [log.status for log in writes] == ["failure", "success", "failure"]
+    assert writes[-1].registry_path == "bedbase/GSE1:raw"
+    assert writes[-1].info == "too many columns"
+
+
+def test_fetch_stage_is_bounded(monkeypatch):
+    """Downloads may run ahead of PEPhub writes only by workers + queue_size GSEs."""
+    workers, queue_size = 2, 1
+    counters = {"fetched": 0, "created": 0, "max_ahead": 0}
+    lock = threading.Lock()
+
+    def _run_geofetch(gse, geofetcher_obj=None, **kwargs):
+        with lock:
+            counters["fetched"] += 1
+        return {f"{gse}_default": make_project()}
+
+    class SlowProjectModule(FakeProjectModule):
+        def create(self, project, namespace, name, tag, **kwargs):
+            time.sleep(0.01)
+            with lock:
+                counters["created"] += 1
+                ahead = counters["fetched"] - counters["created"]
+                counters["max_ahead"] = max(counters["max_ahead"], ahead)
+
+    monkeypatch.setattr(metageo_pephub, "run_geofetch", _run_geofetch)
+    monkeypatch.setattr(metageo_pephub.geofetch, "Geofetcher", lambda **kwargs: None)
+    monkeypatch.setattr(metageo_pephub, "get_geofetch_cache", lambda: None)
+    agent = FakeAgent()
+    agent.project = SlowProjectModule()
+
+    gses = [f"GSE2000{i:02d}" for i in range(30)]
+    status_dict = metageo_pephub._upload_gse_project(
+        agent,
+        FakeLogConnection(),
+        make_logs(gses),
+        "geo",
+        workers=workers,
+        queue_size=queue_size,
+    )
+
+    assert status_dict["success"] == 30
+    # one item is being written, queue_size wait, each worker holds one more
+    assert counters["max_ahead"] <= queue_size + workers + 1
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_log_stream_error_is_raised(fake_geofetch, workers):
+    """A broken status stream must fail the cycle, not end it as a success."""
+
+    def broken_logs():
+        yield from make_logs(["GSE10002", "GSE10003"])
+        raise ConnectionError("server closed the connection unexpectedly")
+
+    with pytest.raises(ConnectionError):
+        metageo_pephub._upload_gse_project(
+            FakeAgent(), FakeLogConnection(), broken_logs(), "geo", workers=workers
+        )
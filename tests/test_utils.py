@@ -0,0 +1,205 @@
+"""Offline tests for geopephub.utils helpers. No database, no network."""
+
+import concurrent.futures
+import os
+import time
+
+import peppy
+import pytest
+
+from geopephub import utils
+from geopephub.utils import (
+    FunctionTimeoutError,
+    GeofetchCache,
+    run_geofetch,
+    split_period,
+)
+
+
+class StubGeofetcher:
+    """Picklable stand-in for geofetch.Geofetcher."""
+
+    def __init__(self, delay: float = 0, error: Exception = None):
+        self.delay = delay
+        self.error = error
+
+    def get_projects(self, gse):
+        time.sleep(self.delay)
+        if self.error:
+            raise self.error
+        project = peppy.Project.from_dict(
+            {
+                "_config": {"pep_version": "2.1.0", "description": f"{gse} project"},
+                "_sample_dict": [{"sample_name": "s1"}, {"sample_name": "s2"}],
+            }
+        )
+        return {f"{gse}_default": project}
+
+
+class TestRunGeofetch:
+    def test_returns_projects(self):
+        project_dict = run_geofetch("GSE100000", StubGeofetcher(), timeout=60)
+
+        assert list(project_dict) == ["GSE100000_default"]
+        project = project_dict["GSE100000_default"]
+        assert isinstance(project, peppy.Project)
+        assert project.description == "GSE100000 project"
+        assert len(project.samples) == 2
+
+    def test_timeout_kills_worker(self):
+        start = time.time()
+        with pytest.raises(FunctionTimeoutError):
+            run_geofetch("GSE100000", StubGeofetcher(delay=60), timeout=1)
+        assert time.time() - start < 30
+
+    def test_propagates_errors(self):
+        with pytest.raises(ValueError, match="malformed"):
+            run_geofetch(
+                "GSE100000", StubGeofetcher(error=ValueError("malformed")), timeout=60
+            )
+
+    def test_timeout_works_in_threads(self):
+        """SIGALRM only worked in the main thread; the subprocess timeout must not."""
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+            slow = pool.submit(run_geofetch, "GSE1", StubGeofetcher(delay=60), 1)
+            fast = pool.submit(run_geofetch, "GSE2", StubGeofetcher(), 60)
+            assert list(fast.result()) == ["GSE2_default"]
+            with pytest.raises(FunctionTimeoutError):
+                slow.result()
+
+
+class TestGeofetchCache:
+    def test_key_depends_on_update_date_and_settings(self, tmp_path):
+        cache = GeofetchCache(str(tmp_path), max_size=10**6)
+        plain = StubGeofetcher()
+        processed = StubGeofetcher()
+        processed.processed = True
+
+        key = cache.key("GSE1", "Mar 01 2024", plain)
+        assert key == cache.key("gse1", "Mar 01 2024", StubGeofetcher())
+        assert key != cache.key("GSE1", "Mar 02 2024", plain)
+        assert key != cache.key("GSE1", "Mar 01 2024", processed)
+        assert key != cache.key("GSE2", "Mar 01 2024", plain)
+
+    def test_round_trip(self, tmp_path):
+        cache = GeofetchCache(str(tmp_path), max_size=10**6)
+        project_dicts = {"GSE1_default": {"_config": {}, "_sample_dict": [{"a": 1}]}}
+
+        assert cache.get("ab" * 32) is None
+        cache.put("ab" * 32, project_dicts)
+        assert cache.get("ab" * 32) == project_dicts
+
+    def test_evicts_least_recently_used(self, tmp_path):
+        payload = {"GSE_default": {"data": "x" * 1000}}
+        cache = GeofetchCache(str(tmp_path), max_size=2500)
+        keys = [f"{i:02d}" * 32 for i in range(3)]
+
+        cache.put(keys[0], payload)
+        cache.put(keys[1], payload)
+        # make keys[0] the most recently used one
+        old = time.time() - 100
+        os.utime(cache._path(keys[1]), (old, old))
+        assert cache.get(keys[0]) == payload
+        cache.put(keys[2], payload)
+
+        assert cache.get(keys[0]) == payload
+        assert cache.get(keys[1]) is None
+        assert cache.get(keys[2]) == payload
+
+    def test_size_survives_restart(self, tmp_path):
+        payload = {"GSE_default": {"data": "x" * 1000}}
+        GeofetchCache(str(tmp_path), max_size=10**6).put("aa" * 32, payload)
+
+        assert GeofetchCache(str(tmp_path), max_size=10**6)._size > 1000
+
+    def test_overwrite_does_not_double_count(self, tmp_path):
+        payload = {"GSE_default": {"data": "x" * 1000}}
+        cache = GeofetchCache(str(tmp_path), max_size=10**6)
+
+        cache.put("aa" * 32, payload)
+        size = cache._size
+        cache.put("aa" * 32, payload)
+        assert cache._size == size
+
+    def test_empty_result_is_not_cached(self, tmp_path, monkeypatch):
+        cache = GeofetchCache(str(tmp_path), max_size=10**6)
+        calls = []
+        monkeypatch.setattr(
+            utils,
+            "_run_geofetch_subprocess",
+            lambda gse, geofetcher_obj, timeout: calls.append(gse) or ({}, 0),
+        )
+        monkeypatch.setattr(utils, "get_gse_last_update_date", lambda gse: "Mar 01")
+
+        run_geofetch("GSE1", StubGeofetcher(), cache=cache)
+        run_geofetch("GSE1", StubGeofetcher(), cache=cache)
+        assert calls == ["GSE1", "GSE1"]
+        assert cache._size == 0
+
+    def test_run_geofetch_uses_cache(self, tmp_path, monkeypatch):
+        cache = GeofetchCache(str(tmp_path), max_size=10**6)
+        calls = []
+
+        def _subprocess(gse, geofetcher_obj, timeout):
+            calls.append(gse)
+            project_dicts = {
+                f"{gse}_default": {
+                    "_config": {"pep_version": "2.1.0"},
+                    "_sample_dict": [{"sample_name": "s1"}],
+                }
+            }
+            return project_dicts, 100
+
+        monkeypatch.setattr(utils, "_run_geofetch_subprocess", _subprocess)
+        update_date = {"GSE1": "Mar 01 2024"}
+        monkeypatch.setattr(utils, "get_gse_last_update_date", update_date.get)
+
+        stage_metrics = {}
+        run_geofetch("GSE1", StubGeofetcher(), cache=cache, stage_metrics=stage_metrics)
+        assert stage_metrics["bytes"] == 100
+        project = run_geofetch(
+            "GSE1", StubGeofetcher(), cache=cache, stage_metrics=stage_metrics
+        )["GSE1_default"]
+        assert calls == ["GSE1"]
+        assert len(project.samples) == 1
+        # cache hits are sized by the cache entry
+        key = cache.key("GSE1", "Mar 01 2024", StubGeofetcher())
+        assert stage_metrics["bytes"] == cache.size(key) > 0
+        assert {"fetch_s", "parse_s"} <= stage_metrics.keys()
+
+        update_date["GSE1"] = "Mar 05 2024"
+        run_geofetch("GSE1", StubGeofetcher(), cache=cache)
+        assert calls == ["GSE1", "GSE1"]
+
+    def test_unknown_update_date_bypasses_cache(self, tmp_path, monkeypatch):
+        cache = GeofetchCache(str(tmp_path), max_size=10**6)
+        calls = []
+        monkeypatch.setattr(
+            utils,
+            "_run_geofetch_subprocess",
+            lambda gse, geofetcher_obj, timeout: calls.append(gse) or ({}, 0),
+        )
+        monkeypatch.setattr(utils, "get_gse_last_update_date", lambda gse: None)
+
+        run_geofetch("GSE1", StubGeofetcher(), cache=cache)
+        run_geofetch("GSE1", StubGeofetcher(), cache=cache)
+        assert calls == ["GSE1", "GSE1"]
+
+
+class TestSplitPeriod:
+    def test_short_period(self):
+        assert split_period("2024/01/01", "2024/01/08", 7) == [
+            ("2024/01/01", "2024/01/08")
+        ]
+
+    def test_windows_share_boundaries(self):
+        assert split_period("2024/01/30", "2024/02/14", 7) == [
+            ("2024/01/30", "2024/02/06"),
+            ("2024/02/06", "2024/02/13"),
+            ("2024/02/13", "2024/02/14"),
+        ]
+
+    def test_disabled(self):
+        assert split_period("2020/01/01", "2024/01/01", 0) == [
+            ("2020/01/01", "2024/01/01")
+        ]
@@ -0,0 +1,271 @@
+"""Tests for run-worker. Run against a throwaway SQLite file; the concurrency test
+needs a local PostgreSQL in GEOPEPHUB_TEST_POSTGRES_DSN."""
+
+import datetime
+import os
+import threading
+
+import pytest
+
+from geopephub import metageo_pephub, worker
+from geopephub.db_utils import BaseEngine
+
+from test_db_utils import db, make_cycle, queued_logs
+from test_uploader import FakeAgent, fake_geofetch
+
+
+def utc(value: datetime.datetime) -> datetime.datetime:
+    # SQLite returns naive datetimes
+    return value if value.tzinfo else value.replace(tzinfo=datetime.timezone.utc)
+
+
+class TestClaim:
+    def test_claims_in_batches(self, db):
+        cycle = make_cycle(db)
+        db.upload_project_logs(queued_logs(cycle.id, [f"GSE{i}" for i in range(5)]))
+
+        first = db.claim_queued_projects("geo", "w1", batch_size=3)
+        second = db.claim_queued_projects("geo", "w2", batch_size=3)
+
+        assert [m.gse for m in first] == ["GSE0", "GSE1", "GSE2"]
+        assert [m.gse for m in second] == ["GSE3", "GSE4"]
+        assert all(m.status == "processing" and m.worker_id == "w1" for m in first)
+        assert db.claim_queued_projects("geo", "w3") == []
+        assert db.get_cycle_status_counts(cycle.id) == {"processing": 5}
+        assert db.was_run_successful("2024/01/01", "2024/01/02").status == "processing"
+
+    def test_skips_other_targets_and_finished_cycles(self, db):
+        done = make_cycle(db, status="success")
+        bedbase = make_cycle(db, target="bedbase")
+        db.upload_project_logs(queued_logs(done.id, ["GSE1"]))
+        db.upload_project_logs(queued_logs(bedbase.id, ["GSE2"], target="bedbase"))
+
+        assert db.claim_queued_projects("geo", "w1") == []
+
+    def test_skips_cycles_of_uploaders(self, db):
+        cycle = make_cycle(db)
+        db.upload_project_logs(queued_logs(cycle.id, ["GSE1", "GSE2"]))
+        assert db.claim_cycle(cycle.id, "uploader")
+
+        assert db.claim_queued_projects("geo", "w1") == []
+        claimed = list(db.iter_claimed_projects("geo", cycle.id, "uploader", 1))
+        assert [m.gse for m in claimed] == ["GSE1", "GSE2"]
+        assert {m.worker_id for m in claimed} == {"uploader"}
+
+    def test_status_writes_keep_the_lease(self, db):
+        cycle = make_cycle(db)
+        db.upload_project_logs(queued_logs(cycle.id, ["GSE1"]))
+        (model,) = db.claim_queued_projects("geo", "w1", lease_seconds=60)
+
+        assert db.extend_project_leases("w1", lease_seconds=3600) == 1
+        model.log_stage = 2
+        db.upload_project_log(model)
+
+        (model,) = db.iter_failed_project(cycle.id)
+        remaining = utc(model.lease_expires_at) - datetime.datetime.now(
+            datetime.timezone.utc
+        )
+        assert remaining > datetime.timedelta(minutes=30)
+        assert model.worker_id == "w1"
+
+    def test_finished_projects_are_not_extended(self, db):
+        cycle = make_cycle(db)
+        db.upload_project_logs(queued_logs(cycle.id, ["GSE1", "GSE2"]))
+        claimed = db.claim_queued_projects("geo", "w1")
+        claimed[0].status = "success"
+        db.upload_project_log(claimed[0])
+
+        assert db.extend_project_leases("w1") == 1
+
+
+class TestFinalize:
+    def test_only_when_nothing_is_left(self, db):
+        cycle = make_cycle(db)
+        db.upload_project_logs(queued_logs(cycle.id, ["GSE1", "GSE2", "GSE3"]))
+        claimed = db.claim_queued_projects("geo", "w1", batch_size=2)
+        for model, status in zip(claimed, ["success", "failure"]):
+            model.status = status
+            db.upload_project_log(model)
+
+        assert not db.finalize_cycle(cycle.id)
+
+        (last,) = db.claim_queued_projects("geo", "w2")
+        last.status = "warning"
+        db.upload_project_log(last)
+
+        assert db.finalize_cycle(cycle.id)
+        assert not db.finalize_cycle(cycle.id)
+        finished = db.was_run_successful("2024/01/01", "2024/01/02")
+        assert finished.status == "success"
+        assert finished.number_of_projects == 3
+        assert finished.number_of_successes == 2
+        assert finished.number_of_failures == 1
+
+
+def crashed_cycle(db, statuses, lease_seconds=-1):
+    """Cycle of an uploader, that died while processing projects in given statuses."""
+    cycle = make_cycle(db)
+    models = db.upload_project_logs(
+        queued_logs(cycle.id, [f"GSE1000{i}" for i in range(2, 2 + len(statuses))])
+    )
+    assert db.claim_cycle(cycle.id, "dead-uploader", lease_seconds=lease_seconds)
+    for model, status in zip(models, statuses):
+        model.status = status
+        model.log_stage = 2
+        db.upload_project_log(model)
+    return cycle
+
+
+class TestResume:
+    def test_cycle_claim_is_exclusive(self, db):
+        cycle = make_cycle(db)
+
+        assert db.claim_cycle(cycle.id, "u1")
+        assert not db.claim_cycle(cycle.id, "u2")
+
+    def test_requeues_expired_uploader_cycle(self, db):
+        cycle = crashed_cycle(db, ["success", "processing", "processing"])
+
+        assert db.requeue_expired("geo") == (2, 1)
+
+        assert db.get_cycle_status_counts(cycle.id) == {"success": 1, "queued": 2}
+        (queued,) = db.get_queued_cycle("geo")
+        assert queued.id == cycle.id
+        resumed = db.get_queued_project(cycle.id)
+        assert {m.status_info for m in resumed} == {"resumed"}
+        assert {m.log_stage for m in resumed} == {2}
+
+    def test_live_leases_are_not_touched(self, db):
+        crashed_cycle(db, ["processing"], lease_seconds=3600)
+        worker_cycle = make_cycle(db)
+        db.upload_project_logs(queued_logs(worker_cycle.id, ["GSE1"]))
+        db.claim_queued_projects("geo", "w1", lease_seconds=3600)
+
+        assert db.requeue_expired("geo") == (0, 0)
+
+    def test_requeues_expired_worker_projects(self, db):
+        cycle = make_cycle(db)
+        db.upload_project_logs(queued_logs(cycle.id, ["GSE1", "GSE2"]))
+        db.claim_queued_projects("geo", "dead", batch_size=1, lease_seconds=-1)
+        db.claim_queued_projects("geo", "alive", batch_size=1, lease_seconds=3600)
+
+        assert db.requeue_expired("geo") == (1, 0)
+        assert [m.gse for m in db.claim_queued_projects("geo", "w2")] == ["GSE1"]
+
+    def test_leased_project_keeps_cycle_processing(self, db):
+        cycle = crashed_cycle(db, ["processing"])
+        db.upload_project_logs(queued_logs(cycle.id, ["GSE2"]))
+        db.claim_queued_projects(
+            "geo", "alive", lease_seconds=3600, cycle_id=cycle.id
+        )
+
+        assert db.requeue_expired("geo") == (0, 0)
+
+    def test_upload_queued_projects_resumes(self, db, fake_geofetch, monkeypatch):
+        monkeypatch.setattr(metageo_pephub, "get_base_db_engine", lambda: db)
+        agent = FakeAgent()
+        monkeypatch.setattr(metageo_pephub, "get_agent", lambda: agent)
+        cycle = crashed_cycle(db, ["success", "processing"])
+
+        metageo_pephub.upload_queued_projects("geo")
+        assert db.get_cycle_status_counts(cycle.id) == {
+            "success": 1,
+            "processing": 1,
+        }
+
+        metageo_pephub.upload_queued_projects("geo", resume=True)
+
+        finished = db.was_run_successful("2024/01/01", "2024/01/02")
+        assert finished.status == "success"
+        assert finished.number_of_projects == 2
+        assert finished.number_of_successes == 2
+        assert agent.project.created == ["geo/GSE10003:default"]
+
+
+def test_run_worker(db, fake_geofetch, monkeypatch):
+    monkeypatch.setattr(worker, "get_base_db_engine", lambda: db)
+    agent = FakeAgent()
+    monkeypatch.setattr(worker, "get_agent", lambda: agent)
+    cycles = [make_cycle(db), make_cycle(db)]
+    db.upload_project_logs(queued_logs(cycles[0].id, ["GSE10002", "GSE10000"]))
+    db.upload_project_logs(queued_logs(cycles[1].id, ["GSE10003", "GSE10001"]))
+
+    status_dict = worker.run_worker("geo", batch_size=3, workers=2, worker_id="w1")
+
+    assert status_dict == {"total": 4, "success": 2, "failure": 1, "warning": 1}
+    for cycle in cycles:
+        assert db.get_cycle_status_counts(cycle.id).get("processing") is None
+        assert not db.finalize_cycle(cycle.id)
+    assert db.claim_queued_projects("geo", "w2") == []
+
+
+def test_uploader_and_worker_on_one_cycle(db, fake_geofetch, monkeypatch):
+    uploader_agent, worker_agent = FakeAgent(), FakeAgent()
+    for module, agent in [(metageo_pephub, uploader_agent), (worker, worker_agent)]:
+        monkeypatch.setattr(module, "get_base_db_engine", lambda: db)
+        monkeypatch.setattr(module, "get_agent", lambda agent=agent: agent)
+    cycle = make_cycle(db)
+    gses = ["GSE10002", "GSE10003", "GSE10005", "GSE10006"]
+    db.upload_project_logs(queued_logs(cycle.id, gses))
+
+    # a worker starts while the uploader is writing its first project
+    worker_reports = []
+    create = uploader_agent.project.create
+
+    def create_and_start_worker(*args, **kwargs):
+        if not worker_reports:
+            worker_reports.append(worker.run_worker("geo", worker_id="w1"))
+        return create(*args, **kwargs)
+
+    monkeypatch.setattr(uploader_agent.project, "create", create_and_start_worker)
+
+    metageo_pephub.upload_queued_projects("geo")
+
+    assert worker_reports[0]["total"] == 0
+    assert worker_agent.project.created == []
+    assert sorted(uploader_agent.project.created) == [
+        f"geo/{gse}:default" for gse in gses
+    ]
+    finished = db.was_run_successful("2024/01/01", "2024/01/02")
+    assert finished.status == "success"
+    assert finished.number_of_successes == 4
+
+
+def test_uploader_leaves_cycle_to_worker(db):
+    cycle = make_cycle(db)
+    db.upload_project_logs(queued_logs(cycle.id, ["GSE1"]))
+    (model,) = db.claim_queued_projects("geo", "w1")
+
+    assert not metageo_pephub._finish_cycle(db, cycle)
+    assert db.was_run_successful("2024/01/01", "2024/01/02").status == "processing"
+
+    model.status = "success"
+    db.upload_project_log(model)
+    assert db.finalize_cycle(cycle.id)
+
+
+@pytest.mark.skipif(
+    not os.environ.get("GEOPEPHUB_TEST_POSTGRES_DSN"),
+    reason="needs GEOPEPHUB_TEST_POSTGRES_DSN of a throwaway PostgreSQL database",
+)
+def test_concurrent_claims_do_not_overlap():
+    pg = BaseEngine(dsn=os.environ["GEOPEPHUB_TEST_POSTGRES_DSN"])
+    pg.create_schema()
+    cycle = make_cycle(pg)
+    pg.upload_project_logs(queued_logs(cycle.id, [f"GSE{i}" for i in range(200)]))
+
+    claimed = {}
+
+    def _claim(worker_id):
+        claimed[worker_id] = []
+        while batch := pg.claim_queued_projects("geo", worker_id, batch_size=7):
+            claimed[worker_id].extend(m.id for m in batch)
+
+    threads = [threading.Thread(target=_claim, args=(f"w{i}",)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    ids = [i for batch in claimed.values() for i in batch]
+    assert len(ids) == len(set(ids)) == 200